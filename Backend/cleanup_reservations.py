@@ -11,6 +11,7 @@ django.setup()
 from django.utils import timezone
 from django.db import transaction
 from myapp.models import InventoryReservation, ProductVariant
+from myapp.inventory import expire_reservations
 import logging
 
 # Configure logging
@@ -24,48 +25,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 def cleanup_expired_reservations():
-    """Clean up expired reservations and verify inventory consistency"""
-    now = timezone.now()
-    
-    # Find all expired but still active reservations
-    expired_reservations = InventoryReservation.objects.filter(
-        expires_at__lt=now,
-        is_active=True
-    )
-    
-    logger.info(f"Found {expired_reservations.count()} expired but still active reservations")
-    
-    # Process each expired reservation
-    for reservation in expired_reservations:
-        with transaction.atomic():
-            try:
-                variant = reservation.variant
-                
-                # Log before state
-                logger.info(f"Before cleanup - Variant {variant.id}: count_in_stock={variant.count_in_stock}, "
-                           f"reserved_stock={variant.reserved_stock}, available_stock={variant.available_stock}")
-                
-                # Release the reserved stock
-                variant.reserved_stock = max(0, variant.reserved_stock - reservation.quantity)
-                variant.save()
-                
-                # Mark reservation as canceled
-                reservation.is_active = False
-                reservation.canceled_at = now
-                reservation.save()
-                
-                # Refresh from database to ensure we have the latest values
-                variant.refresh_from_db()
-                
-                # Log after state
-                logger.info(f"After cleanup - Variant {variant.id}: count_in_stock={variant.count_in_stock}, "
-                           f"reserved_stock={variant.reserved_stock}, available_stock={variant.available_stock}")
-                
-                logger.info(f"Released {reservation.quantity} units of variant {variant.id} "
-                           f"from reservation {reservation.id}. New reserved_stock: {variant.reserved_stock}")
-            
-            except Exception as e:
-                logger.error(f"Error cleaning up reservation {reservation.id}: {str(e)}")
+    """Clean up expired reservations with the shared set-based sweep"""
+    count = expire_reservations()
+    logger.info(f"Released {count} expired reservations")
 
 def verify_inventory_consistency():
     """Verify that reserved_stock matches the sum of active reservations"""
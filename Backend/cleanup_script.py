@@ -11,6 +11,7 @@ django.setup()
 from django.utils import timezone
 from django.db import transaction
 from myapp.models import InventoryReservation, ProductVariant
+from myapp.inventory import expire_reservations
 
 # Set up logging
 logging.basicConfig(
@@ -27,54 +28,14 @@ def cleanup_expired_reservations():
     """Clean up expired inventory reservations and release reserved stock"""
     logger.info("Starting cleanup of expired reservations...")
     
-    # Get current time
-    now = timezone.now()
+    # Shared set-based sweep, one short transaction per batch
+    count = expire_reservations()
     
-    # Get all active reservations that have expired
-    expired_reservations = InventoryReservation.objects.filter(
-        is_active=True,
-        expires_at__lte=now
-    ).select_related('variant')
-    
-    if not expired_reservations.exists():
+    if not count:
         logger.info('No expired reservations found.')
         return
     
-    logger.info(f"Found {expired_reservations.count()} expired reservations to clean up...")
-    
-    # Process each expired reservation
-    with transaction.atomic():
-        for reservation in expired_reservations:
-            variant = reservation.variant
-            
-            # Log before state
-            logger.info(f"Before cleanup - Variant {variant.id}: count_in_stock={variant.count_in_stock}, "
-                        f"reserved_stock={variant.reserved_stock}, available_stock={variant.available_stock}")
-            
-            # Release the reserved stock
-            old_reserved_stock = variant.reserved_stock
-            variant.reserved_stock = max(0, variant.reserved_stock - reservation.quantity)
-            variant.save()
-            
-            # Mark reservation as expired
-            reservation.is_active = False
-            reservation.canceled_at = now
-            reservation.save()
-            
-            # Refresh from database
-            variant.refresh_from_db()
-            
-            # Log after state
-            logger.info(f"After cleanup - Variant {variant.id}: count_in_stock={variant.count_in_stock}, "
-                        f"reserved_stock={variant.reserved_stock}, available_stock={variant.available_stock}")
-            
-            logger.info(
-                f"Released {reservation.quantity} units of variant {variant.id} "
-                f"from expired reservation {reservation.id}. "
-                f"Reserved stock changed from {old_reserved_stock} to {variant.reserved_stock}"
-            )
-    
-    logger.info('Successfully cleaned up expired reservations.')
+    logger.info(f'Successfully cleaned up {count} expired reservations.')
 
 def cleanup_stale_reservations():
     """Clean up stale reservations that are older than 24 hours"""
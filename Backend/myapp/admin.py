@@ -1,7 +1,8 @@
 from django.contrib import admin
 from .models import (
-    Product, ProductVariant, InventoryChange, InventoryReservation,
-    PhoneBrand, PhoneModel, RepairService, Accessories
+    Product, ProductVariant, InventoryChange, InventoryReservation, InventorySnapshot,
+    PhoneBrand, PhoneModel, RepairService, Accessories, StripeSyncTask,
+    WebhookEvent
 )
 
 class ProductVariantInline(admin.TabularInline):
@@ -26,6 +27,11 @@ class InventoryChangeAdmin(admin.ModelAdmin):
     search_fields = ('variant__product__name', 'notes')
     date_hierarchy = 'created_at'
 
+class InventorySnapshotAdmin(admin.ModelAdmin):
+    list_display = ('variant', 'count_in_stock', 'reserved_stock', 'taken_at')
+    list_filter = ('taken_at',)
+    search_fields = ('variant__sku', 'variant__product__name')
+
 
 class InventoryReservationAdmin(admin.ModelAdmin):
     list_display = ('variant', 'quantity', 'session_id', 'expires_at', 'is_active')
@@ -33,6 +39,16 @@ class InventoryReservationAdmin(admin.ModelAdmin):
     search_fields = ('session_id', 'order_id', 'variant__product__name')
     date_hierarchy = 'created_at'
 
+class StripeSyncTaskAdmin(admin.ModelAdmin):
+    list_display = ('object_type', 'object_id', 'attempts', 'next_attempt_at', 'processed_at')
+    list_filter = ('object_type', 'processed_at')
+    search_fields = ('last_error',)
+
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'event_type')
+    search_fields = ('event_id',)
+
 class PhoneBrandAdmin(admin.ModelAdmin):
     list_display = ('name',)
     prepopulated_fields = {'slug': ('name',)}
@@ -55,7 +71,10 @@ class AccessoriesAdmin(admin.ModelAdmin):
 admin.site.register(Product, ProductAdmin)
 admin.site.register(ProductVariant, ProductVariantAdmin)
 admin.site.register(InventoryChange, InventoryChangeAdmin)
+admin.site.register(InventorySnapshot, InventorySnapshotAdmin)
 admin.site.register(InventoryReservation, InventoryReservationAdmin)
+admin.site.register(StripeSyncTask, StripeSyncTaskAdmin)
+admin.site.register(WebhookEvent, WebhookEventAdmin)
 admin.site.register(PhoneBrand, PhoneBrandAdmin)
 admin.site.register(PhoneModel, PhoneModelAdmin)
 admin.site.register(RepairService, RepairServiceAdmin)
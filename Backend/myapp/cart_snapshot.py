@@ -0,0 +1,133 @@
+"""
+Denormalized cart snapshots. Cart.snapshot holds the cart as CartSerializer
+renders it. The cart views patch the changed line and the totals in place, so
+reads and mutation responses need only the cart row. Saving a product or
+variant clears the snapshots of the carts holding it (prices or images may
+have changed), as do CartItem edits made outside the cart views; a cleared
+snapshot is rebuilt on the next read.
+"""
+import contextvars
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import Cart, CartItem
+
+# Cart whose snapshot the current mutation maintains itself
+_editing_cart = contextvars.ContextVar('editing_cart', default=None)
+
+_datetime = serializers.DateTimeField()
+
+
+def line_for_item(item):
+    """
+    One cart line in CartItemSerializer's shape; item.product and item.variant must be loaded
+    """
+    variant = item.variant
+    if variant and variant.color_image:
+        image = variant.color_image.url
+    else:
+        image = item.product.base_image.url if item.product.base_image else None
+    return {
+        'id': item.id,
+        'product': item.product_id,
+        'product_name': item.product.name,
+        'product_image': image,
+        'variant': item.variant_id,
+        'variant_details': {
+            'color': variant.color,
+            'storage': variant.storage,
+            'sku': variant.sku
+        } if variant else None,
+        'quantity': item.quantity,
+        'price': float(item.price),
+        'total_price': float(item.total_price),
+    }
+
+
+def build_cart_snapshot(cart):
+    """
+    Build a snapshot from the cart's items (one query)
+    """
+    items = CartItem.objects.filter(cart=cart).select_related('product', 'variant').order_by('id')
+    return {
+        'id': cart.id,
+        'items': [line_for_item(item) for item in items],
+        'created_at': _datetime.to_representation(cart.created_at),
+    }
+
+
+def add_totals(snapshot):
+    """
+    Recompute total_price and total_items from the snapshot's lines
+    """
+    snapshot['total_price'] = float(sum(
+        Decimal(str(line['price'])) * line['quantity'] for line in snapshot['items']
+    ))
+    snapshot['total_items'] = sum(line['quantity'] for line in snapshot['items'])
+    return snapshot
+
+
+def save_cart_snapshot(cart, snapshot):
+    """
+    Recompute the totals and store the snapshot; returns it
+    """
+    now = timezone.now()
+    add_totals(snapshot)
+    snapshot['updated_at'] = _datetime.to_representation(now)
+    Cart.objects.filter(pk=cart.pk).update(snapshot=snapshot, updated_at=now)
+    cart.snapshot = snapshot
+    cart.updated_at = now
+    return snapshot
+
+
+def get_cart_snapshot(cart):
+    """
+    The cart's snapshot, built first if it is missing
+    """
+    snapshot = cart.snapshot
+    if snapshot:
+        return snapshot
+    return save_cart_snapshot(cart, build_cart_snapshot(cart))
+
+
+@contextmanager
+def editing_cart(cart):
+    """
+    Lock the cart row for a mutation and yield its current snapshot. Item
+    saves and deletes inside the block leave the stored snapshot alone; the
+    caller patches the yielded one and stores it with save_cart_snapshot().
+    """
+    with transaction.atomic():
+        cart.snapshot = Cart.objects.select_for_update().values_list('snapshot', flat=True).get(pk=cart.pk)
+        snapshot = get_cart_snapshot(cart)
+        token = _editing_cart.set(cart.pk)
+        try:
+            yield snapshot
+        finally:
+            _editing_cart.reset(token)
+
+
+def is_editing(cart_id):
+    return _editing_cart.get() == cart_id
+
+
+def put_line(snapshot, item):
+    """
+    Add item's line to the snapshot or replace the existing one
+    """
+    line = line_for_item(item)
+    for index, existing in enumerate(snapshot['items']):
+        if existing['id'] == item.id:
+            snapshot['items'][index] = line
+            return snapshot
+    snapshot['items'].append(line)
+    return snapshot
+
+
+def remove_line(snapshot, item_id):
+    snapshot['items'] = [line for line in snapshot['items'] if line['id'] != item_id]
+    return snapshot
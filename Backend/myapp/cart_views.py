@@ -1,16 +1,20 @@
 import json
 import logging
 import uuid
-from django.db import transaction
+from django.db import connection
 from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
 from .models import Cart, CartItem, Product, ProductVariant
-from .serializers import CartSerializer, CartItemSerializer
-from .inventory_views import validate_inventory as check_inventory
+from .cart_snapshot import (
+    build_cart_snapshot, editing_cart, get_cart_snapshot, put_line, remove_line, save_cart_snapshot
+)
+from .guest_cart import GUEST_CART_COOKIE, GuestCart, guest_carts_enabled
+from .inventory import check_availability
 
 logger = logging.getLogger('myapp')
 
@@ -38,13 +42,352 @@ def get_or_create_cart(request):
     return cart, session_id if created else None
 
 
-@api_view(['GET'])
+def _upsert_cart_lines(target, lines_sql, params):
+    """
+    Upsert the (product_id, variant_id, quantity) rows produced by lines_sql
+    into target against each of the two partial unique constraints, adding
+    quantities on conflict. Variant lines are clamped to the variant's
+    max_purchase_quantity. Returns the number of target lines inserted or
+    updated.
+    """
+    items = CartItem._meta.db_table
+    variants = ProductVariant._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                {lines_sql}
+            ), variant_lines AS (
+                INSERT INTO {items} (cart_id, product_id, variant_id, quantity, created_at, updated_at)
+                SELECT %(target)s, moved.product_id, moved.variant_id,
+                       LEAST(moved.quantity, v.max_purchase_quantity), %(now)s, %(now)s
+                FROM moved JOIN {variants} v ON v.id = moved.variant_id
+                ON CONFLICT (cart_id, variant_id) WHERE variant_id IS NOT NULL DO UPDATE
+                SET quantity = LEAST(
+                        {items}.quantity + EXCLUDED.quantity,
+                        (SELECT max_purchase_quantity FROM {variants} WHERE id = EXCLUDED.variant_id)
+                    ),
+                    updated_at = EXCLUDED.updated_at
+                RETURNING 1
+            ), product_lines AS (
+                INSERT INTO {items} (cart_id, product_id, variant_id, quantity, created_at, updated_at)
+                SELECT %(target)s, moved.product_id, NULL, moved.quantity, %(now)s, %(now)s
+                FROM moved JOIN {Product._meta.db_table} p ON p.id = moved.product_id
+                WHERE moved.variant_id IS NULL
+                ON CONFLICT (cart_id, product_id) WHERE variant_id IS NULL DO UPDATE
+                SET quantity = {items}.quantity + EXCLUDED.quantity,
+                    updated_at = EXCLUDED.updated_at
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM variant_lines) + (SELECT COUNT(*) FROM product_lines)
+            """,
+            {**params, 'target': target.pk, 'now': timezone.now()}
+        )
+        return cursor.fetchone()[0]
+
+
+def merge_cart_items(source, target):
+    """
+    Move every item of source into target with one statement: the items are
+    deleted from source and upserted into target (see _upsert_cart_lines)
+    """
+    return _upsert_cart_lines(
+        target,
+        f"DELETE FROM {CartItem._meta.db_table} WHERE cart_id = %(source)s "
+        f"RETURNING product_id, variant_id, quantity",
+        {'source': source.pk}
+    )
+
+
+def merge_guest_cart(guest, target):
+    """
+    Write a cookie guest cart's lines into target with the same upsert;
+    lines whose product or variant no longer exists are skipped
+    """
+    if not guest.lines:
+        return 0
+    return _upsert_cart_lines(
+        target,
+        "SELECT * FROM unnest(%(products)s::bigint[], %(variants)s::bigint[], %(quantities)s::integer[]) "
+        "AS lines(product_id, variant_id, quantity)",
+        {
+            'products': [line['product'] for line in guest.lines],
+            'variants': [line['variant'] for line in guest.lines],
+            'quantities': [line['quantity'] for line in guest.lines],
+        }
+    )
+
+
+def guest_cart_response(guest):
+    """
+    Render a cookie cart and store it back. A cart that has outgrown the
+    cookie is written to a new session Cart, which takes over from then on.
+    """
+    if guest.fits():
+        return guest.set_cookie(Response(guest.render()))
+    session_id = str(uuid.uuid4())
+    cart = Cart.objects.create(session_id=session_id)
+    with editing_cart(cart):
+        merge_guest_cart(guest, cart)
+        snapshot = save_cart_snapshot(cart, build_cart_snapshot(cart))
+    response = Response(snapshot)
+    response.set_cookie(
+        'cart_session_id', 
+        session_id, 
+        max_age=60*60*24*30,  # 30 days
+        httponly=True,
+        samesite='Lax'
+    )
+    response.delete_cookie(GUEST_CART_COOKIE)
+    return response
+
+
+CART_OPERATIONS = ('add', 'set', 'remove')
+
+
+def parse_cart_operations(operations):
+    """
+    Validate a PATCH body's operations list. Each operation is
+    {'op': 'add' | 'set' | 'remove', 'quantity', and either 'item_id' or
+    'variant_id' / 'product_id'}. Returns (operations, error).
+    """
+    if not isinstance(operations, list) or not operations:
+        return None, "operations must be a non-empty list"
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in CART_OPERATIONS:
+            return None, f"Operation {index}: op must be one of {', '.join(CART_OPERATIONS)}"
+        try:
+            item_id = int(operation['item_id']) if operation.get('item_id') is not None else None
+            variant_id = int(operation['variant_id']) if operation.get('variant_id') is not None else None
+            product_id = int(operation['product_id']) if operation.get('product_id') is not None else None
+            quantity = int(operation.get('quantity', 1 if operation['op'] == 'add' else 0))
+        except (TypeError, ValueError):
+            return None, f"Operation {index}: ids and quantity must be integers"
+        if operation['op'] == 'add' and item_id is None and variant_id is None and product_id is None:
+            return None, f"Operation {index}: product_id or variant_id is required"
+        if operation['op'] != 'add' and item_id is None and variant_id is None and product_id is None:
+            return None, f"Operation {index}: item_id, variant_id or product_id is required"
+        if operation['op'] == 'set' and operation.get('quantity') is None:
+            return None, f"Operation {index}: quantity is required"
+        if operation['op'] == 'add' and quantity < 1:
+            return None, f"Operation {index}: quantity must be at least 1"
+        if quantity < 0:
+            return None, f"Operation {index}: quantity must be positive"
+        parsed.append({
+            'op': operation['op'], 'item_id': item_id, 'variant_id': variant_id,
+            'product_id': product_id, 'quantity': quantity
+        })
+    return parsed, None
+
+
+def unavailable_response(results):
+    """
+    400 response listing the check_availability() results that fail the
+    stock check or the purchase limit, or None when every line passes
+    """
+    shortages = [
+        {
+            'variant_id': result['variant_id'],
+            'requested': result['requested'],
+            'available': result['available'],
+            'max_purchase_quantity': result['max_purchase_quantity'],
+            'problems': result['problems']
+        }
+        for result in results if not result['is_available']
+    ]
+    if not shortages:
+        return None
+    if any('insufficient_stock' in shortage['problems'] for shortage in shortages):
+        message = "Not enough stock available"
+    else:
+        message = "Quantity exceeds the purchase limit"
+    return Response({"error": message, "shortages": shortages}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def patch_cart(request, cart):
+    """
+    Apply a list of add / set / remove operations to the cart in one
+    transaction: the lines are resolved against the locked snapshot, every
+    referenced variant is loaded and checked against stock and its purchase
+    limit in one query, and the changes are written with one bulk delete,
+    update and insert. Returns a Response.
+    """
+    operations, error = parse_cart_operations(request.data.get('operations'))
+    if error:
+        return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+    with editing_cart(cart) as snapshot:
+        # Lines keyed the way the unique constraints key them
+        lines = {}
+        by_item_id = {}
+        for line in snapshot['items']:
+            key = ('variant', line['variant']) if line['variant'] else ('product', line['product'])
+            lines[key] = {'id': line['id'], 'product_id': line['product'], 'variant_id': line['variant'],
+                          'quantity': line['quantity'], 'original': line['quantity']}
+            by_item_id[line['id']] = key
+
+        keys = []
+        for operation in operations:
+            if operation['item_id'] is not None:
+                if operation['item_id'] not in by_item_id:
+                    return Response(
+                        {"error": "Cart item not found", "item_id": operation['item_id']},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                keys.append(by_item_id[operation['item_id']])
+            elif operation['variant_id'] is not None:
+                keys.append(('variant', operation['variant_id']))
+            else:
+                keys.append(('product', operation['product_id']))
+
+        for operation, key in zip(operations, keys):
+            if key not in lines:
+                if key[0] == 'variant':
+                    lines[key] = {'id': None, 'product_id': None, 'variant_id': key[1], 'quantity': 0, 'original': 0}
+                else:
+                    lines[key] = {'id': None, 'product_id': key[1], 'variant_id': None, 'quantity': 0, 'original': 0}
+            if operation['op'] == 'add':
+                lines[key]['quantity'] += operation['quantity']
+            elif operation['op'] == 'set':
+                lines[key]['quantity'] = operation['quantity']
+            else:
+                lines[key]['quantity'] = 0
+
+        # One query loads every referenced variant and checks the final
+        # quantities; only the lines that grew have to pass
+        variants, results = check_availability(
+            (key[1], lines[key]['quantity']) for key in dict.fromkeys(keys) if key[0] == 'variant'
+        )
+        missing = sorted(result['variant_id'] for result in results if 'not_found' in result['problems'])
+        if missing:
+            return Response({"error": "Variant not found", "variant_ids": missing}, status=status.HTTP_404_NOT_FOUND)
+        product_ids = {key[1] for key in keys if key[0] == 'product'}
+        products = Product.objects.in_bulk(product_ids) if product_ids else {}
+        missing = sorted(product_ids - set(products))
+        if missing:
+            return Response({"error": "Product not found", "product_ids": missing}, status=status.HTTP_404_NOT_FOUND)
+        grown = {key[1] for key, line in lines.items() if key[0] == 'variant' and line['quantity'] > line['original']}
+        error = unavailable_response(result for result in results if result['variant_id'] in grown)
+        if error:
+            return error
+
+        now = timezone.now()
+        removed, changed, created = [], [], []
+        for key in dict.fromkeys(keys):
+            line = lines[key]
+            if line['quantity'] == line['original']:
+                continue
+            if line['variant_id']:
+                variant = variants[line['variant_id']]
+                product = variant.product
+            else:
+                variant, product = None, products[line['product_id']]
+            if line['quantity'] == 0:
+                removed.append(line['id'])
+            elif line['id']:
+                changed.append(CartItem(
+                    id=line['id'], cart=cart, product=product, variant=variant,
+                    quantity=line['quantity'], updated_at=now
+                ))
+            else:
+                created.append(CartItem(cart=cart, product=product, variant=variant, quantity=line['quantity']))
+
+        if removed:
+            CartItem.objects.filter(cart=cart, id__in=removed).delete()
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity', 'updated_at'])
+        if created:
+            created = CartItem.objects.bulk_create(created)
+
+        for item_id in removed:
+            remove_line(snapshot, item_id)
+        for item in changed + created:
+            put_line(snapshot, item)
+        snapshot = save_cart_snapshot(cart, snapshot)
+
+    return Response(snapshot)
+
+
+def patch_guest_cart(request, guest):
+    """
+    patch_cart() for a cookie cart: the same operations, with the lines that
+    grow checked in one availability query
+    """
+    operations, error = parse_cart_operations(request.data.get('operations'))
+    if error:
+        return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+    quantities = {}
+    products_of = {}
+    for line in guest.lines:
+        key = ('variant', line['variant']) if line['variant'] else ('product', line['product'])
+        quantities[key] = line['quantity']
+        products_of[key] = line['product']
+    original = dict(quantities)
+
+    for operation in operations:
+        if operation['item_id'] is not None:
+            line = guest.get(operation['item_id'])
+            if line is None:
+                return Response(
+                    {"error": "Cart item not found", "item_id": operation['item_id']},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            key = ('variant', line['variant']) if line['variant'] else ('product', line['product'])
+        elif operation['variant_id'] is not None:
+            key = ('variant', operation['variant_id'])
+        else:
+            key = ('product', operation['product_id'])
+        if operation['op'] == 'add':
+            quantities[key] = quantities.get(key, 0) + operation['quantity']
+        elif operation['op'] == 'set':
+            quantities[key] = operation['quantity']
+        else:
+            quantities[key] = 0
+
+    grown = [key for key, quantity in quantities.items() if quantity > original.get(key, 0)]
+    variants, results = check_availability(
+        (key[1], quantities[key]) for key in grown if key[0] == 'variant'
+    )
+    missing = [result['variant_id'] for result in results if 'not_found' in result['problems']]
+    if missing:
+        return Response({"error": "Variant not found", "variant_ids": missing}, status=status.HTTP_404_NOT_FOUND)
+    error = unavailable_response(results)
+    if error:
+        return error
+    product_ids = {key[1] for key in grown if key[0] == 'product'}
+    missing = []
+    if product_ids:
+        missing = sorted(product_ids - set(Product.objects.filter(id__in=product_ids).values_list('id', flat=True)))
+    if missing:
+        return Response({"error": "Product not found", "product_ids": missing}, status=status.HTTP_404_NOT_FOUND)
+
+    for key, quantity in quantities.items():
+        if quantity == original.get(key, 0):
+            continue
+        if key[0] == 'variant':
+            product_id = products_of.get(key) or variants[key[1]].product_id
+            guest.set_quantity(product_id, key[1], quantity)
+        else:
+            guest.set_quantity(key[1], None, quantity)
+    return guest_cart_response(guest)
+
+
+@api_view(['GET', 'PATCH'])
 @permission_classes([AllowAny])
 def get_cart(request):
     """
-    Get the current user's cart
+    Get the current user's cart, or (PATCH) apply a batch of operations to it
     """
     try:
+        if guest_carts_enabled(request):
+            guest = GuestCart.from_request(request)
+            if request.method == 'PATCH':
+                return patch_guest_cart(request, guest)
+            # Nothing is written, so crawlers and browsing visitors cost no rows
+            return Response(guest.render())
+        
         result = get_or_create_cart(request)
         
         if isinstance(result, tuple):
@@ -53,8 +396,11 @@ def get_cart(request):
             cart = result
             session_id = None
         
-        serializer = CartSerializer(cart)
-        response = Response(serializer.data)
+        if request.method == 'PATCH':
+            response = patch_cart(request, cart)
+        else:
+            # Served from the stored snapshot: no item, product or variant reads
+            response = Response(get_cart_snapshot(cart))
         
         # Set session cookie if needed
         if session_id:
@@ -76,6 +422,34 @@ def get_cart(request):
         )
 
 
+def check_line_quantity(variant_id, quantity):
+    """
+    Check the quantity a cart line would end up with against stock and the
+    purchase limit. Every path that grows a line goes through here. Returns
+    (variant, None), or (None, error response).
+    """
+    variants, results = check_availability([(variant_id, quantity)])
+    result = results[0]
+    if 'not_found' in result['problems']:
+        return None, Response(
+            {"error": "Variant not found"},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    if not result['is_available']:
+        return None, Response(
+            {
+                "error": "Not enough stock available" if 'insufficient_stock' in result['problems']
+                         else "Quantity exceeds the purchase limit",
+                "available": result['available'],
+                "requested": quantity,
+                "max_purchase_quantity": result['max_purchase_quantity'],
+                "problems": result['problems']
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return variants[variant_id], None
+
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def add_to_cart(request):
@@ -84,33 +458,42 @@ def add_to_cart(request):
     """
     try:
         product_id = request.data.get('product_id')
-        variant_id = request.data.get('variant_id')
-        quantity = int(request.data.get('quantity', 1))
+        try:
+            variant_id = int(request.data['variant_id']) if request.data.get('variant_id') else None
+            quantity = int(request.data.get('quantity', 1))
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "variant_id and quantity must be integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
         if not product_id:
             return Response(
                 {"error": "Product ID is required"},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        if quantity < 1:
+            return Response(
+                {"error": "Quantity must be positive"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
         # Get the product
         product = get_object_or_404(Product, id=product_id)
         
-        # Get the variant if specified
-        variant = None
-        if variant_id:
-            variant = get_object_or_404(ProductVariant, id=variant_id)
-            
-            # Check if there's enough stock
-            if variant.available_stock < quantity:
-                return Response(
-                    {
-                        "error": "Not enough stock available",
-                        "available": variant.available_stock,
-                        "requested": quantity
-                    },
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+        if guest_carts_enabled(request):
+            guest = GuestCart.from_request(request)
+            variant = None
+            if variant_id:
+                variant, error = check_line_quantity(variant_id, guest.quantity_of(product.id, variant_id) + quantity)
+                if error:
+                    return error
+            line_product_id = variant.product_id if variant else product.id
+            guest.set_quantity(
+                line_product_id, variant_id,
+                guest.quantity_of(line_product_id, variant_id) + quantity
+            )
+            return guest_cart_response(guest)
         
         # Get or create the cart
         result = get_or_create_cart(request)
@@ -121,35 +504,33 @@ def add_to_cart(request):
             cart = result
             session_id = None
         
-        # Check if the item is already in the cart
-        with transaction.atomic():
-            if variant:
-                cart_item, created = CartItem.objects.get_or_create(
-                    cart=cart,
-                    product=product,
-                    variant=variant,
-                    defaults={'quantity': quantity}
-                )
-                
-                if not created:
-                    # Update quantity if item already exists
-                    cart_item.quantity += quantity
-                    cart_item.save()
-            else:
-                cart_item, created = CartItem.objects.get_or_create(
-                    cart=cart,
-                    product=product,
-                    variant=None,
-                    defaults={'quantity': quantity}
-                )
-                
-                if not created:
-                    # Update quantity if item already exists
-                    cart_item.quantity += quantity
-                    cart_item.save()
+        with editing_cart(cart) as snapshot:
+            variant = None
+            if variant_id:
+                # The locked snapshot says how many are already in the cart
+                in_cart = sum(line['quantity'] for line in snapshot['items'] if line['variant'] == variant_id)
+                variant, error = check_line_quantity(variant_id, in_cart + quantity)
+                if error:
+                    return error
+            
+            # Check if the item is already in the cart
+            cart_item, created = CartItem.objects.get_or_create(
+                cart=cart,
+                product=product,
+                variant=variant,
+                defaults={'quantity': quantity}
+            )
+            
+            if not created:
+                # Update quantity if item already exists
+                cart_item.quantity += quantity
+                cart_item.save()
+            
+            # Already loaded above, so the line is built without queries
+            cart_item.product, cart_item.variant = product, variant
+            snapshot = save_cart_snapshot(cart, put_line(snapshot, cart_item))
         
-        serializer = CartSerializer(cart)
-        response = Response(serializer.data)
+        response = Response(snapshot)
         
         # Set session cookie if needed
         if session_id:
@@ -186,6 +567,21 @@ def update_cart_item(request, item_id):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        if guest_carts_enabled(request):
+            guest = GuestCart.from_request(request)
+            line = guest.get(item_id)
+            if line is None:
+                return Response(
+                    {"error": "Cart item not found"},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            if line['variant'] and quantity > line['quantity']:
+                _, error = check_line_quantity(line['variant'], quantity)
+                if error:
+                    return error
+            guest.set_quantity(line['product'], line['variant'], quantity)
+            return guest_cart_response(guest)
+        
         # Get the cart
         result = get_or_create_cart(request)
         
@@ -197,34 +593,31 @@ def update_cart_item(request, item_id):
         
         # Get the cart item
         try:
-            cart_item = CartItem.objects.get(id=item_id, cart=cart)
+            cart_item = CartItem.objects.select_related('product', 'variant').get(id=item_id, cart=cart)
         except CartItem.DoesNotExist:
             return Response(
                 {"error": "Cart item not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Check stock if there's a variant
-        if cart_item.variant and cart_item.variant.available_stock < quantity:
-            return Response(
-                {
-                    "error": "Not enough stock available",
-                    "available": cart_item.variant.available_stock,
-                    "requested": quantity
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        if quantity == 0:
-            # Remove the item if quantity is 0
-            cart_item.delete()
-        else:
-            # Update the quantity
-            cart_item.quantity = quantity
-            cart_item.save()
+        with editing_cart(cart) as snapshot:
+            # Only a growing line is checked, so a cart over a lowered limit can still shrink
+            if cart_item.variant_id and quantity > cart_item.quantity:
+                _, error = check_line_quantity(cart_item.variant_id, quantity)
+                if error:
+                    return error
+            if quantity == 0:
+                # Remove the item if quantity is 0
+                cart_item.delete()
+                remove_line(snapshot, item_id)
+            else:
+                # Update the quantity
+                cart_item.quantity = quantity
+                cart_item.save()
+                put_line(snapshot, cart_item)
+            snapshot = save_cart_snapshot(cart, snapshot)
         
-        serializer = CartSerializer(cart)
-        response = Response(serializer.data)
+        response = Response(snapshot)
         
         # Set session cookie if needed
         if session_id:
@@ -253,6 +646,17 @@ def remove_from_cart(request, item_id):
     Remove an item from the cart
     """
     try:
+        if guest_carts_enabled(request):
+            guest = GuestCart.from_request(request)
+            line = guest.get(item_id)
+            if line is None:
+                return Response(
+                    {"error": "Cart item not found"},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            guest.set_quantity(line['product'], line['variant'], 0)
+            return guest_cart_response(guest)
+        
         # Get the cart
         result = get_or_create_cart(request)
         
@@ -272,10 +676,11 @@ def remove_from_cart(request, item_id):
             )
         
         # Delete the cart item
-        cart_item.delete()
+        with editing_cart(cart) as snapshot:
+            cart_item.delete()
+            snapshot = save_cart_snapshot(cart, remove_line(snapshot, item_id))
         
-        serializer = CartSerializer(cart)
-        response = Response(serializer.data)
+        response = Response(snapshot)
         
         # Set session cookie if needed
         if session_id:
@@ -305,17 +710,11 @@ def merge_carts(request):
     """
     try:
         session_id = request.COOKIES.get('cart_session_id')
+        guest = GuestCart.from_request(request)
         
-        if not session_id:
-            return Response(
-                {"message": "No anonymous cart to merge"},
-                status=status.HTTP_200_OK
-            )
-        
-        # Get the anonymous cart
-        try:
-            anonymous_cart = Cart.objects.get(session_id=session_id)
-        except Cart.DoesNotExist:
+        # Get the anonymous cart (a session Cart row and/or a cookie cart)
+        anonymous_cart = Cart.objects.filter(session_id=session_id).first() if session_id else None
+        if anonymous_cart is None and not guest.lines:
             return Response(
                 {"message": "No anonymous cart to merge"},
                 status=status.HTTP_200_OK
@@ -325,42 +724,21 @@ def merge_carts(request):
         user_cart, created = Cart.objects.get_or_create(user=request.user)
         
         # Merge the carts
-        with transaction.atomic():
-            for anon_item in anonymous_cart.items.all():
-                # Check if the item is already in the user's cart
-                if anon_item.variant:
-                    user_item, created = CartItem.objects.get_or_create(
-                        cart=user_cart,
-                        product=anon_item.product,
-                        variant=anon_item.variant,
-                        defaults={'quantity': anon_item.quantity}
-                    )
-                    
-                    if not created:
-                        # Update quantity if item already exists
-                        user_item.quantity += anon_item.quantity
-                        user_item.save()
-                else:
-                    user_item, created = CartItem.objects.get_or_create(
-                        cart=user_cart,
-                        product=anon_item.product,
-                        variant=None,
-                        defaults={'quantity': anon_item.quantity}
-                    )
-                    
-                    if not created:
-                        # Update quantity if item already exists
-                        user_item.quantity += anon_item.quantity
-                        user_item.save()
-            
-            # Delete the anonymous cart
-            anonymous_cart.delete()
-        
-        serializer = CartSerializer(user_cart)
-        response = Response(serializer.data)
-        
-        # Clear the session cookie
+        with editing_cart(user_cart):
+            if anonymous_cart is not None:
+                merge_cart_items(anonymous_cart, user_cart)
+                # Delete the anonymous cart (its items were moved)
+                anonymous_cart.delete()
+            # The cookie cart is persisted here, at login, for the first time
+            merge_guest_cart(guest, user_cart)
+            # The merge touched arbitrary lines, so rebuild rather than patch
+            snapshot = save_cart_snapshot(user_cart, build_cart_snapshot(user_cart))
+        
+        response = Response(snapshot)
+        
+        # Clear the anonymous cart cookies
         response.delete_cookie('cart_session_id')
+        response.delete_cookie(GUEST_CART_COOKIE)
         
         return response
     
@@ -379,6 +757,11 @@ def clear_cart(request):
     Clear all items from the cart
     """
     try:
+        if guest_carts_enabled(request):
+            guest = GuestCart.from_request(request)
+            guest.clear()
+            return guest_cart_response(guest)
+        
         # Get the cart
         result = get_or_create_cart(request)
         
@@ -389,10 +772,12 @@ def clear_cart(request):
             session_id = None
         
         # Delete all cart items
-        cart.items.all().delete()
+        with editing_cart(cart) as snapshot:
+            cart.items.all().delete()
+            snapshot['items'] = []
+            snapshot = save_cart_snapshot(cart, snapshot)
         
-        serializer = CartSerializer(cart)
-        response = Response(serializer.data)
+        response = Response(snapshot)
         
         # Set session cookie if needed
         if session_id:
@@ -421,27 +806,35 @@ def validate_cart(request):
     Validate the cart items against current inventory
     """
     try:
-        # Get the cart
-        result = get_or_create_cart(request)
-        
-        if isinstance(result, tuple):
-            cart, session_id = result
-        else:
-            cart = result
+        if guest_carts_enabled(request):
+            cart_lines = GuestCart.from_request(request).render()['items']
             session_id = None
-        
-        # Check each item with a variant
-        invalid_items = []
-        for item in cart.items.all():
-            if item.variant:
-                if item.variant.available_stock < item.quantity:
-                    invalid_items.append({
-                        'id': item.id,
-                        'product_name': item.product.name,
-                        'variant_id': item.variant.id,
-                        'requested': item.quantity,
-                        'available': item.variant.available_stock
-                    })
+        else:
+            # Get the cart
+            result = get_or_create_cart(request)
+            
+            if isinstance(result, tuple):
+                cart, session_id = result
+            else:
+                cart = result
+                session_id = None
+            cart_lines = get_cart_snapshot(cart)['items']
+        
+        # Lines come from the snapshot (or cookie), stock from one bulk availability check
+        lines = {line['variant']: line for line in cart_lines if line['variant']}
+        _, results = check_availability((variant_id, line['quantity']) for variant_id, line in lines.items())
+        invalid_items = [
+            {
+                'id': lines[result['variant_id']]['id'],
+                'product_name': lines[result['variant_id']]['product_name'],
+                'variant_id': result['variant_id'],
+                'requested': result['requested'],
+                'available': result['available'],
+                'max_purchase_quantity': result['max_purchase_quantity'],
+                'problems': result['problems']
+            }
+            for result in results if not result['is_available']
+        ]
         
         response_data = {
             'is_valid': len(invalid_items) == 0,
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('myapp')
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    """
+    Return the current catalog version, initialising it if the cache was flushed
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # add() only succeeds for the first process, everyone else re-reads its value
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Invalidate every cached catalog response by moving to a new version
+    """
+    try:
+        version = cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # Key was evicted; any fresh value works as long as it differs from old entries
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+        version = cache.incr(CATALOG_VERSION_KEY)
+    logger.debug(f"Catalog version bumped to {version}")
+    return version
+
+
+def make_catalog_key(name, params=None, *args):
+    """
+    Build a cache key from the endpoint name, its arguments and query parameters
+    """
+    items = sorted((params or {}).items())
+    raw = json.dumps([name, [str(arg) for arg in args], items], sort_keys=True)
+    digest = hashlib.md5(raw.encode('utf-8')).hexdigest()
+    return f"catalog:{get_catalog_version()}:{name}:{digest}"
+
+
+def get_or_build(name, builder, params=None, *args, timeout=None):
+    """
+    Return the cached response data for a catalog endpoint, building it on a miss.
+    The builder must return JSON-serialisable data (e.g. serializer.data).
+    """
+    key = make_catalog_key(name, params, *args)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    data = builder()
+    if timeout is None:
+        timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+    cache.set(key, data, timeout=timeout)
+    return data
+
+
+def query_params_dict(request):
+    """
+    Flatten the request's query parameters (keeping repeated values) for key building
+    """
+    return {key: request.query_params.getlist(key) for key in request.query_params}
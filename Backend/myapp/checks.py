@@ -0,0 +1,48 @@
+"""
+System checks for settings that are only safe in a single process
+"""
+from django.conf import settings
+from django.core.checks import Error, register
+
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def _single_process_allowed():
+    return settings.DEBUG or getattr(settings, 'TESTING', False)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Catalog and stock versions are bumped by whichever process changed the
+    data (and webhook handler timings are recorded by the workers); a
+    per-process cache would leave every other process serving stale responses
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES and not _single_process_allowed():
+        return [Error(
+            f"The default cache ({backend}) is local to one process.",
+            hint="Set CACHE_BACKEND/CACHE_LOCATION to a shared cache such as Redis.",
+            id='myapp.E001',
+        )]
+    return []
+
+
+@register()
+def check_reservation_engine(app_configs, **kwargs):
+    """
+    The in-process counter store keeps one set of counters per process, so
+    several workers would each sell the same units
+    """
+    engine = getattr(settings, 'RESERVATION_ENGINE', 'db')
+    url = getattr(settings, 'RESERVATION_ENGINE_URL', '')
+    if engine == 'counter' and not url and not _single_process_allowed():
+        return [Error(
+            "RESERVATION_ENGINE = 'counter' without RESERVATION_ENGINE_URL uses a per-process store.",
+            hint="Point RESERVATION_ENGINE_URL at Redis, or use RESERVATION_ENGINE = 'db'.",
+            id='myapp.E002',
+        )]
+    return []
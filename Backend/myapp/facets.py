@@ -0,0 +1,57 @@
+from django.db.models import Count, Q
+
+from .models import Product, ProductVariant
+
+# (label, lower bound inclusive, upper bound exclusive) on Product.base_price
+PRICE_BUCKETS = (
+    ('0-199', None, 200),
+    ('200-499', 200, 500),
+    ('500-999', 500, 1000),
+    ('1000+', 1000, None),
+)
+
+
+def _count_by(queryset, field, count_expr):
+    """
+    GROUP BY a single column and return {value: count}
+    """
+    rows = queryset.order_by().values(field).annotate(count=count_expr)
+    return {row[field]: row['count'] for row in rows if row[field] not in (None, '')}
+
+
+def _price_bucket_filter(low, high):
+    condition = Q()
+    if low is not None:
+        condition &= Q(base_price__gte=low)
+    if high is not None:
+        condition &= Q(base_price__lt=high)
+    return condition
+
+
+def compute_facets(products):
+    """
+    Count the filtered products per brand, category, product type, variant
+    color, variant storage and price bucket. Every facet is one aggregate
+    query over the same filtered id set.
+    """
+    matching_ids = products.order_by().values('pk')
+    base = Product.objects.filter(pk__in=matching_ids)
+    variants = ProductVariant.objects.filter(product__in=matching_ids)
+
+    price_counts = base.aggregate(**{
+        label: Count('pk', filter=_price_bucket_filter(low, high))
+        for label, low, high in PRICE_BUCKETS
+    })
+
+    return {
+        'brand': _count_by(base, 'brand', Count('pk')),
+        'category': _count_by(base, 'category', Count('pk')),
+        'product_type': _count_by(base, 'product_type', Count('pk')),
+        # A product counts once per color/storage even with several matching variants
+        'color': _count_by(variants, 'color', Count('product', distinct=True)),
+        'storage': _count_by(variants, 'storage', Count('product', distinct=True)),
+        'price': [
+            {'range': label, 'min': low, 'max': high, 'count': price_counts[label]}
+            for label, low, high in PRICE_BUCKETS
+        ],
+    }
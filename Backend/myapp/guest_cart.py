@@ -0,0 +1,146 @@
+"""
+Stateless guest carts (GUEST_CART_STORAGE = 'cookie'). An anonymous
+visitor's cart lives in a signed, compressed cookie instead of a Cart row,
+so browsing and crawlers write nothing. The lines are written to the
+database when the visitor logs in (merge_carts) or when the cart outgrows
+GUEST_CART_MAX_LINES, at which point it becomes an ordinary session cart.
+"""
+import logging
+
+from django.conf import settings
+from django.core import signing
+
+from .cart_snapshot import add_totals, line_for_item
+from .models import CartItem, Product, ProductVariant
+
+logger = logging.getLogger('myapp')
+
+GUEST_CART_COOKIE = 'guest_cart'
+GUEST_CART_SALT = 'myapp.guest_cart'
+GUEST_CART_MAX_AGE = 60 * 60 * 24 * 30  # 30 days
+# Keeps the signed cookie well under the browsers' 4KB limit
+GUEST_CART_MAX_LINES = 30
+
+
+def guest_carts_enabled(request):
+    """
+    True when this request's cart should be a cookie cart: anonymous, cookie
+    mode on, and no database session cart already in use
+    """
+    return (
+        getattr(settings, 'GUEST_CART_STORAGE', 'db') == 'cookie'
+        and not request.user.is_authenticated
+        and not request.COOKIES.get('cart_session_id')
+    )
+
+
+class GuestCart:
+    """
+    Lines are {'id', 'product', 'variant', 'quantity'}; ids are assigned
+    from a counter kept in the cookie so they stay stable between requests
+    """
+    def __init__(self, lines=None, next_id=1):
+        self.lines = lines or []
+        self.next_id = next_id
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.COOKIES.get(GUEST_CART_COOKIE)
+        if not value:
+            return cls()
+        try:
+            data = signing.loads(value, salt=GUEST_CART_SALT, max_age=GUEST_CART_MAX_AGE)
+            lines = [
+                {'id': item_id, 'product': product_id, 'variant': variant_id, 'quantity': quantity}
+                for item_id, product_id, variant_id, quantity in data['l']
+            ]
+            return cls(lines, data['n'])
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            # Tampered with, expired or unreadable: start a new cart
+            logger.info("Discarding unreadable guest cart cookie")
+            return cls()
+
+    def get(self, item_id):
+        for line in self.lines:
+            if line['id'] == item_id:
+                return line
+        return None
+
+    def find(self, product_id, variant_id):
+        # Same keys as CartItem's unique constraints
+        for line in self.lines:
+            if variant_id and line['variant'] == variant_id:
+                return line
+            if not variant_id and not line['variant'] and line['product'] == product_id:
+                return line
+        return None
+
+    def quantity_of(self, product_id, variant_id):
+        line = self.find(product_id, variant_id)
+        return line['quantity'] if line else 0
+
+    def set_quantity(self, product_id, variant_id, quantity):
+        """
+        Set a line's quantity, adding the line or dropping it (quantity 0)
+        """
+        line = self.find(product_id, variant_id)
+        if line is None:
+            if quantity > 0:
+                self.lines.append({'id': self.next_id, 'product': product_id, 'variant': variant_id, 'quantity': quantity})
+                self.next_id += 1
+        elif quantity > 0:
+            line['quantity'] = quantity
+        else:
+            self.lines.remove(line)
+
+    def clear(self):
+        self.lines = []
+
+    def fits(self):
+        return len(self.lines) <= GUEST_CART_MAX_LINES
+
+    def render(self):
+        """
+        The cart in the same shape as a stored cart snapshot. Reads the
+        variants (with products) and any variant-less products in at most
+        two queries; lines whose product or variant is gone are dropped.
+        """
+        variant_ids = [line['variant'] for line in self.lines if line['variant']]
+        product_ids = [line['product'] for line in self.lines if not line['variant']]
+        variants = ProductVariant.objects.select_related('product').in_bulk(variant_ids) if variant_ids else {}
+        products = Product.objects.in_bulk(product_ids) if product_ids else {}
+
+        self.lines = [
+            line for line in self.lines
+            if (variants.get(line['variant']) if line['variant'] else products.get(line['product']))
+        ]
+        items = []
+        for line in self.lines:
+            variant = variants.get(line['variant'])
+            product = variant.product if variant else products[line['product']]
+            items.append(line_for_item(CartItem(
+                id=line['id'], product=product, variant=variant, quantity=line['quantity']
+            )))
+        return add_totals({'id': None, 'items': items, 'created_at': None, 'updated_at': None})
+
+    def set_cookie(self, response):
+        """
+        Store the cart in the response's cookie (or delete the cookie when empty)
+        """
+        if not self.lines:
+            response.delete_cookie(GUEST_CART_COOKIE)
+            return response
+        value = signing.dumps(
+            {'n': self.next_id, 'l': [
+                [line['id'], line['product'], line['variant'], line['quantity']] for line in self.lines
+            ]},
+            salt=GUEST_CART_SALT, compress=True
+        )
+        response.set_cookie(
+            GUEST_CART_COOKIE,
+            value,
+            max_age=GUEST_CART_MAX_AGE,
+            httponly=True,
+            samesite='Lax'
+        )
+        return response
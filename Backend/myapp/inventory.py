@@ -0,0 +1,587 @@
+"""
+Inventory service. Every stock movement is one guarded UPDATE with F()
+expressions (e.g. reserved_stock = reserved_stock + n WHERE
+count_in_stock - reserved_stock >= n), judged by its affected row count and
+paired with an InventoryChange ledger row in the same transaction. The
+variant CHECK constraints back the guards up: available_stock can never go
+negative.
+"""
+import logging
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import ProductVariant, InventoryChange, InventoryReservation
+from .stock_stream import notify_stock_changes
+from .stock_versions import bump_stock_versions
+
+logger = logging.getLogger('myapp')
+
+# How long a checkout may hold stock before the expiry sweep releases it
+RESERVATION_TTL = timedelta(minutes=3)
+
+
+def reservation_engine_enabled():
+    """
+    True when reservations go through the in-memory counter engine
+    (reservation_engine.py) instead of locking variant rows
+    """
+    return getattr(settings, 'RESERVATION_ENGINE', 'db') == 'counter'
+
+
+class StockCommitError(Exception):
+    """
+    A paid session's reserved units could not be turned into sold units
+    """
+
+
+def _check_quantity(quantity):
+    """
+    Stock moves are always a positive number of units; the sign comes from
+    the operation, so a negative quantity would silently run it backwards
+    """
+    if quantity <= 0:
+        raise ValueError(f"Quantity must be positive, got {quantity}")
+
+
+def _record_change(variant_id, quantity, reserved_quantity, reason, reference_id=None, notes=None, user=None):
+    """
+    Append a ledger row. quantity is the change to count_in_stock and
+    reserved_quantity the change to reserved_stock.
+    """
+    InventoryChange.objects.create(
+        variant_id=variant_id,
+        quantity=quantity,
+        reserved_quantity=reserved_quantity,
+        reason=reason,
+        reference_id=reference_id,
+        notes=notes,
+        created_by=user if user is not None and user.is_authenticated else None
+    )
+
+
+def _stock_changed(variant_ids, sync_engine=True):
+    """
+    Tell pollers, stream listeners and (when enabled) the reservation counter
+    engine about new counts. All of it happens only once the surrounding
+    transaction commits, so nobody sees a new version or notification paired
+    with old counts.
+    """
+    variant_ids = list(variant_ids)
+    notify_stock_changes(variant_ids)
+    transaction.on_commit(lambda: bump_stock_versions(variant_ids))
+    if sync_engine and reservation_engine_enabled():
+        from .reservation_engine import sync_counters
+        transaction.on_commit(lambda: sync_counters(variant_ids))
+
+
+def reserve_stock(variant_id, quantity, reference_id=None, notes=None):
+    """
+    Move quantity units from available to reserved if that many are available.
+    Returns True on success, False if the variant is missing or short.
+    """
+    _check_quantity(quantity)
+    with transaction.atomic():
+        updated = ProductVariant.objects.filter(
+            pk=variant_id,
+            count_in_stock__gte=F('reserved_stock') + quantity
+        ).update(reserved_stock=F('reserved_stock') + quantity, updatedAt=timezone.now())
+        if updated:
+            _record_change(variant_id, 0, quantity, 'reservation', reference_id, notes)
+            _stock_changed([variant_id])
+    return bool(updated)
+
+
+def _write_reservations(rows, sync_engine=True):
+    """
+    Write reservations whose availability was already checked: one CASE
+    UPDATE of reserved_stock per batch plus bulk inserts of the reservation
+    and ledger rows. rows are (session_id, variant_id, quantity, expires_at,
+    notes); the caller holds the variant row locks (or relies on the CHECK
+    constraint) inside its transaction.
+    """
+    totals = defaultdict(int)
+    for _, variant_id, quantity, _, _ in rows:
+        totals[variant_id] += quantity
+    ids = sorted(totals)
+    ProductVariant.objects.filter(id__in=ids).update(
+        reserved_stock=F('reserved_stock') + Case(
+            *[When(id=variant_id, then=Value(totals[variant_id])) for variant_id in ids],
+            default=Value(0), output_field=IntegerField()
+        ),
+        updatedAt=timezone.now()
+    )
+    reservations = InventoryReservation.objects.bulk_create([
+        InventoryReservation(
+            variant_id=variant_id, quantity=quantity,
+            session_id=session_id, expires_at=expires_at
+        )
+        for session_id, variant_id, quantity, expires_at, _ in rows
+    ])
+    InventoryChange.objects.bulk_create([
+        InventoryChange(
+            variant_id=variant_id, quantity=0, reserved_quantity=quantity,
+            reason='reservation', reference_id=session_id, notes=notes
+        )
+        for session_id, variant_id, quantity, _, notes in rows
+    ])
+    _stock_changed(ids, sync_engine=sync_engine)
+    return reservations
+
+
+def check_availability(items):
+    """
+    Check (variant_id, quantity) pairs against the stored available_stock in
+    one query; quantities for the same variant are added together. Returns
+    (variants, results): variants maps id -> ProductVariant (product
+    selected) for the ids that exist, results has one entry per variant in
+    request order: {'variant_id', 'requested', 'available',
+    'max_purchase_quantity', 'is_available', 'problems'}, where problems
+    lists any of 'not_found', 'insufficient_stock' and 'over_purchase_limit'.
+    """
+    quantities = {}
+    for variant_id, quantity in items:
+        quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+    variants = ProductVariant.objects.select_related('product').in_bulk(list(quantities))
+
+    results = []
+    for variant_id, quantity in quantities.items():
+        variant = variants.get(variant_id)
+        problems = []
+        if variant is None:
+            problems.append('not_found')
+        else:
+            if variant.available_stock < quantity:
+                problems.append('insufficient_stock')
+            if quantity > variant.max_purchase_quantity:
+                problems.append('over_purchase_limit')
+        results.append({
+            'variant_id': variant_id,
+            'requested': quantity,
+            'available': variant.available_stock if variant else None,
+            'max_purchase_quantity': variant.max_purchase_quantity if variant else None,
+            'is_available': not problems,
+            'problems': problems,
+        })
+    return variants, results
+
+
+def reserve_items(quantities, session_id, expires_at, notes=None):
+    """
+    Reserve several variants for one session, all or nothing.
+    quantities maps variant_id -> quantity. The variants are locked with one
+    SELECT ... FOR UPDATE ordered by id (so concurrent checkouts can't
+    deadlock), then a single CASE UPDATE bumps reserved_stock and the
+    reservation and ledger rows are bulk inserted. With
+    RESERVATION_ENGINE = 'counter' the hold is taken in the counter store
+    instead and written behind (the returned reservations are unsaved).
+    Returns (reservations, shortages); on any shortage nothing is written and
+    shortages lists {'variant_id', 'requested', 'available'} (available is
+    None for unknown variants). Raises ValueError for a quantity below 1.
+    """
+    for quantity in quantities.values():
+        _check_quantity(quantity)
+    if reservation_engine_enabled():
+        from .reservation_engine import reserve
+        return reserve(quantities, session_id, expires_at, notes)
+    return reserve_items_locked(quantities, session_id, expires_at, notes)
+
+
+def reserve_items_locked(quantities, session_id, expires_at, notes=None, sync_engine=True):
+    """
+    The row-locking implementation of reserve_items()
+    """
+    for quantity in quantities.values():
+        _check_quantity(quantity)
+    ids = sorted(quantities)
+    with transaction.atomic():
+        locked = {
+            row['id']: row for row in
+            ProductVariant.objects.select_for_update().filter(id__in=ids).order_by('id')
+            .values('id', 'count_in_stock', 'reserved_stock')
+        }
+        shortages = []
+        for variant_id in ids:
+            row = locked.get(variant_id)
+            available = row['count_in_stock'] - row['reserved_stock'] if row else None
+            if available is None or available < quantities[variant_id]:
+                shortages.append({
+                    'variant_id': variant_id,
+                    'requested': quantities[variant_id],
+                    'available': max(0, available) if available is not None else None
+                })
+        if shortages:
+            return [], shortages
+
+        reservations = _write_reservations(
+            [(session_id, variant_id, quantities[variant_id], expires_at, notes) for variant_id in ids],
+            sync_engine=sync_engine
+        )
+    return reservations, []
+
+
+def new_reservation_token():
+    """
+    Provisional session id for stock reserved before the Stripe session exists
+    """
+    return f"pending_{uuid.uuid4().hex}"
+
+
+def bind_reservations(token, session_id):
+    """
+    Re-key a provisional hold to the real checkout session id. The ledger is
+    append-only, so its reservation rows stay under the token and one
+    zero-quantity 'reservation' row per variant links them to the session.
+    Returns the number of reservations bound; 0 means the hold expired (or
+    was released) in the meantime.
+    """
+    if reservation_engine_enabled():
+        from .reservation_engine import bind
+        if bind(token, session_id):
+            # Still buffered; it will be written under the session id
+            return 1
+    with transaction.atomic():
+        # The lock keeps the expiry sweep (which skips locked rows) off the hold
+        reservations = list(
+            InventoryReservation.objects.select_for_update()
+            .filter(session_id=token, is_active=True, expires_at__gt=timezone.now())
+        )
+        if not reservations:
+            return 0
+        InventoryReservation.objects.filter(id__in=[r.id for r in reservations]).update(session_id=session_id)
+        InventoryChange.objects.bulk_create([
+            InventoryChange(
+                variant_id=variant_id, quantity=0, reserved_quantity=0, reason='reservation',
+                reference_id=session_id, notes=f"Bound hold {token}"
+            )
+            for variant_id in sorted({r.variant_id for r in reservations})
+        ])
+    return len(reservations)
+
+
+def release_stock(variant_id, quantity, reference_id=None, notes=None):
+    """
+    Give reserved units back to available stock (never below zero reserved)
+    """
+    _check_quantity(quantity)
+    with transaction.atomic():
+        updated = ProductVariant.objects.filter(pk=variant_id).update(
+            reserved_stock=Greatest(F('reserved_stock') - quantity, Value(0)),
+            updatedAt=timezone.now()
+        )
+        if updated:
+            _record_change(variant_id, 0, -quantity, 'release', reference_id, notes)
+            _stock_changed([variant_id])
+    return bool(updated)
+
+
+def commit_stock(variant_id, quantity, reference_id=None, notes=None):
+    """
+    Turn reserved units into a sale: both count_in_stock and reserved_stock drop
+    """
+    _check_quantity(quantity)
+    with transaction.atomic():
+        updated = ProductVariant.objects.filter(
+            pk=variant_id,
+            count_in_stock__gte=quantity
+        ).update(
+            count_in_stock=F('count_in_stock') - quantity,
+            reserved_stock=Greatest(F('reserved_stock') - quantity, Value(0)),
+            updatedAt=timezone.now()
+        )
+        if updated:
+            _record_change(variant_id, -quantity, -quantity, 'purchase', reference_id, notes)
+            _stock_changed([variant_id])
+    return bool(updated)
+
+
+def deduct_stock(variant_id, quantity, reference_id=None, notes=None):
+    """
+    Sell units that were never reserved; only succeeds if that many are
+    available (units held for other checkouts can't be sold twice)
+    """
+    _check_quantity(quantity)
+    with transaction.atomic():
+        updated = ProductVariant.objects.filter(
+            pk=variant_id,
+            available_stock__gte=quantity
+        ).update(count_in_stock=F('count_in_stock') - quantity, updatedAt=timezone.now())
+        if updated:
+            _record_change(variant_id, -quantity, 0, 'purchase', reference_id, notes)
+            _stock_changed([variant_id])
+    return bool(updated)
+
+
+def set_stock(variant_id, count_in_stock, reason='adjustment', user=None, notes=None):
+    """
+    Set the absolute on-hand count (admin edits, stock takes). Returns the
+    updated variant, or None if it doesn't exist. Raises ValueError if the
+    count would drop below the units reserved for open checkouts.
+    """
+    with transaction.atomic():
+        row = (
+            ProductVariant.objects.select_for_update()
+            .filter(pk=variant_id)
+            .values_list('count_in_stock', 'reserved_stock')
+            .first()
+        )
+        if row is None:
+            return None
+        previous, reserved = row
+        if count_in_stock < reserved:
+            raise ValueError(f"{reserved} units are reserved; stock can't be set to {count_in_stock}")
+        ProductVariant.objects.filter(pk=variant_id).update(
+            count_in_stock=count_in_stock, updatedAt=timezone.now()
+        )
+        _record_change(variant_id, count_in_stock - previous, 0, reason, notes=notes, user=user)
+        _stock_changed([variant_id])
+    return ProductVariant.objects.get(pk=variant_id)
+
+
+def _merge_stock_updates(updates):
+    """
+    Collapse rows for the same SKU, in order: an absolute count replaces what
+    came before it, deltas add up. Returns {sku: (delta, count or None)} and
+    the input rows of each SKU.
+    """
+    merged = {}
+    rows = defaultdict(list)
+    for update in updates:
+        sku = update['sku']
+        delta, count = merged.get(sku, (0, None))
+        if update.get('count') is not None:
+            delta, count = 0, update['count']
+        elif count is not None:
+            count += update['delta']
+        else:
+            delta += update['delta']
+        merged[sku] = (delta, count)
+        rows[sku].append(update.get('row'))
+    return merged, rows
+
+
+def _apply_stock_chunk(merged, reason, notes, user_id, now):
+    """
+    Apply one chunk in a single statement: lock the matching variants in id
+    order, set their new counts (skipping any that would drop below the
+    reserved units) and append a ledger row for each real change.
+    Returns [(sku, variant_id, new_count, reserved_stock, applied)].
+    """
+    variant_table = ProductVariant._meta.db_table
+    change_table = InventoryChange._meta.db_table
+    values = ', '.join(['(%s, %s::integer, %s::integer)'] * len(merged))
+    params = [value for sku, (delta, count) in merged.items() for value in (sku, delta, count)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH input (sku, delta, count) AS (VALUES {values}),
+            target AS (
+                SELECT v.id, input.sku, v.count_in_stock AS previous, v.reserved_stock,
+                       COALESCE(input.count, v.count_in_stock + input.delta) AS new_count
+                FROM {variant_table} v JOIN input ON input.sku = v.sku
+                ORDER BY v.id
+                FOR UPDATE OF v
+            ),
+            updated AS (
+                UPDATE {variant_table} v
+                SET count_in_stock = target.new_count, "updatedAt" = %s
+                FROM target
+                WHERE v.id = target.id AND target.new_count >= target.reserved_stock
+                RETURNING v.id, target.previous, target.new_count
+            ),
+            ledger AS (
+                INSERT INTO {change_table} (variant_id, quantity, reserved_quantity, reason, notes, created_by_id, created_at)
+                SELECT id, new_count - previous, 0, %s, %s, %s, %s
+                FROM updated WHERE new_count <> previous
+            )
+            SELECT target.sku, target.id, target.new_count, target.reserved_stock, updated.id IS NOT NULL
+            FROM target LEFT JOIN updated ON updated.id = target.id
+            """,
+            params + [now, reason, notes, user_id, now]
+        )
+        return cursor.fetchall()
+
+
+def apply_stock_updates(updates, reason='restock', user=None, notes=None, chunk_size=1000):
+    """
+    Bulk restock. updates is a sequence of {'sku', 'delta'} or {'sku', 'count'}
+    dicts (optionally with the input 'row' number for error reporting).
+    Each chunk is one transaction and one UPDATE ... FROM (VALUES ...)
+    statement. Returns (applied, errors) where errors lists
+    {'row', 'sku', 'error'} for unknown SKUs and counts below the reserved
+    units; those rows are skipped, everything else is applied.
+    """
+    merged, rows = _merge_stock_updates(updates)
+    user_id = user.id if user is not None and user.is_authenticated else None
+    skus = list(merged)
+    applied = 0
+    errors = []
+    for start in range(0, len(skus), chunk_size):
+        chunk = {sku: merged[sku] for sku in skus[start:start + chunk_size]}
+        with transaction.atomic():
+            results = _apply_stock_chunk(chunk, reason, notes, user_id, timezone.now())
+            _stock_changed(variant_id for _, variant_id, _, _, done in results if done)
+
+        found = set()
+        for sku, variant_id, new_count, reserved, done in results:
+            found.add(sku)
+            if done:
+                applied += 1
+            else:
+                errors.append({
+                    'row': rows[sku][-1], 'sku': sku,
+                    'error': f"New count {new_count} is below the {reserved} reserved units"
+                })
+        errors.extend(
+            {'row': rows[sku][-1], 'sku': sku, 'error': 'Unknown SKU'}
+            for sku in chunk if sku not in found
+        )
+    return applied, errors
+
+
+def _close_reservations(reservations, **fields):
+    """
+    Deactivate reservation rows in one UPDATE and return {variant_id: quantity}
+    """
+    InventoryReservation.objects.filter(id__in=[r.id for r in reservations]).update(is_active=False, **fields)
+    quantities = defaultdict(int)
+    for reservation in reservations:
+        quantities[reservation.variant_id] += reservation.quantity
+    # Lock order by variant id so concurrent sweeps can't deadlock
+    return dict(sorted(quantities.items()))
+
+
+def release_reservations(reservations, reference_id=None, notes=None):
+    """
+    Cancel the given active reservations and release their stock
+    """
+    with transaction.atomic():
+        quantities = _close_reservations(reservations, canceled_at=timezone.now())
+        for variant_id, quantity in quantities.items():
+            release_stock(variant_id, quantity, reference_id, notes)
+    return reservations
+
+
+def release_session_reservations(session_id, notes=None):
+    """
+    Cancel every active reservation held by a checkout session. The row lock
+    makes a concurrent second release see nothing left to release.
+    """
+    if reservation_engine_enabled():
+        from .reservation_engine import discard
+        discarded = discard(session_id)
+        if discarded:
+            # The hold was never written; dropping it from the buffer released it
+            return discarded
+    with transaction.atomic():
+        reservations = list(
+            InventoryReservation.objects.select_for_update()
+            .filter(session_id=session_id, is_active=True)
+        )
+        if reservations:
+            release_reservations(reservations, reference_id=session_id, notes=notes)
+    return reservations
+
+
+def commit_session_reservations(session_id, order_id=None, notes=None):
+    """
+    Fulfil every active reservation of a paid checkout session: the reserved
+    units become sold units. Returns the reservations that were committed.
+    Raises StockCommitError (and writes nothing) if any variant can't be
+    committed, so the reservations stay active for a retry.
+    """
+    with transaction.atomic():
+        reservations = list(
+            InventoryReservation.objects.select_for_update()
+            .filter(session_id=session_id, is_active=True)
+        )
+        if not reservations:
+            return reservations
+        fields = {'fulfilled_at': timezone.now()}
+        if order_id:
+            fields['order_id'] = order_id
+        quantities = _close_reservations(reservations, **fields)
+        for variant_id, quantity in quantities.items():
+            if not commit_stock(variant_id, quantity, session_id, notes):
+                raise StockCommitError(
+                    f"Could not commit {quantity} units of variant {variant_id} for session {session_id}"
+                )
+    return reservations
+
+
+def _expire_batch(now, batch_size):
+    """
+    Expire one batch in a single statement: claim due reservations (skipping
+    rows another sweeper holds), deactivate them, subtract the per-variant
+    totals from reserved_stock (locking variants in id order) and append one
+    ledger row per variant. Returns [(variant_id, quantity, reservations)].
+    """
+    reservation_table = InventoryReservation._meta.db_table
+    variant_table = ProductVariant._meta.db_table
+    change_table = InventoryChange._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH expired AS (
+                SELECT id FROM {reservation_table}
+                WHERE is_active AND expires_at <= %s
+                ORDER BY expires_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ),
+            closed AS (
+                UPDATE {reservation_table} r
+                SET is_active = FALSE, canceled_at = %s
+                FROM expired WHERE r.id = expired.id
+                RETURNING r.variant_id, r.quantity
+            ),
+            totals AS (
+                SELECT variant_id, SUM(quantity) AS quantity, COUNT(*) AS reservations
+                FROM closed GROUP BY variant_id
+            ),
+            locked AS (
+                SELECT v.id FROM {variant_table} v
+                WHERE v.id IN (SELECT variant_id FROM totals)
+                ORDER BY v.id
+                FOR UPDATE
+            ),
+            released AS (
+                UPDATE {variant_table} v
+                SET reserved_stock = GREATEST(v.reserved_stock - totals.quantity, 0), "updatedAt" = %s
+                FROM totals JOIN locked ON locked.id = totals.variant_id
+                WHERE v.id = totals.variant_id
+                RETURNING v.id, totals.quantity
+            ),
+            ledger AS (
+                INSERT INTO {change_table} (variant_id, quantity, reserved_quantity, reason, notes, created_at)
+                SELECT id, 0, -quantity, 'release', 'Reservation expired', %s FROM released
+            )
+            SELECT variant_id, quantity, reservations FROM totals
+            """,
+            [now, batch_size, now, now, now]
+        )
+        return cursor.fetchall()
+
+
+def expire_reservations(now=None, batch_size=5000):
+    """
+    Release every reservation that expired before `now`, a batch per short
+    transaction, so a sweep of 100k rows never holds locks for long.
+    Returns the number of reservations expired.
+    """
+    now = now or timezone.now()
+    expired = 0
+    while True:
+        with transaction.atomic():
+            rows = _expire_batch(now, batch_size)
+            _stock_changed(variant_id for variant_id, _, _ in rows)
+        count = sum(reservations for _, _, reservations in rows)
+        expired += count
+        if count < batch_size:
+            return expired
@@ -2,10 +2,23 @@ from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from .models import ProductVariant, InventoryReservation
+from .inventory import (
+    RESERVATION_TTL, reserve_items, set_stock, apply_stock_updates, expire_reservations,
+    release_session_reservations, commit_session_reservations, check_availability, StockCommitError
+)
 import logging
+import asyncio
+import json
+from django.http import Http404, StreamingHttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from .stock_import import parse_stock_rows, parse_stock_records
+from .stock_stream import broadcaster
+from .stock_versions import get_stock_versions, stock_etag, STOCK_MAX_AGE, STOCK_STALE_WHILE_REVALIDATE
 
 logger = logging.getLogger('myapp')
 
@@ -13,32 +26,52 @@ logger = logging.getLogger('myapp')
 @permission_classes([AllowAny])
 def get_variant_stock(request, variant_id=None):
     """
-    Get stock information for a specific variant or filtered variants
+    Get stock information for a specific variant or filtered variants.
+    Responses carry an ETag built from the variants' stock versions, so polls
+    with a matching If-None-Match get a 304 without touching the database.
     """
     try:
         if variant_id:
+            ids = [variant_id]
+        else:
+            # Handle filtering by query params
+            variant_ids = request.query_params.get('ids')
+            if not variant_ids:
+                return Response({"error": "No variant ID provided"}, status=status.HTTP_400_BAD_REQUEST)
+            ids = [int(id) for id in variant_ids.split(',')]
+        
+        # Read the versions before the rows: a change in between only makes the ETag older
+        etag = stock_etag(get_stock_versions(ids))
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and etag in parse_etags(if_none_match):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif variant_id:
             variant = get_object_or_404(ProductVariant, id=variant_id)
-            return Response({
+            response = Response({
                 'id': variant.id,
                 'stock': variant.count_in_stock,
                 'reserved': variant.reserved_stock,
                 'available': variant.available_stock
             })
         else:
-            # Handle filtering by query params
-            variant_ids = request.query_params.get('ids')
-            if variant_ids:
-                ids = [int(id) for id in variant_ids.split(',')]
-                variants = ProductVariant.objects.filter(id__in=ids)
-                result = {}
-                for variant in variants:
-                    result[variant.id] = {
-                        'stock': variant.count_in_stock,
-                        'reserved': variant.reserved_stock,
-                        'available': variant.available_stock
-                    }
-                return Response(result)
-            return Response({"error": "No variant ID provided"}, status=status.HTTP_400_BAD_REQUEST)
+            variants = ProductVariant.objects.filter(id__in=ids)
+            result = {}
+            for variant in variants:
+                result[variant.id] = {
+                    'stock': variant.count_in_stock,
+                    'reserved': variant.reserved_stock,
+                    'available': variant.available_stock
+                }
+            response = Response(result)
+        
+        response['ETag'] = etag
+        patch_cache_control(
+            response, public=True, max_age=STOCK_MAX_AGE,
+            stale_while_revalidate=STOCK_STALE_WHILE_REVALIDATE
+        )
+        return response
+    except Http404:
+        raise
     except Exception as e:
         logger.error(f"Error getting variant stock: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -55,9 +88,12 @@ def update_variant_stock(request):
         if not variant_id or quantity is None:
             return Response({"error": "variant_id and quantity are required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        variant = get_object_or_404(ProductVariant, id=variant_id)
-        variant.count_in_stock = quantity
-        variant.save()
+        try:
+            variant = set_stock(variant_id, int(quantity), user=request.user)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if variant is None:
+            return Response({"error": "Variant not found"}, status=status.HTTP_404_NOT_FOUND)
         
         return Response({
             'id': variant.id,
@@ -69,6 +105,47 @@ def update_variant_stock(request):
         logger.error(f"Error updating variant stock: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Ledger reasons a bulk update may be filed under
+BULK_STOCK_REASONS = ('restock', 'adjustment', 'return')
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def bulk_update_stock(request):
+    """
+    Apply a warehouse feed of (sku, delta or count) rows in chunked bulk
+    statements. Accepts JSON ({"updates": [...]} or a list), JSON lines or
+    CSV (Content-Type: text/csv). Bad rows are reported and skipped.
+    """
+    try:
+        reason = request.query_params.get('reason', 'restock')
+        if reason not in BULK_STOCK_REASONS:
+            return Response({"error": f"reason must be one of {', '.join(BULK_STOCK_REASONS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        content_type = (request.content_type or '').split(';')[0].strip()
+        try:
+            if content_type == 'application/json':
+                records = request.data.get('updates', []) if isinstance(request.data, dict) else request.data
+                updates, errors = parse_stock_records(records)
+            else:
+                fmt = 'csv' if content_type == 'text/csv' else 'json'
+                updates, errors = parse_stock_rows(request.body.decode('utf-8'), fmt)
+        except ValueError as e:
+            return Response({"error": f"Could not parse updates: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        received = len(updates) + len(errors)
+        applied, apply_errors = apply_stock_updates(
+            updates, reason=reason, user=request.user, notes=request.query_params.get('notes')
+        )
+        errors = sorted(errors + apply_errors, key=lambda error: error['row'] or 0)
+        return Response({
+            'received': received,
+            'applied': applied,
+            'errors': errors
+        })
+    except Exception as e:
+        logger.error(f"Error applying bulk stock update: {str(e)}")
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 @api_view(['POST'])
 def reserve_inventory(request):
     """
@@ -81,42 +158,39 @@ def reserve_inventory(request):
         if not session_id or not items:
             return Response({"error": "session_id and items are required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Delete any existing reservations for this session
-        InventoryReservation.objects.filter(session_id=session_id).delete()
-        
-        results = []
+        quantities = {}
         for item in items:
-            variant_id = item.get('variant_id')
-            quantity = item.get('quantity', 1)
-            
-            variant = get_object_or_404(ProductVariant, id=variant_id)
-            
-            # Check if enough stock is available
-            if variant.available_stock < quantity:
-                # Rollback any reservations made so far
-                InventoryReservation.objects.filter(session_id=session_id).delete()
-                return Response({
-                    "error": f"Not enough stock for variant {variant_id}",
-                    "available": variant.available_stock,
-                    "requested": quantity
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Create reservation
-            reservation = InventoryReservation.objects.create(
-                variant=variant,
-                session_id=session_id,
-                quantity=quantity
-            )
-            
-            # Update variant reserved count
-            variant.reserved_stock += quantity
-            variant.save()
-            
-            results.append({
-                'variant_id': variant_id,
-                'quantity': quantity,
-                'reservation_id': reservation.id
-            })
+            try:
+                variant_id = int(item['variant_id'])
+                quantity = int(item.get('quantity', 1))
+            except (KeyError, TypeError, ValueError):
+                return Response({"error": "Each item needs an integer variant_id and quantity"}, status=status.HTTP_400_BAD_REQUEST)
+            if quantity <= 0:
+                return Response({"error": f"Quantity for variant {variant_id} must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+            quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+        
+        # Release anything this session already holds before reserving again
+        release_session_reservations(session_id)
+        
+        # All-or-nothing: one locking SELECT ordered by id, one UPDATE, bulk inserts
+        reservations, shortages = reserve_items(
+            quantities, session_id, timezone.now() + RESERVATION_TTL
+        )
+        if shortages:
+            shortage = shortages[0]
+            if shortage['available'] is None:
+                return Response({"error": f"Variant {shortage['variant_id']} not found"}, status=status.HTTP_404_NOT_FOUND)
+            return Response({
+                "error": f"Not enough stock for variant {shortage['variant_id']}",
+                "available": shortage['available'],
+                "requested": shortage['requested']
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        results = [{
+            'variant_id': reservation.variant_id,
+            'quantity': reservation.quantity,
+            'reservation_id': reservation.id
+        } for reservation in reservations]
         
         return Response({
             'session_id': session_id,
@@ -137,22 +211,12 @@ def release_reservation(request):
         if not session_id:
             return Response({"error": "session_id is required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Get all reservations for this session
-        reservations = InventoryReservation.objects.filter(session_id=session_id)
+        # Cancel the session's active reservations and release their stock
+        count = len(release_session_reservations(session_id))
         
-        if not reservations.exists():
+        if not count:
             return Response({"message": "No reservations found for this session"})
         
-        # Release each reservation
-        for reservation in reservations:
-            variant = reservation.variant
-            variant.reserved_stock -= reservation.quantity
-            variant.save()
-        
-        # Delete the reservations
-        count = reservations.count()
-        reservations.delete()
-        
         return Response({
             "message": f"Released {count} reservations for session {session_id}"
         })
@@ -171,23 +235,15 @@ def commit_reservation(request):
         if not session_id:
             return Response({"error": "session_id is required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Get all reservations for this session
-        reservations = InventoryReservation.objects.filter(session_id=session_id)
+        # Fulfil the session's active reservations (reserved -> sold)
+        try:
+            count = len(commit_session_reservations(session_id))
+        except StockCommitError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
         
-        if not reservations.exists():
+        if not count:
             return Response({"message": "No reservations found for this session"})
         
-        # Commit each reservation
-        for reservation in reservations:
-            variant = reservation.variant
-            variant.count_in_stock -= reservation.quantity
-            variant.reserved_stock -= reservation.quantity
-            variant.save()
-        
-        # Delete the reservations
-        count = reservations.count()
-        reservations.delete()
-        
         return Response({
             "message": f"Committed {count} reservations for session {session_id}"
         })
@@ -207,28 +263,19 @@ def validate_inventory(request):
         if not items:
             return Response({"error": "items are required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        results = []
-        all_available = True
+        try:
+            requested = [(int(item.get('variant_id')), int(item.get('quantity', 1))) for item in items]
+        except (AttributeError, TypeError, ValueError):
+            return Response(
+                {"error": "Each item needs an integer variant_id and quantity"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        for item in items:
-            variant_id = item.get('variant_id')
-            quantity = item.get('quantity', 1)
-            
-            variant = get_object_or_404(ProductVariant, id=variant_id)
-            
-            available = variant.available_stock >= quantity
-            if not available:
-                all_available = False
-            
-            results.append({
-                'variant_id': variant_id,
-                'requested': quantity,
-                'available': variant.available_stock,
-                'is_available': available
-            })
+        # One query for every item; missing variants are reported, not raised
+        _, results = check_availability(requested)
         
         return Response({
-            'all_available': all_available,
+            'all_available': all(result['is_available'] for result in results),
             'items': results
         })
     except Exception as e:
@@ -243,31 +290,11 @@ def cleanup_expired_reservations(request):
     This is useful for both development testing and as a scheduled task in production
     """
     try:
-        # Find all expired and active reservations
-        expired = InventoryReservation.objects.filter(
-            expires_at__lt=timezone.now(),
-            is_active=True
-        )
-        
-        count = expired.count()
+        # Set-based sweep: a few statements per batch, however many rows expired
+        count = expire_reservations()
         if count == 0:
             return Response({"message": "No expired reservations found"})
             
-        logger.info(f"Cleaning up {count} expired reservations")
-        
-        # Process each expired reservation
-        for reservation in expired:
-            # Release the reserved stock
-            variant = reservation.variant
-            variant.reserved_stock = max(0, variant.reserved_stock - reservation.quantity)
-            variant.save()
-            
-            # Mark the reservation as inactive
-            reservation.is_active = False
-            reservation.save()
-            
-            logger.info(f"Released expired reservation for variant {variant.id}, quantity {reservation.quantity}")
-            
         logger.info(f"Successfully cleaned up {count} expired reservations")
         
         return Response({
@@ -277,3 +304,60 @@ def cleanup_expired_reservations(request):
     except Exception as e:
         logger.error(f"Error cleaning up expired reservations: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Comment line sent to idle stock streams so proxies keep them open
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_MAX_VARIANTS = 100
+# Streams end after this long and the browser's EventSource reconnects, so a
+# stream never outlives a deploy or, behind a WSGI server, pins a worker for good
+STREAM_MAX_SECONDS = 300
+STREAM_RETRY_MS = 1000
+
+@require_GET
+async def stream_variant_stock(request):
+    """
+    Server-sent events with {id, available, reserved} for the variants in
+    ?ids=, pushed whenever their stock changes. Async so one ASGI worker can
+    hold thousands of idle streams; serve it with an ASGI server (see
+    myproject/asgi.py). Each stream ends after STREAM_MAX_SECONDS.
+    """
+    try:
+        ids = [int(id) for id in request.GET.get('ids', '').split(',') if id]
+    except ValueError:
+        return JsonResponse({"error": "ids must be a comma separated list of integers"}, status=400)
+    if not ids or len(ids) > STREAM_MAX_VARIANTS:
+        return JsonResponse({"error": f"Provide between 1 and {STREAM_MAX_VARIANTS} variant ids"}, status=400)
+
+    async def events():
+        subscription = broadcaster.subscribe(ids)
+        deadline = asyncio.get_running_loop().time() + STREAM_MAX_SECONDS
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            # Current counts first, so the client needs no separate fetch
+            async for variant in ProductVariant.objects.filter(id__in=ids).values('id', 'available_stock', 'reserved_stock'):
+                update = {
+                    'id': variant['id'],
+                    'available': variant['available_stock'],
+                    'reserved': variant['reserved_stock']
+                }
+                yield f"event: stock\ndata: {json.dumps(update)}\n\n"
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                updates = await subscription.next_updates(min(STREAM_HEARTBEAT_SECONDS, remaining))
+                if not updates:
+                    yield ": keep-alive\n\n"
+                for update in updates:
+                    yield f"event: stock\ndata: {json.dumps(update)}\n\n"
+        except asyncio.CancelledError:
+            # Client went away
+            raise
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
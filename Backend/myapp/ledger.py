@@ -0,0 +1,185 @@
+"""
+Inventory ledger maintenance. InventoryChange is range-partitioned by month,
+so partitions are created ahead of time here. Snapshots compact the ledger per
+variant, and reconciliation replays only the ledger tail after the latest
+snapshot to check the live counters.
+"""
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import InventoryChange, InventorySnapshot, ProductVariant
+
+logger = logging.getLogger('myapp')
+
+# Snapshots stop this far in the past so rows from still-open transactions
+# (created_at is stamped before commit) are never skipped
+SNAPSHOT_LAG = timedelta(minutes=5)
+
+
+def _month_start(year, month):
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1, tzinfo=dt_timezone.utc)
+
+
+def _create_partition(cursor, table, name, start, end):
+    """
+    Create one monthly partition. Postgres refuses to create it while the
+    default partition holds rows from its range, so those are moved over:
+    the default is detached, the partition created, the rows re-inserted
+    through the parent (routing them to the new partition) and deleted from
+    the default, which is then attached again. Returns the rows moved.
+    """
+    default = f"{table}_default"
+    bounds = [start, end]
+    cursor.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {default} WHERE created_at >= %s AND created_at < %s)", bounds
+    )
+    partition = (
+        f"CREATE TABLE {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(partition)
+        return 0
+    with transaction.atomic():
+        cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {default}")
+        cursor.execute(partition)
+        cursor.execute(
+            f"INSERT INTO {table} SELECT * FROM {default} WHERE created_at >= %s AND created_at < %s", bounds
+        )
+        moved = cursor.rowcount
+        cursor.execute(f"DELETE FROM {default} WHERE created_at >= %s AND created_at < %s", bounds)
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT")
+    return moved
+
+
+def ensure_ledger_partitions(months_ahead=3):
+    """
+    Create the monthly ledger partitions from this month to months_ahead
+    months out, moving any rows the default partition caught for those
+    months into them. Returns the names of the partitions that were checked.
+    """
+    table = InventoryChange._meta.db_table
+    today = timezone.now()
+    names = []
+    with connection.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            start = _month_start(today.year, today.month + offset)
+            end = _month_start(today.year, today.month + offset + 1)
+            name = f"{table}_{start:%Y_%m}"
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [name])
+            if not cursor.fetchone()[0]:
+                moved = _create_partition(cursor, table, name, start, end)
+                if moved:
+                    logger.warning(f"Moved {moved} ledger rows from the default partition into {name}")
+            names.append(name)
+    return names
+
+
+def _repeatable_read(cursor):
+    # Counters and ledger must come from one consistent view of the database
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+
+def take_inventory_snapshot(cut=None):
+    """
+    Write one snapshot per variant as of `cut` (default: now - SNAPSHOT_LAG):
+    the previous snapshot plus the ledger rows since it, or, for a variant's
+    first snapshot, the live counters minus the ledger rows after the cut.
+    Returns the number of snapshots written.
+    """
+    cut = cut or timezone.now() - SNAPSHOT_LAG
+    variant_table = ProductVariant._meta.db_table
+    change_table = InventoryChange._meta.db_table
+    snapshot_table = InventorySnapshot._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        _repeatable_read(cursor)
+        cursor.execute(
+            f"""
+            INSERT INTO {snapshot_table} (variant_id, count_in_stock, reserved_stock, taken_at, created_at)
+            SELECT v.id,
+                   CASE WHEN s.taken_at IS NULL THEN v.count_in_stock - tail.quantity
+                        ELSE s.count_in_stock + tail.quantity END,
+                   CASE WHEN s.taken_at IS NULL THEN v.reserved_stock - tail.reserved
+                        ELSE s.reserved_stock + tail.reserved END,
+                   %(cut)s, %(now)s
+            FROM {variant_table} v
+            LEFT JOIN LATERAL (
+                SELECT count_in_stock, reserved_stock, taken_at FROM {snapshot_table}
+                WHERE variant_id = v.id AND taken_at <= %(cut)s
+                ORDER BY taken_at DESC LIMIT 1
+            ) s ON TRUE
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(c.quantity), 0) AS quantity,
+                       COALESCE(SUM(c.reserved_quantity), 0) AS reserved
+                FROM {change_table} c
+                WHERE c.variant_id = v.id
+                  AND c.created_at > COALESCE(s.taken_at, %(cut)s)
+                  AND (s.taken_at IS NULL OR c.created_at <= %(cut)s)
+            ) tail
+            ON CONFLICT (variant_id, taken_at) DO NOTHING
+            """,
+            {'cut': cut, 'now': timezone.now()}
+        )
+        return cursor.rowcount
+
+
+def prune_snapshots(older_than):
+    """
+    Delete snapshots taken before older_than, always keeping each variant's
+    latest one. Returns the number deleted.
+    """
+    newer = InventorySnapshot.objects.filter(variant=OuterRef('variant'), taken_at__gt=OuterRef('taken_at'))
+    deleted, _ = InventorySnapshot.objects.filter(taken_at__lt=older_than).filter(Exists(newer)).delete()
+    return deleted
+
+
+def reconcile_inventory():
+    """
+    Recompute every snapshotted variant's counters from its latest snapshot
+    plus the ledger tail and compare them with the live columns. Returns
+    (drift, unverified): drift lists the variants whose counters disagree,
+    unverified counts variants that have no snapshot yet.
+    """
+    variant_table = ProductVariant._meta.db_table
+    change_table = InventoryChange._meta.db_table
+    snapshot_table = InventorySnapshot._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        _repeatable_read(cursor)
+        cursor.execute(
+            f"""
+            SELECT v.id, v.sku, v.count_in_stock, v.reserved_stock,
+                   s.count_in_stock + tail.quantity, s.reserved_stock + tail.reserved
+            FROM {variant_table} v
+            JOIN LATERAL (
+                SELECT count_in_stock, reserved_stock, taken_at FROM {snapshot_table}
+                WHERE variant_id = v.id
+                ORDER BY taken_at DESC LIMIT 1
+            ) s ON TRUE
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(c.quantity), 0) AS quantity,
+                       COALESCE(SUM(c.reserved_quantity), 0) AS reserved
+                FROM {change_table} c
+                WHERE c.variant_id = v.id AND c.created_at > s.taken_at
+            ) tail
+            WHERE v.count_in_stock <> s.count_in_stock + tail.quantity
+               OR v.reserved_stock <> s.reserved_stock + tail.reserved
+            ORDER BY v.id
+            """
+        )
+        drift = [
+            {
+                'variant_id': variant_id, 'sku': sku,
+                'count_in_stock': count, 'expected_count_in_stock': expected_count,
+                'reserved_stock': reserved, 'expected_reserved_stock': expected_reserved,
+            }
+            for variant_id, sku, count, reserved, expected_count, expected_reserved in cursor.fetchall()
+        ]
+        unverified = ProductVariant.objects.exclude(
+            Exists(InventorySnapshot.objects.filter(variant=OuterRef('pk')))
+        ).count()
+    return drift, unverified
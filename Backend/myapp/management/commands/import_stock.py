@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...inventory import apply_stock_updates
+from ...stock_import import parse_stock_rows
+
+
+class Command(BaseCommand):
+    help = 'Apply a warehouse stock feed (CSV with sku,delta,count columns, or JSON lines)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Feed file; .csv is read as CSV, anything else as JSON')
+        parser.add_argument('--format', choices=['csv', 'json'], help='Override the format guessed from the extension')
+        parser.add_argument('--reason', default='restock', choices=['restock', 'adjustment', 'return'])
+        parser.add_argument('--notes', default=None)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.lower().endswith('.csv') else 'json')
+        try:
+            with open(path, encoding='utf-8') as feed:
+                updates, errors = parse_stock_rows(feed.read(), fmt)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read feed: {e}")
+
+        started = time.perf_counter()
+        applied, apply_errors = apply_stock_updates(
+            updates, reason=options['reason'], notes=options['notes'], chunk_size=options['chunk_size']
+        )
+        elapsed = time.perf_counter() - started
+
+        for error in sorted(errors + apply_errors, key=lambda error: error['row'] or 0):
+            self.stderr.write(f"Row {error['row']} ({error['sku']}): {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Applied {applied} SKUs in {elapsed:.2f}s; {len(errors) + len(apply_errors)} rows rejected"
+        ))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...webhook_events import process_webhook_batch, webhook_queue_metrics
+from ...webhooks import dispatch, prepare
+
+
+class Command(BaseCommand):
+    help = 'Apply queued Stripe webhook events: parallel across checkout sessions, in order within one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--workers', type=int, default=4, help='Events processed concurrently')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                # Drop a connection the database closed (or that hit an error) before the next batch
+                close_old_connections()
+                handled = process_webhook_batch(
+                    dispatch, batch_size=options['batch_size'], workers=options['workers'], prepare=prepare
+                )
+                if handled:
+                    metrics = webhook_queue_metrics()
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Processed {handled} events (depth {metrics['depth']}, lag {metrics['lag_seconds']:.1f}s)"
+                    ))
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Webhook worker stopped')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...ledger import reconcile_inventory
+
+
+class Command(BaseCommand):
+    help = 'Check count_in_stock/reserved_stock against the latest snapshot plus the ledger tail'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-drift', action='store_true', help='Exit with an error if any variant drifted')
+
+    def handle(self, *args, **options):
+        drift, unverified = reconcile_inventory()
+
+        for row in drift:
+            self.stdout.write(self.style.WARNING(
+                f"Variant {row['variant_id']} ({row['sku']}): "
+                f"count_in_stock {row['count_in_stock']} (ledger says {row['expected_count_in_stock']}), "
+                f"reserved_stock {row['reserved_stock']} (ledger says {row['expected_reserved_stock']})"
+            ))
+        if unverified:
+            self.stdout.write(f"{unverified} variants have no snapshot yet; run snapshot_inventory")
+
+        if drift and options['fail_on_drift']:
+            raise CommandError(f"{len(drift)} variants drifted from the ledger")
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('All snapshotted variants match the ledger'))
@@ -0,0 +1,51 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...webhooks import dispatch, handler_metrics, prepare, reset_handler_metrics
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the webhook router by replaying a recorded event stream (one Stripe event JSON per line)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSONL file of recorded events')
+        parser.add_argument('--repeat', type=int, default=1, help='Replay the stream this many times')
+        parser.add_argument('--commit', action='store_true',
+                            help='Keep the inventory changes (by default each event is rolled back)')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path']) as stream:
+                events = [json.loads(line) for line in stream if line.strip()]
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read events: {e}")
+
+        reset_handler_metrics()
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(options['repeat']):
+            for event in events:
+                try:
+                    prepare(event)
+                    with transaction.atomic():
+                        dispatch(event)
+                        if not options['commit']:
+                            transaction.set_rollback(True)
+                except Exception as e:
+                    errors += 1
+                    self.stderr.write(f"{event.get('id')} ({event.get('type')}): {e}")
+        elapsed = time.perf_counter() - started
+
+        replayed = len(events) * options['repeat']
+        self.stdout.write(self.style.SUCCESS(
+            f"Replayed {replayed} events in {elapsed:.2f}s "
+            f"({replayed / elapsed if elapsed else 0:.0f}/s, {errors} errors)"
+        ))
+        for event_type, stats in sorted(handler_metrics().items()):
+            self.stdout.write(
+                f"  {event_type}: {stats['calls']} calls, avg {stats['avg_ms']:.2f}ms, "
+                f"max {stats['max_ms']:.2f}ms, {stats['failures']} failures"
+            )
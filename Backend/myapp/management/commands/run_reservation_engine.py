@@ -0,0 +1,46 @@
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from ...reservation_engine import flush, restore_counters
+
+logger = logging.getLogger('myapp')
+
+
+class Command(BaseCommand):
+    help = 'Load the reservation counters and keep writing buffered holds to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0.2,
+                            help='Seconds to wait when the buffer is empty')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        loaded = restore_counters()
+        self.stdout.write(self.style.SUCCESS(f'Loaded reservation counters for {loaded} variants'))
+
+        while not self.stopping.is_set():
+            try:
+                # Keep draining while there is a backlog, sleep once it is empty
+                if not flush(batch_size=options['batch_size']):
+                    self.stopping.wait(options['interval'])
+            except DatabaseError as e:
+                logger.error(f"Reservation engine lost the database: {e}")
+                connection.close()
+                self.stopping.wait(options['interval'])
+
+        # Write whatever is still buffered before exiting
+        while flush(batch_size=options['batch_size']):
+            pass
+        connection.close()
+        self.stdout.write(self.style.SUCCESS('Reservation engine stopped'))
+
+    def request_stop(self, signum, frame):
+        self.stopping.set()
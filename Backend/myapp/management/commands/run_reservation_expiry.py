@@ -0,0 +1,107 @@
+import heapq
+import logging
+import signal
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from ...inventory import expire_reservations
+from ...models import InventoryReservation
+
+logger = logging.getLogger('myapp')
+
+# Shared by every replica; whoever holds it runs the sweep, the others skip
+ADVISORY_LOCK_KEY = 7306203541
+
+
+class Command(BaseCommand):
+    help = 'Long-running scheduler that releases reservations within seconds of expiring'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Seconds between refreshes of the upcoming-deadline heap')
+        parser.add_argument('--horizon', type=int, default=300,
+                            help='Only deadlines this many seconds ahead are loaded')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        poll_interval = options['poll_interval']
+        horizon = timedelta(seconds=options['horizon'])
+        deadlines = []
+        next_refresh = 0.0
+        catching_up = True
+
+        self.stdout.write(self.style.SUCCESS('Reservation expiry scheduler started'))
+        while not self.stopping.is_set():
+            try:
+                if catching_up:
+                    # Catch up on anything that expired while no scheduler was
+                    # running; retried like any sweep if the database is away
+                    self.sweep(options['batch_size'])
+                    catching_up = False
+
+                if time.monotonic() >= next_refresh:
+                    deadlines = self.load_deadlines(timezone.now() + horizon)
+                    next_refresh = time.monotonic() + poll_interval
+
+                now = timezone.now()
+                if deadlines and deadlines[0] <= now:
+                    while deadlines and deadlines[0] <= now:
+                        heapq.heappop(deadlines)
+                    self.sweep(options['batch_size'])
+                    continue
+
+                # Sleep until the next deadline or the next refresh, whichever is first
+                wait = max(0.0, next_refresh - time.monotonic())
+                if deadlines:
+                    wait = min(wait, (deadlines[0] - now).total_seconds())
+                self.stopping.wait(max(wait, 0.05))
+            except DatabaseError as e:
+                logger.error(f"Reservation expiry scheduler lost the database: {e}")
+                connection.close()
+                self.stopping.wait(poll_interval)
+
+        connection.close()
+        self.stdout.write(self.style.SUCCESS('Reservation expiry scheduler stopped'))
+
+    def request_stop(self, signum, frame):
+        # Finish the current sweep, then exit the loop
+        self.stopping.set()
+
+    def load_deadlines(self, until):
+        """
+        Heap of distinct upcoming expires_at values; an index-only range scan on
+        the partial (expires_at) WHERE is_active index
+        """
+        deadlines = list(
+            InventoryReservation.objects.filter(is_active=True, expires_at__lte=until)
+            .order_by('expires_at')
+            .values_list('expires_at', flat=True)
+            .distinct()[:1000]
+        )
+        # Already sorted, which is a valid heap
+        return deadlines
+
+    def sweep(self, batch_size):
+        """
+        Run the set-based expiry under a Postgres advisory lock so only one
+        replica sweeps at a time
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [ADVISORY_LOCK_KEY])
+            if not cursor.fetchone()[0]:
+                return
+            try:
+                count = expire_reservations(batch_size=batch_size)
+                if count:
+                    logger.info(f"Released {count} expired reservations")
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [ADVISORY_LOCK_KEY])
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...ledger import ensure_ledger_partitions, prune_snapshots, take_inventory_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming ledger partitions, snapshot every variant and prune old snapshots (run daily)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3, help='Ledger partitions to keep ready')
+        parser.add_argument('--keep-days', type=int, default=30,
+                            help='Delete snapshots older than this (the latest per variant is always kept)')
+
+    def handle(self, *args, **options):
+        partitions = ensure_ledger_partitions(options['months_ahead'])
+        self.stdout.write(f"Ledger partitions ready: {', '.join(partitions)}")
+
+        written = take_inventory_snapshot()
+        self.stdout.write(self.style.SUCCESS(f"Snapshotted {written} variants"))
+
+        pruned = prune_snapshots(timezone.now() - timedelta(days=options['keep_days']))
+        if pruned:
+            self.stdout.write(f"Pruned {pruned} old snapshots")
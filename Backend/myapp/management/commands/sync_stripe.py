@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...stripe_sync import process_stripe_sync_batch
+
+
+class Command(BaseCommand):
+    help = 'Push pending product/variant changes from the Stripe sync outbox to Stripe'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds to sleep when the outbox is empty')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        try:
+            while True:
+                handled = process_stripe_sync_batch(batch_size=batch_size)
+                if handled:
+                    self.stdout.write(self.style.SUCCESS(f"Synced {handled} objects to Stripe"))
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stripe sync worker stopped')
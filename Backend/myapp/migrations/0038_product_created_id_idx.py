@@ -0,0 +1,14 @@
+from django.db import migrations, models
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0037_add_canceled_at_to_inventoryreservation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-createdAt', '-id'], name='product_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0040_stripesynctask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventorychange',
+            name='reserved_quantity',
+            field=models.IntegerField(default=0),
+        ),
+    ]
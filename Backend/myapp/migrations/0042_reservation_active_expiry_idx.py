@@ -0,0 +1,14 @@
+from django.db import migrations, models
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0041_inventorychange_reserved_quantity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='inventoryreservation',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['expires_at'], name='reservation_active_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0044_webhookevent_queue'),
+    ]
+
+    operations = [
+        # Bring existing rows inside the new constraints before adding them
+        migrations.RunSQL(
+            sql="""
+                UPDATE myapp_productvariant
+                SET count_in_stock = GREATEST(count_in_stock, 0),
+                    reserved_stock = LEAST(GREATEST(reserved_stock, 0), GREATEST(count_in_stock, 0))
+                WHERE count_in_stock < 0 OR reserved_stock < 0 OR reserved_stock > count_in_stock
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddField(
+            model_name='productvariant',
+            name='available_stock',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(models.F('count_in_stock'), '-', models.F('reserved_stock')), output_field=models.IntegerField()),
+        ),
+        migrations.AddConstraint(
+            model_name='productvariant',
+            constraint=models.CheckConstraint(condition=models.Q(('reserved_stock__lte', models.F('count_in_stock'))), name='variant_available_stock_non_negative'),
+        ),
+        migrations.AddConstraint(
+            model_name='productvariant',
+            constraint=models.CheckConstraint(condition=models.Q(('reserved_stock__gte', 0)), name='variant_reserved_stock_non_negative'),
+        ),
+        migrations.AddIndex(
+            model_name='productvariant',
+            index=models.Index(condition=models.Q(('available_stock__gt', 0)), fields=['product'], name='variant_in_stock_idx'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+from django.db import migrations
+
+# Rebuild the ledger as a table range-partitioned by month on created_at. The
+# current and next two months get partitions up front (ledger.py keeps adding
+# them); older rows land in a single history partition, and a default
+# partition catches anything outside the prepared range.
+PARTITION_LEDGER = """
+ALTER TABLE myapp_inventorychange RENAME TO myapp_inventorychange_unpartitioned;
+ALTER TABLE myapp_inventorychange_unpartitioned
+    RENAME CONSTRAINT myapp_inventorychange_pkey TO myapp_inventorychange_unpartitioned_pkey;
+
+CREATE TABLE myapp_inventorychange (LIKE myapp_inventorychange_unpartitioned INCLUDING DEFAULTS)
+    PARTITION BY RANGE (created_at);
+
+ALTER TABLE myapp_inventorychange ALTER COLUMN id DROP DEFAULT;
+CREATE SEQUENCE myapp_inventorychange_ledger_id_seq OWNED BY myapp_inventorychange.id;
+ALTER TABLE myapp_inventorychange ALTER COLUMN id SET DEFAULT nextval('myapp_inventorychange_ledger_id_seq');
+
+ALTER TABLE myapp_inventorychange ADD PRIMARY KEY (id, created_at);
+ALTER TABLE myapp_inventorychange ADD CONSTRAINT myapp_inventorychange_variant_fk
+    FOREIGN KEY (variant_id) REFERENCES myapp_productvariant (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE myapp_inventorychange ADD CONSTRAINT myapp_inventorychange_created_by_fk
+    FOREIGN KEY (created_by_id) REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX myapp_inventorychange_variant_created_idx ON myapp_inventorychange (variant_id, created_at);
+CREATE INDEX myapp_inventorychange_created_by_idx ON myapp_inventorychange (created_by_id);
+
+DO $$
+DECLARE
+    first_month timestamptz := date_trunc('month', now());
+    month_start timestamptz;
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE myapp_inventorychange_history PARTITION OF myapp_inventorychange FOR VALUES FROM (MINVALUE) TO (%L)',
+        first_month
+    );
+    FOR i IN 0..2 LOOP
+        month_start := first_month + make_interval(months => i);
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF myapp_inventorychange FOR VALUES FROM (%L) TO (%L)',
+            'myapp_inventorychange_' || to_char(month_start, 'YYYY_MM'),
+            month_start,
+            month_start + interval '1 month'
+        );
+    END LOOP;
+END $$;
+
+CREATE TABLE myapp_inventorychange_default PARTITION OF myapp_inventorychange DEFAULT;
+
+INSERT INTO myapp_inventorychange SELECT * FROM myapp_inventorychange_unpartitioned;
+SELECT setval('myapp_inventorychange_ledger_id_seq', COALESCE((SELECT MAX(id) FROM myapp_inventorychange), 0) + 1, false);
+
+DROP TABLE myapp_inventorychange_unpartitioned;
+"""
+
+# Back to a plain table with an identity id; the partitions, the ledger
+# sequence and the partitioned table's indexes go with the DROP
+UNPARTITION_LEDGER = """
+ALTER TABLE myapp_inventorychange RENAME TO myapp_inventorychange_partitioned;
+ALTER TABLE myapp_inventorychange_partitioned
+    RENAME CONSTRAINT myapp_inventorychange_pkey TO myapp_inventorychange_partitioned_pkey;
+
+CREATE TABLE myapp_inventorychange (LIKE myapp_inventorychange_partitioned);
+INSERT INTO myapp_inventorychange SELECT * FROM myapp_inventorychange_partitioned;
+DROP TABLE myapp_inventorychange_partitioned;
+
+ALTER TABLE myapp_inventorychange ADD PRIMARY KEY (id);
+ALTER TABLE myapp_inventorychange ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+SELECT setval(
+    pg_get_serial_sequence('myapp_inventorychange', 'id'),
+    COALESCE((SELECT MAX(id) FROM myapp_inventorychange), 0) + 1, false
+);
+ALTER TABLE myapp_inventorychange ADD CONSTRAINT myapp_inventorychange_variant_fk
+    FOREIGN KEY (variant_id) REFERENCES myapp_productvariant (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE myapp_inventorychange ADD CONSTRAINT myapp_inventorychange_created_by_fk
+    FOREIGN KEY (created_by_id) REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX myapp_inventorychange_variant_created_idx ON myapp_inventorychange (variant_id, created_at);
+CREATE INDEX myapp_inventorychange_created_by_idx ON myapp_inventorychange (created_by_id);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0045_variant_available_stock'),
+    ]
+
+    operations = [
+        migrations.RunSQL(PARTITION_LEDGER, reverse_sql=UNPARTITION_LEDGER),
+    ]
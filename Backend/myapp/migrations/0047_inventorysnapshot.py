@@ -0,0 +1,27 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0046_partition_inventorychange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventorySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count_in_stock', models.IntegerField()),
+                ('reserved_stock', models.IntegerField()),
+                ('taken_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('variant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory_snapshots', to='myapp.productvariant')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('variant', 'taken_at'), name='unique_variant_snapshot')],
+                'indexes': [models.Index(fields=['variant', '-taken_at'], name='snapshot_variant_latest_idx')],
+            },
+        ),
+    ]
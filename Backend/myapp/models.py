@@ -1,10 +1,15 @@
-from django.db import models
+from django.db import models, transaction
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.utils.text import slugify
 from django.utils import timezone
 import uuid
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from .catalog_cache import bump_catalog_version
+from .search import product_search_vector
+from .stock_versions import bump_stock_versions
 
 # Create your models here.
 
@@ -25,8 +30,20 @@ class Product(models.Model):
   num_reviews = models.IntegerField(default=0)
   base_price = models.DecimalField(max_digits=10, decimal_places=2)
   stripe_id = models.CharField(max_length=100, null=True, blank=True)
+  # Computed by Postgres in the same INSERT/UPDATE as the columns it indexes
+  search_vector = models.GeneratedField(
+      expression=product_search_vector(),
+      output_field=SearchVectorField(),
+      db_persist=True,
+  )
   createdAt = models.DateTimeField(auto_now_add=True)
   updatedAt = models.DateTimeField(auto_now=True)
+  class Meta:
+      indexes = [
+          # Supports keyset (cursor) pagination of the product list
+          models.Index(fields=['-createdAt', '-id'], name='product_created_id_idx'),
+          GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+      ]
   def save(self, *args, **kwargs):
       # Generate slug if it doesn't exist
       if not self.slug:
@@ -38,37 +55,20 @@ class Product(models.Model):
               self.slug = f"{original_slug}-{counter}"
               counter += 1
    
-      # Create or update Stripe product
-      import stripe
-      import os
-      from django.conf import settings
-     
-      # Set Stripe API key safely
-      if not stripe.api_key:
-          stripe.api_key = settings.STRIPE_SECRET_KEY or os.getenv('STRIPE_SECRET_KEY')
-     
-      if not self.stripe_id:
-          # Create new Stripe product
-          try:
-              stripe_product = stripe.Product.create(
-                  name=self.name,
-                  description=self.description or f"{self.brand} {self.name}"
-              )
-              self.stripe_id = stripe_product.id
-          except Exception as e:
-              print(f"Error creating Stripe product: {e}")
-      else:
-          # Update existing Stripe product
-          try:
-              stripe.Product.modify(
-                  self.stripe_id,
-                  name=self.name,
-                  description=self.description or f"{self.brand} {self.name}"
-              )
-          except Exception as e:
-              print(f"Error updating Stripe product: {e}")
-   
       super().save(*args, **kwargs)
+      # Stripe is updated by the sync worker, not inside the request/transaction
+      if not self.stripe_id or self._stripe_state() != getattr(self, '_loaded_stripe_state', None):
+          from .stripe_sync import enqueue_stripe_sync
+          enqueue_stripe_sync('product', self.pk)
+          self._loaded_stripe_state = self._stripe_state()
+  @classmethod
+  def from_db(cls, db, field_names, values):
+      instance = super().from_db(db, field_names, values)
+      instance._loaded_stripe_state = instance._stripe_state()
+      return instance
+  def _stripe_state(self):
+      # Fields mirrored on the Stripe product; read from __dict__ so deferred fields don't query
+      return tuple(self.__dict__.get(field) for field in ('name', 'brand', 'description'))
   def __str__(self):
       return self.name
 
@@ -86,9 +86,34 @@ class ProductVariant(models.Model):
   stripe_price_id = models.CharField(max_length=100, null=True, blank=True)
   createdAt = models.DateTimeField(auto_now_add=True)
   updatedAt = models.DateTimeField(auto_now=True)
+  # Stored column computed by Postgres, so availability can be filtered and indexed
+  available_stock = models.GeneratedField(
+      expression=models.F('count_in_stock') - models.F('reserved_stock'),
+      output_field=models.IntegerField(),
+      db_persist=True,
+  )
   class Meta:
       # Ensure each product can only have one variant with a specific color-storage combination
       unique_together = ('product', 'color', 'storage')
+      constraints = [
+          # Overselling is impossible at the storage layer: available never drops below zero
+          models.CheckConstraint(
+              condition=models.Q(reserved_stock__lte=models.F('count_in_stock')),
+              name='variant_available_stock_non_negative',
+          ),
+          models.CheckConstraint(
+              condition=models.Q(reserved_stock__gte=0),
+              name='variant_reserved_stock_non_negative',
+          ),
+      ]
+      indexes = [
+          # Backs the in_stock filter: EXISTS(variant of this product with stock)
+          models.Index(
+              fields=['product'],
+              name='variant_in_stock_idx',
+              condition=models.Q(available_stock__gt=0),
+          ),
+      ]
   def save(self, *args, **kwargs):
       # Generate SKU if it doesn't exist
       if not self.sku:
@@ -110,76 +135,38 @@ class ProductVariant(models.Model):
           # Combine all parts to create the SKU
           self.sku = f"{brand_abbr}-{product_abbr}-{color_abbr}{storage_num}-{random_digits}"
    
-      # Create or update Stripe price
-      if self.product.stripe_id:
-          import stripe
-          import os
-          from django.conf import settings
-         
-          # Set Stripe API key safely
-          if not stripe.api_key:
-              stripe.api_key = settings.STRIPE_SECRET_KEY or os.getenv('STRIPE_SECRET_KEY')
-         
-          price_in_cents = int(float(self.price) * 100)
-       
-          if not self.stripe_price_id:
-              # Create new price
-              try:
-                  price = stripe.Price.create(
-                      product=self.product.stripe_id,
-                      unit_amount=price_in_cents,
-                      currency='usd',
-                      metadata={
-                          'color': self.color,
-                          'storage': self.storage,
-                          'sku': self.sku
-                      }
-                  )
-                  self.stripe_price_id = price.id
-              except Exception as e:
-                  print(f"Error creating Stripe price: {e}")
-          else:
-              # For price updates, create a new price and update the reference
-              # (Stripe doesn't allow updating existing prices)
-              try:
-                  # Check if price needs updating
-                  try:
-                      current_price = stripe.Price.retrieve(self.stripe_price_id)
-                      if current_price.unit_amount != price_in_cents:
-                          # Create new price
-                          new_price = stripe.Price.create(
-                              product=self.product.stripe_id,
-                              unit_amount=price_in_cents,
-                              currency='usd',
-                              metadata={
-                                  'color': self.color,
-                                  'storage': self.storage,
-                                  'sku': self.sku
-                              }
-                          )
-                          # Update to new price ID
-                          self.stripe_price_id = new_price.id
-                  except stripe.error.StripeError:
-                      # If price doesn't exist, create a new one
-                      new_price = stripe.Price.create(
-                          product=self.product.stripe_id,
-                          unit_amount=price_in_cents,
-                          currency='usd',
-                          metadata={
-                              'color': self.color,
-                              'storage': self.storage,
-                              'sku': self.sku
-                          }
-                      )
-                      self.stripe_price_id = new_price.id
-              except Exception as e:
-                  print(f"Error updating Stripe price: {e}")
-   
       super().save(*args, **kwargs)
-  @property
-  def available_stock(self):
-      return max(0, self.count_in_stock - self.reserved_stock)
-  
+      # Only price-relevant edits need a Stripe sync; stock updates never do
+      if not self.stripe_price_id or self._stripe_state() != getattr(self, '_loaded_stripe_state', None):
+          from .stripe_sync import enqueue_stripe_sync
+          enqueue_stripe_sync('variant', self.pk)
+          self._loaded_stripe_state = self._stripe_state()
+      self._record_stock_edit()
+  @classmethod
+  def from_db(cls, db, field_names, values):
+      instance = super().from_db(db, field_names, values)
+      instance._loaded_stripe_state = instance._stripe_state()
+      instance._loaded_stock = (instance.__dict__.get('count_in_stock'), instance.__dict__.get('reserved_stock'))
+      return instance
+  def _record_stock_edit(self):
+      # Saves that change the counters directly (admin, scripts) still get a ledger row
+      previous = getattr(self, '_loaded_stock', None)
+      current = (self.count_in_stock, self.reserved_stock)
+      if previous is None:
+          previous, reason = (0, 0), 'restock'
+      elif None in previous:
+          return
+      else:
+          reason = 'adjustment'
+      if current != previous:
+          InventoryChange.objects.create(
+              variant=self, reason=reason, notes='Direct edit',
+              quantity=current[0] - previous[0], reserved_quantity=current[1] - previous[1]
+          )
+      self._loaded_stock = current
+  def _stripe_state(self):
+      # Fields mirrored on the Stripe price; read from __dict__ so deferred fields don't query
+      return tuple(self.__dict__.get(field) for field in ('price', 'color', 'storage', 'sku'))
   @property
   def total_available_stock(self):
       return max(0, self.count_in_stock)
@@ -194,7 +181,47 @@ class ProductVariant(models.Model):
   def __str__(self):
       return f"{self.product.name} - {self.color}, {self.storage}"
 
+class StripeSyncTask(models.Model):
+  """
+  Outbox row asking the sync worker to push a product or variant to Stripe.
+  At most one pending row exists per object; repeated saves only bump requested_at.
+  """
+  OBJECT_TYPES = (
+      ('product', 'Product'),
+      ('variant', 'Product Variant'),
+  )
+  object_type = models.CharField(max_length=20, choices=OBJECT_TYPES)
+  object_id = models.BigIntegerField()
+  attempts = models.PositiveIntegerField(default=0)
+  last_error = models.TextField(blank=True, null=True)
+  requested_at = models.DateTimeField(default=timezone.now)
+  next_attempt_at = models.DateTimeField(default=timezone.now)
+  created_at = models.DateTimeField(auto_now_add=True)
+  processed_at = models.DateTimeField(null=True, blank=True)
+  class Meta:
+      constraints = [
+          models.UniqueConstraint(
+              fields=['object_type', 'object_id'],
+              condition=models.Q(processed_at__isnull=True),
+              name='unique_pending_stripe_sync'
+          )
+      ]
+      indexes = [
+          models.Index(
+              fields=['next_attempt_at'],
+              condition=models.Q(processed_at__isnull=True),
+              name='stripe_sync_pending_idx'
+          )
+      ]
+  def __str__(self):
+      return f"Stripe sync for {self.object_type} {self.object_id}"
+
 class InventoryChange(models.Model):
+  """
+  Append-only stock ledger. The table is range-partitioned by month on
+  created_at (see migration 0046 and ledger.ensure_ledger_partitions), so its
+  primary key is (id, created_at) in the database.
+  """
   REASON_CHOICES = (
       ('purchase', 'Customer Purchase'),
       ('restock', 'Restock'),
@@ -204,7 +231,8 @@ class InventoryChange(models.Model):
       ('release', 'Reservation Release'),
   )
   variant = models.ForeignKey(ProductVariant, related_name='inventory_changes', on_delete=models.CASCADE)
-  quantity = models.IntegerField()  # Can be positive (increase) or negative (decrease)
+  quantity = models.IntegerField()  # Change to count_in_stock, positive (increase) or negative (decrease)
+  reserved_quantity = models.IntegerField(default=0)  # Change to reserved_stock
   reason = models.CharField(max_length=50, choices=REASON_CHOICES)
   reference_id = models.CharField(max_length=100, blank=True, null=True)  # Order ID, reservation ID, etc.
   notes = models.TextField(blank=True, null=True)
@@ -213,6 +241,27 @@ class InventoryChange(models.Model):
   def __str__(self):
       return f"{self.variant} - {self.quantity} - {self.reason}"
 
+class InventorySnapshot(models.Model):
+  """
+  Per-variant counters as of taken_at, compacted from the previous snapshot
+  plus the ledger rows in between. Reconciliation only replays the ledger
+  tail after the latest snapshot.
+  """
+  variant = models.ForeignKey(ProductVariant, related_name='inventory_snapshots', on_delete=models.CASCADE)
+  count_in_stock = models.IntegerField()
+  reserved_stock = models.IntegerField()
+  taken_at = models.DateTimeField()
+  created_at = models.DateTimeField(auto_now_add=True)
+  class Meta:
+      constraints = [
+          models.UniqueConstraint(fields=['variant', 'taken_at'], name='unique_variant_snapshot')
+      ]
+      indexes = [
+          models.Index(fields=['variant', '-taken_at'], name='snapshot_variant_latest_idx')
+      ]
+  def __str__(self):
+      return f"{self.variant_id} @ {self.taken_at}: {self.count_in_stock}/{self.reserved_stock}"
+
 class InventoryReservation(models.Model):
   variant = models.ForeignKey(ProductVariant, related_name='reservations', on_delete=models.CASCADE)
   quantity = models.IntegerField(default=1)
@@ -223,6 +272,11 @@ class InventoryReservation(models.Model):
   created_at = models.DateTimeField(auto_now_add=True)
   fulfilled_at = models.DateTimeField(null=True, blank=True)
   canceled_at = models.DateTimeField(null=True, blank=True)
+  class Meta:
+      indexes = [
+          # The expiry sweep only ever scans active reservations by deadline
+          models.Index(fields=['expires_at'], condition=models.Q(is_active=True), name='reservation_active_expiry_idx'),
+      ]
   
   def __str__(self):
       return f"Reservation for {self.quantity}x {self.variant} (Session: {self.session_id})"
@@ -310,6 +364,8 @@ class UserProfile(models.Model):
 class Cart(models.Model):
   user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True, related_name='cart')
   session_id = models.CharField(max_length=255, null=True, blank=True)
+  # Rendered cart kept up to date by the cart views (see cart_snapshot.py)
+  snapshot = models.JSONField(null=True, blank=True, editable=False)
   created_at = models.DateTimeField(auto_now_add=True)
   updated_at = models.DateTimeField(auto_now=True)
   class Meta:
@@ -378,11 +434,71 @@ def create_user_profile(sender, instance, created, **kwargs):
 def save_user_profile(sender, instance, **kwargs):
   instance.profile.save()
 
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductVariant)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+  # Cached catalog responses are keyed by version, so bumping it retires them all.
+  # Only after commit: a reader that misses before then caches uncommitted-era
+  # data under the old version, which the bump retires.
+  transaction.on_commit(bump_catalog_version)
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def invalidate_stock_version(sender, instance, **kwargs):
+  # Direct saves (admin edits) can change counts outside the inventory service.
+  # Bumped once committed, so no poller caches the old counts under the new version
+  transaction.on_commit(lambda: bump_stock_versions([instance.pk]))
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductVariant)
+def invalidate_cart_snapshots(sender, instance, **kwargs):
+  # Snapshot lines copy names, images and prices, so carts holding the edited
+  # product or variant rebuild theirs on the next read (deletes cascade to the
+  # cart items, which clear it below)
+  if sender is Product:
+      carts = Cart.objects.filter(items__product_id=instance.pk)
+  else:
+      carts = Cart.objects.filter(items__variant_id=instance.pk)
+  carts.update(snapshot=None)
+
+@receiver([post_save, post_delete], sender=CartItem)
+def invalidate_cart_snapshot(sender, instance, **kwargs):
+  # Edits outside the cart views (admin, shell) make the next read rebuild the snapshot
+  from .cart_snapshot import is_editing
+  if not is_editing(instance.cart_id):
+      Cart.objects.filter(pk=instance.cart_id).update(snapshot=None)
+
 class WebhookEvent(models.Model):
+   STATUS_CHOICES = [
+       ('received', 'Received'),
+       ('processed', 'Processed'),
+       ('failed', 'Failed'),
+   ]
+
    event_id = models.CharField(max_length=255, unique=True)
    event_type = models.CharField(max_length=100)
    data = models.TextField()  # JSON data
-   processed_at = models.DateTimeField(auto_now_add=True)
+   status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='received')
+   outcome = models.TextField(null=True, blank=True)
+   # Events sharing a key (the checkout session) are processed one at a time, in order
+   ordering_key = models.CharField(max_length=255, null=True, blank=True)
+   attempts = models.IntegerField(default=0)
+   next_attempt_at = models.DateTimeField(default=timezone.now)
+   received_at = models.DateTimeField(default=timezone.now)
+   processed_at = models.DateTimeField(null=True, blank=True)
+
+   class Meta:
+       indexes = [
+           models.Index(
+               fields=['next_attempt_at'],
+               name='webhook_pending_idx',
+               condition=models.Q(status='received'),
+           ),
+           models.Index(
+               fields=['ordering_key', 'id'],
+               name='webhook_pending_key_idx',
+               condition=models.Q(status='received'),
+           ),
+       ]
   
    def __str__(self):
        return f"{self.event_type} - {self.event_id}"
@@ -0,0 +1,35 @@
+from rest_framework.pagination import PageNumberPagination, CursorPagination
+
+
+class ProductPageNumberPagination(PageNumberPagination):
+    """
+    Classic numbered pages; the client may pick page_size up to max_page_size
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+    Cursor pagination ordered by (createdAt, id): no COUNT(*) and no deep
+    OFFSET scan, so later pages cost about the same as the first one.
+    Next/previous links carry opaque cursor tokens. DRF positions the cursor
+    on createdAt alone; rows sharing a createdAt are stepped over with a
+    small offset inside the token, and id only makes their order stable.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-createdAt', '-id')
+
+
+def get_product_paginator(request):
+    """
+    Pick the paginator for the product list; cursor mode is opt-in with
+    ?pagination=cursor (or any request already carrying a cursor token)
+    """
+    params = request.query_params
+    if params.get('pagination') == 'cursor' or 'cursor' in params:
+        return ProductCursorPagination()
+    return ProductPageNumberPagination()
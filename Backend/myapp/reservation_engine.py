@@ -0,0 +1,609 @@
+"""
+Counter-based reservation engine for hot SKUs (RESERVATION_ENGINE = 'counter').
+
+Each variant's available count lives in an atomic counter store: Redis with
+Lua scripts when RESERVATION_ENGINE_URL is set, otherwise an in-process
+store. A reservation is one check-and-decrement across all of its variants.
+The hold is buffered and written to InventoryReservation in batches by
+flush(), so a product drop no longer serialises on one variant row lock.
+
+Counters are kept as "available in the database minus what is still
+buffered" (the per-variant pending total). sync_counters() recomputes them
+from the database. The inventory service calls it after every committed
+stock change, and restore_counters() runs it for every variant at startup.
+Finishing a hold and setting counters bump a version, and a counter set is
+only applied if the version is unchanged since the database was read, so a
+flush committing in between can't leave a counter computed from stale stock.
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+
+from .inventory import _write_reservations, reserve_items_locked
+from .models import InventoryChange, InventoryReservation, ProductVariant
+from .stripe_sync import get_stripe_client
+
+logger = logging.getLogger('myapp')
+
+COUNTER_PREFIX = 'reservations:available:'
+PENDING_KEY = 'reservations:pending'
+BUFFER_KEY = 'reservations:buffer'
+QUEUE_KEY = 'reservations:queue'
+INFLIGHT_KEY = 'reservations:inflight'
+VERSION_KEY = 'reservations:version'
+
+# How long a caller waits for its session's previous hold to be flushed
+FLUSH_WAIT_SECONDS = 2.0
+# How far before a hold's expiry its ledger rows may have been written
+INFLIGHT_LOOKBACK = timedelta(days=1)
+# Times sync_counters() re-reads the database when a flush lands in between
+SYNC_ATTEMPTS = 5
+
+
+class InProcessCounterStore:
+    """
+    Single-process store with the same semantics as RedisCounterStore, for
+    tests and local development
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.pending = defaultdict(int)
+        self.buffer = {}
+        self.queue = deque()
+        self.inflight = {}
+        self.version = 0
+
+    def reserve(self, session_id, items, record):
+        with self._lock:
+            if session_id in self.buffer or session_id in self.inflight:
+                return 'busy', []
+            missing = [variant_id for variant_id, _ in items if variant_id not in self.counters]
+            if missing:
+                return 'missing', missing
+            short = [
+                (variant_id, self.counters[variant_id])
+                for variant_id, quantity in items if self.counters[variant_id] < quantity
+            ]
+            if short:
+                return 'short', short
+            for variant_id, quantity in items:
+                self.counters[variant_id] -= quantity
+                self.pending[variant_id] += quantity
+            self.buffer[session_id] = record
+            self.queue.append(session_id)
+            return 'ok', []
+
+    def discard(self, session_id):
+        with self._lock:
+            record = self.buffer.pop(session_id, None)
+            if record is None:
+                return None
+            self.queue.remove(session_id)
+            self._release(record, restore=True)
+            return record
+
+    def bind(self, token, session_id):
+        with self._lock:
+            if token in self.buffer:
+                self.buffer[session_id] = _bound_record(self.buffer.pop(token), token)
+                self.queue.remove(token)
+                self.queue.append(session_id)
+                return 'buffered'
+            return 'inflight' if token in self.inflight else 'absent'
+
+    def status(self, session_id):
+        with self._lock:
+            if session_id in self.buffer:
+                return 'buffered'
+            return 'inflight' if session_id in self.inflight else 'absent'
+
+    def take_batch(self, size):
+        with self._lock:
+            taken = []
+            while self.queue and len(taken) < size:
+                session_id = self.queue.popleft()
+                record = self.buffer.pop(session_id)
+                self.inflight[session_id] = record
+                taken.append((session_id, record))
+            return taken
+
+    def finish(self, session_ids, restore=False):
+        with self._lock:
+            self.version += 1
+            for session_id in session_ids:
+                record = self.inflight.pop(session_id, None)
+                if record is not None:
+                    self._release(record, restore)
+
+    def inflight_holds(self):
+        with self._lock:
+            return list(self.inflight.items())
+
+    def requeue(self, session_ids):
+        with self._lock:
+            for session_id in reversed(session_ids):
+                record = self.inflight.pop(session_id, None)
+                if record is not None:
+                    self.buffer[session_id] = record
+                    self.queue.appendleft(session_id)
+
+    def current_version(self):
+        with self._lock:
+            return self.version
+
+    def set_available(self, available, version):
+        with self._lock:
+            if version != self.version:
+                return False
+            self.version += 1
+            for variant_id, count in available.items():
+                self.counters[variant_id] = count - self.pending[variant_id]
+            return True
+
+    def _release(self, record, restore):
+        for variant_id, quantity in json.loads(record)['items'].items():
+            self.pending[int(variant_id)] -= quantity
+            if restore:
+                self.counters[int(variant_id)] += quantity
+
+
+# KEYS: pending, buffer, queue, inflight, counter keys...
+# ARGV: session id, record, variant ids..., quantities...
+RESERVE_SCRIPT = """
+local n = #KEYS - 4
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 or redis.call('HEXISTS', KEYS[4], ARGV[1]) == 1 then
+    return {'busy'}
+end
+local missing, short = {}, {}
+for i = 1, n do
+    local available = redis.call('GET', KEYS[4 + i])
+    if not available then
+        table.insert(missing, ARGV[2 + i])
+    elseif tonumber(available) < tonumber(ARGV[2 + n + i]) then
+        table.insert(short, ARGV[2 + i])
+        table.insert(short, available)
+    end
+end
+if #missing > 0 then return {'missing', unpack(missing)} end
+if #short > 0 then return {'short', unpack(short)} end
+for i = 1, n do
+    redis.call('DECRBY', KEYS[4 + i], ARGV[2 + n + i])
+    redis.call('HINCRBY', KEYS[1], ARGV[2 + i], ARGV[2 + n + i])
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('RPUSH', KEYS[3], ARGV[1])
+return {'ok'}
+"""
+
+# KEYS: pending, buffer, queue; ARGV: session id, counter prefix
+DISCARD_SCRIPT = """
+local record = redis.call('HGET', KEYS[2], ARGV[1])
+if not record then return false end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('LREM', KEYS[3], 0, ARGV[1])
+for variant_id, quantity in pairs(cjson.decode(record)['items']) do
+    redis.call('INCRBY', ARGV[2] .. variant_id, quantity)
+    redis.call('HINCRBY', KEYS[1], variant_id, -quantity)
+end
+return record
+"""
+
+# KEYS: buffer, queue, inflight; ARGV: token, session id
+BIND_SCRIPT = """
+local record = redis.call('HGET', KEYS[1], ARGV[1])
+if record then
+    local hold = cjson.decode(record)
+    hold['token'] = ARGV[1]
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HSET', KEYS[1], ARGV[2], cjson.encode(hold))
+    redis.call('LREM', KEYS[2], 0, ARGV[1])
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+    return 'buffered'
+end
+if redis.call('HEXISTS', KEYS[3], ARGV[1]) == 1 then return 'inflight' end
+return 'absent'
+"""
+
+# KEYS: buffer, queue, inflight; ARGV: batch size
+TAKE_SCRIPT = """
+local taken = {}
+for i = 1, tonumber(ARGV[1]) do
+    local session_id = redis.call('LPOP', KEYS[2])
+    if not session_id then break end
+    local record = redis.call('HGET', KEYS[1], session_id)
+    if record then
+        redis.call('HDEL', KEYS[1], session_id)
+        redis.call('HSET', KEYS[3], session_id, record)
+        table.insert(taken, session_id)
+        table.insert(taken, record)
+    end
+end
+return taken
+"""
+
+# KEYS: pending, inflight, version; ARGV: counter prefix, restore flag, session ids...
+FINISH_SCRIPT = """
+redis.call('INCR', KEYS[3])
+for i = 3, #ARGV do
+    local record = redis.call('HGET', KEYS[2], ARGV[i])
+    if record then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        for variant_id, quantity in pairs(cjson.decode(record)['items']) do
+            redis.call('HINCRBY', KEYS[1], variant_id, -quantity)
+            if ARGV[2] == '1' then
+                redis.call('INCRBY', ARGV[1] .. variant_id, quantity)
+            end
+        end
+    end
+end
+return true
+"""
+
+# KEYS: buffer, queue, inflight; ARGV: session ids (put back at the front, in order)
+REQUEUE_SCRIPT = """
+for i = #ARGV, 1, -1 do
+    local record = redis.call('HGET', KEYS[3], ARGV[i])
+    if record then
+        redis.call('HDEL', KEYS[3], ARGV[i])
+        redis.call('HSET', KEYS[1], ARGV[i], record)
+        redis.call('LPUSH', KEYS[2], ARGV[i])
+    end
+end
+return true
+"""
+
+# KEYS: pending, version; ARGV: counter prefix, expected version, then variant id / available pairs
+SET_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then return 0 end
+redis.call('INCR', KEYS[2])
+for i = 3, #ARGV, 2 do
+    local pending = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+    redis.call('SET', ARGV[1] .. ARGV[i], tonumber(ARGV[i + 1]) - pending)
+end
+return 1
+"""
+
+
+class RedisCounterStore:
+    """
+    Counter store shared by every web worker. Each operation is one Lua
+    script, so check-and-decrement across a cart's variants is atomic.
+    """
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured("RESERVATION_ENGINE_URL is set but the redis package is not installed")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._reserve = self.client.register_script(RESERVE_SCRIPT)
+        self._discard = self.client.register_script(DISCARD_SCRIPT)
+        self._bind = self.client.register_script(BIND_SCRIPT)
+        self._take = self.client.register_script(TAKE_SCRIPT)
+        self._finish = self.client.register_script(FINISH_SCRIPT)
+        self._requeue = self.client.register_script(REQUEUE_SCRIPT)
+        self._set = self.client.register_script(SET_SCRIPT)
+
+    def reserve(self, session_id, items, record):
+        keys = [PENDING_KEY, BUFFER_KEY, QUEUE_KEY, INFLIGHT_KEY]
+        keys += [f"{COUNTER_PREFIX}{variant_id}" for variant_id, _ in items]
+        args = [session_id, record]
+        args += [variant_id for variant_id, _ in items] + [quantity for _, quantity in items]
+        status, *detail = self._reserve(keys=keys, args=args)
+        if status == 'missing':
+            return status, [int(variant_id) for variant_id in detail]
+        if status == 'short':
+            return status, [(int(detail[i]), int(detail[i + 1])) for i in range(0, len(detail), 2)]
+        return status, []
+
+    def discard(self, session_id):
+        return self._discard(keys=[PENDING_KEY, BUFFER_KEY, QUEUE_KEY], args=[session_id, COUNTER_PREFIX]) or None
+
+    def bind(self, token, session_id):
+        return self._bind(keys=[BUFFER_KEY, QUEUE_KEY, INFLIGHT_KEY], args=[token, session_id])
+
+    def status(self, session_id):
+        # MULTI/EXEC, so both fields are read at one point in time
+        pipe = self.client.pipeline()
+        pipe.hexists(BUFFER_KEY, session_id)
+        pipe.hexists(INFLIGHT_KEY, session_id)
+        buffered, inflight = pipe.execute()
+        if buffered:
+            return 'buffered'
+        return 'inflight' if inflight else 'absent'
+
+    def take_batch(self, size):
+        taken = self._take(keys=[BUFFER_KEY, QUEUE_KEY, INFLIGHT_KEY], args=[size])
+        return list(zip(taken[::2], taken[1::2]))
+
+    def finish(self, session_ids, restore=False):
+        if session_ids:
+            self._finish(keys=[PENDING_KEY, INFLIGHT_KEY, VERSION_KEY], args=[COUNTER_PREFIX, '1' if restore else '0', *session_ids])
+
+    def inflight_holds(self):
+        return list(self.client.hgetall(INFLIGHT_KEY).items())
+
+    def requeue(self, session_ids):
+        if session_ids:
+            self._requeue(keys=[BUFFER_KEY, QUEUE_KEY, INFLIGHT_KEY], args=list(session_ids))
+
+    def current_version(self):
+        return int(self.client.get(VERSION_KEY) or 0)
+
+    def set_available(self, available, version):
+        args = [COUNTER_PREFIX, version]
+        for variant_id, count in available.items():
+            args += [variant_id, count]
+        return bool(self._set(keys=[PENDING_KEY, VERSION_KEY], args=args))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    The process-wide counter store. The in-process store also starts a
+    daemon thread that flushes the buffer, since no other process can; it is
+    only accepted with DEBUG or in tests, because each worker would keep its
+    own counters and together they would oversell.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            url = getattr(settings, 'RESERVATION_ENGINE_URL', '')
+            if url:
+                _store = RedisCounterStore(url)
+            elif not (settings.DEBUG or getattr(settings, 'TESTING', False)):
+                raise ImproperlyConfigured(
+                    "RESERVATION_ENGINE = 'counter' needs RESERVATION_ENGINE_URL outside DEBUG and tests"
+                )
+            else:
+                _store = InProcessCounterStore()
+                interval = getattr(settings, 'RESERVATION_ENGINE_FLUSH_INTERVAL', 0.2)
+                if interval:
+                    threading.Thread(target=_flush_forever, args=(interval,), daemon=True).start()
+        return _store
+
+
+def reset_store(store=None):
+    """
+    Swap the counter store (tests use a fresh InProcessCounterStore)
+    """
+    global _store
+    with _store_lock:
+        _store = store
+
+
+def _bound_record(record, token):
+    # Remember the token: a bound hold has a checkout session the customer can pay
+    hold = json.loads(record)
+    hold['token'] = token
+    return json.dumps(hold)
+
+
+def _unsaved_reservations(session_id, items, expires_at):
+    return [
+        InventoryReservation(variant_id=variant_id, quantity=quantity, session_id=session_id, expires_at=expires_at)
+        for variant_id, quantity in items
+    ]
+
+
+def _wait_until_flushed(store, session_id):
+    # A second hold for the same session waits for the first to be written.
+    # Only reads: re-queueing the hold on every probe would postpone its flush
+    deadline = time.monotonic() + FLUSH_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        if store.status(session_id) == 'absent':
+            return
+        time.sleep(0.01)
+
+
+def reserve(quantities, session_id, expires_at, notes=None):
+    """
+    Take an all-or-nothing hold in the counter store and buffer it for the
+    database. Same return shape as inventory.reserve_items().
+    """
+    store = get_store()
+    items = sorted(quantities.items())
+    record = json.dumps({
+        'items': {str(variant_id): quantity for variant_id, quantity in items},
+        'expires_at': expires_at.isoformat(),
+        'notes': notes,
+    })
+    synced = False
+    for _ in range(3):
+        status, detail = store.reserve(session_id, items, record)
+        if status == 'ok':
+            return _unsaved_reservations(session_id, items, expires_at), []
+        if status == 'short':
+            return [], [
+                {'variant_id': variant_id, 'requested': quantities[variant_id], 'available': max(0, available)}
+                for variant_id, available in detail
+            ]
+        if status == 'busy':
+            _wait_until_flushed(store, session_id)
+        elif status == 'missing':
+            if synced:
+                # Still no counter after loading from the database: no such variant
+                return [], [
+                    {'variant_id': variant_id, 'requested': quantities[variant_id], 'available': None}
+                    for variant_id in detail
+                ]
+            sync_counters(detail)
+            synced = True
+    return [], [{'variant_id': variant_id, 'requested': quantity, 'available': 0} for variant_id, quantity in items]
+
+
+def discard(session_id):
+    """
+    Drop a hold that is still buffered, giving its units back. Returns the
+    unsaved reservations that were dropped, or [] if nothing was buffered.
+    """
+    store = get_store()
+    record = store.discard(session_id)
+    if not record:
+        # If it is being written right now, let the caller release it from the database
+        _wait_until_flushed(store, session_id)
+        return []
+    record = json.loads(record)
+    items = [(int(variant_id), quantity) for variant_id, quantity in record['items'].items()]
+    return _unsaved_reservations(session_id, items, datetime.fromisoformat(record['expires_at']))
+
+
+def bind(token, session_id):
+    """
+    Re-key a buffered hold to its checkout session. Returns True if it was
+    still buffered; False means it is (now) in the database, where
+    inventory.bind_reservations() updates it.
+    """
+    store = get_store()
+    deadline = time.monotonic() + FLUSH_WAIT_SECONDS
+    while True:
+        status = store.bind(token, session_id)
+        if status != 'inflight' or time.monotonic() > deadline:
+            return status == 'buffered'
+        # Being written right now; wait for the commit
+        time.sleep(0.01)
+
+
+def sync_counters(variant_ids):
+    """
+    Reset the counters of the given variants from the database. The store's
+    version is read before the database, and the counters are only set if
+    no hold was finished (and no other sync landed) in between; otherwise
+    the database is read again. Returns True if the counters were set.
+    """
+    store = get_store()
+    variant_ids = list(variant_ids)
+    for _ in range(SYNC_ATTEMPTS):
+        version = store.current_version()
+        available = dict(
+            ProductVariant.objects.filter(id__in=variant_ids).values_list('id', 'available_stock')
+        )
+        if store.set_available(available, version):
+            return True
+    # The next flush syncs these variants again
+    logger.warning(f"Gave up syncing {len(variant_ids)} reservation counters after {SYNC_ATTEMPTS} attempts")
+    return False
+
+
+def recover_inflight():
+    """
+    Settle holds a flusher took but never finished (it died between
+    take_batch() and finish()). Holds whose rows were committed are
+    finished; the rest go back to the front of the buffer to be written
+    again. The check uses the hold's 'reservation' ledger rows, which are
+    committed with the reservations and, unlike them, never re-keyed by
+    inventory.bind_reservations(). Returns (finished, requeued).
+    """
+    store = get_store()
+    inflight = store.inflight_holds()
+    if not inflight:
+        return 0, 0
+    session_ids = [session_id for session_id, _ in inflight]
+    # Holds are written when taken, never after they expire; this bounds the ledger partitions scanned
+    since = min(datetime.fromisoformat(json.loads(record)['expires_at']) for _, record in inflight) - INFLIGHT_LOOKBACK
+    written = set(
+        InventoryChange.objects.filter(
+            reference_id__in=session_ids, reason='reservation', created_at__gte=since
+        ).values_list('reference_id', flat=True)
+    )
+    requeued = [session_id for session_id in session_ids if session_id not in written]
+    store.finish([session_id for session_id in session_ids if session_id in written])
+    store.requeue(requeued)
+    if requeued:
+        logger.warning(f"Requeued {len(requeued)} reservation holds left in flight")
+    return len(session_ids) - len(requeued), len(requeued)
+
+
+def restore_counters(chunk_size=1000):
+    """
+    Settle holds left in flight, then reload every variant's counter. Run at
+    startup, before any flusher. Returns the number of counters loaded.
+    """
+    recover_inflight()
+    ids = list(ProductVariant.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(ids), chunk_size):
+        sync_counters(ids[start:start + chunk_size])
+    return len(ids)
+
+
+def flush(batch_size=500):
+    """
+    Write one batch of buffered holds to the database in a single
+    transaction. If the batch no longer fits (a counter drifted), the holds
+    are retried one at a time with row locks, and those that fail are
+    dropped and their units returned; a dropped hold that was already bound
+    to a checkout session has that session expired, so the customer can't
+    pay for stock that was never held. Returns the number of holds handled.
+    """
+    store = get_store()
+    taken = store.take_batch(batch_size)
+    if not taken:
+        return 0
+
+    holds = []
+    bound = set()
+    for session_id, record in taken:
+        record = json.loads(record)
+        holds.append((
+            session_id,
+            {int(variant_id): quantity for variant_id, quantity in record['items'].items()},
+            datetime.fromisoformat(record['expires_at']),
+            record['notes'],
+        ))
+        if record.get('token'):
+            bound.add(session_id)
+    variant_ids = sorted({variant_id for _, items, _, _ in holds for variant_id in items})
+
+    try:
+        with transaction.atomic():
+            # Same lock order as reserve_items; the CHECK constraint rejects overselling
+            list(ProductVariant.objects.select_for_update().filter(id__in=variant_ids).order_by('id').values_list('id'))
+            _write_reservations([
+                (session_id, variant_id, quantity, expires_at, notes)
+                for session_id, items, expires_at, notes in holds
+                for variant_id, quantity in sorted(items.items())
+            ], sync_engine=False)
+        store.finish([session_id for session_id, _, _, _ in holds])
+    except IntegrityError:
+        logger.warning(f"Buffered reservations no longer fit; writing {len(holds)} holds one by one")
+        for session_id, items, expires_at, notes in holds:
+            _, shortages = reserve_items_locked(items, session_id, expires_at, notes, sync_engine=False)
+            store.finish([session_id], restore=bool(shortages))
+            if shortages and session_id in bound:
+                _expire_checkout_session(session_id, shortages)
+            elif shortages:
+                logger.warning(f"Dropped buffered hold for session {session_id}: {shortages}")
+
+    # Pending totals just dropped; recompute the counters from the committed rows
+    sync_counters(variant_ids)
+    return len(holds)
+
+
+def _expire_checkout_session(session_id, shortages):
+    logger.error(f"Dropped buffered hold for checkout session {session_id}: {shortages}; expiring the session")
+    try:
+        get_stripe_client().checkout.Session.expire(session_id)
+    except Exception as e:
+        logger.error(f"Could not expire checkout session {session_id}; a payment would sell unheld stock: {e}")
+
+
+def _flush_forever(interval):
+    while True:
+        try:
+            if not flush():
+                time.sleep(interval)
+        except Exception as e:
+            logger.error(f"Reservation flush failed: {e}")
+            time.sleep(interval)
+        finally:
+            connection.close()
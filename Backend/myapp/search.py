@@ -0,0 +1,48 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import F
+
+# 'simple' keeps model names such as "iphone" or "s24" intact instead of stemming them
+SEARCH_CONFIG = 'simple'
+
+
+def product_search_vector():
+    """
+    Weighted tsvector over the searchable product columns (name ranks
+    highest). Product.search_vector is a generated column over this
+    expression, so it must stay immutable (explicit config, no functions
+    that depend on settings).
+    """
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('brand', weight='B', config=SEARCH_CONFIG)
+        + SearchVector('category', weight='C', config=SEARCH_CONFIG)
+        + SearchVector('description', weight='D', config=SEARCH_CONFIG)
+    )
+
+
+def build_search_query(text):
+    """
+    Turn free text into a prefix tsquery ("iph 15" -> "iph:* & 15:*") for typeahead.
+    Only word characters are kept, so user input can't inject tsquery syntax.
+    """
+    terms = re.findall(r'\w+', (text or '').lower())
+    if not terms:
+        return None
+    return SearchQuery(' & '.join(f"{term}:*" for term in terms), search_type='raw', config=SEARCH_CONFIG)
+
+
+def search_products(queryset, text):
+    """
+    Filter a product queryset by full-text match against the GIN-indexed
+    search vector and order it by relevance
+    """
+    query = build_search_query(text)
+    if query is None:
+        return queryset.none()
+    return (
+        queryset.filter(search_vector=query)
+        .annotate(rank=SearchRank(F('search_vector'), query))
+        .order_by('-rank', '-createdAt', '-id')
+    )
@@ -48,8 +48,8 @@ class InventoryChangeSerializer(serializers.ModelSerializer):
     class Meta:
         model = InventoryChange
         fields = [
-            'id', 'variant', 'variant_name', 'quantity', 'reason',
-            'notes', 'timestamp'
+            'id', 'variant', 'variant_name', 'quantity', 'reserved_quantity',
+            'reason', 'reference_id', 'notes', 'created_at'
         ]
    
     def get_variant_name(self, obj):
@@ -0,0 +1,63 @@
+import csv
+import io
+import json
+
+
+def _parse_row(number, record):
+    """
+    Validate one {'sku', 'delta' | 'count'} record; returns (update, error)
+    """
+    if not isinstance(record, dict):
+        return None, {'row': number, 'sku': None, 'error': 'Expected an object'}
+    sku = str(record.get('sku') or '').strip()
+    delta = record.get('delta')
+    count = record.get('count')
+    # CSV leaves unused columns as empty strings
+    delta = None if delta in (None, '') else delta
+    count = None if count in (None, '') else count
+
+    if not sku:
+        return None, {'row': number, 'sku': None, 'error': 'sku is required'}
+    if (delta is None) == (count is None):
+        return None, {'row': number, 'sku': sku, 'error': 'Provide exactly one of delta or count'}
+    try:
+        delta = int(delta) if delta is not None else None
+        count = int(count) if count is not None else None
+    except (TypeError, ValueError):
+        return None, {'row': number, 'sku': sku, 'error': 'delta/count must be integers'}
+    if count is not None and count < 0:
+        return None, {'row': number, 'sku': sku, 'error': 'count cannot be negative'}
+    return {'row': number, 'sku': sku, 'delta': delta, 'count': count}, None
+
+
+def parse_stock_rows(text, fmt='csv'):
+    """
+    Parse a warehouse feed: CSV with a `sku,delta,count` header, or JSON
+    (an array or one object per line). Returns (updates, errors); rows are
+    numbered from 1 in the order given.
+    """
+    if fmt == 'csv':
+        records = list(csv.DictReader(io.StringIO(text)))
+    elif fmt == 'json':
+        stripped = text.strip()
+        if stripped.startswith('['):
+            records = json.loads(stripped)
+        else:
+            records = [json.loads(line) for line in stripped.splitlines() if line.strip()]
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+    return parse_stock_records(records)
+
+
+def parse_stock_records(records):
+    """
+    Validate already decoded records; returns (updates, errors)
+    """
+    updates, errors = [], []
+    for number, record in enumerate(records, start=1):
+        update, error = _parse_row(number, record)
+        if error:
+            errors.append(error)
+        else:
+            updates.append(update)
+    return updates, errors
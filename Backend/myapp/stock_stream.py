@@ -0,0 +1,148 @@
+"""
+Live stock updates. The inventory service NOTIFYs the new counts of every
+variant it touches on the `stock_changes` channel (delivered only when the
+transaction commits); each worker process keeps one LISTEN connection, on a
+thread with its own event loop, and fans the notifications out to its
+server-sent event subscribers on whichever loops they were opened on (one
+per process under ASGI, one per request under WSGI).
+"""
+import asyncio
+import json
+import logging
+import threading
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from django.db import connection
+
+from .models import ProductVariant
+
+logger = logging.getLogger('myapp')
+
+STOCK_CHANNEL = 'stock_changes'
+
+
+def notify_stock_changes(variant_ids):
+    """
+    Queue a notification with the current counts of each variant. Runs in the
+    caller's transaction, so listeners only hear about committed changes.
+    """
+    variant_ids = sorted(set(variant_ids))
+    if not variant_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT pg_notify(%s, json_build_object(
+                'id', id,
+                'available', available_stock,
+                'reserved', reserved_stock
+            )::text)
+            FROM {ProductVariant._meta.db_table}
+            WHERE id = ANY(%s)
+            """,
+            [STOCK_CHANNEL, variant_ids]
+        )
+
+
+class Subscription:
+    """
+    One client's interest in a set of variants. Updates for the same variant
+    are coalesced, so a slow client only ever gets the latest counts. Must be
+    created on the event loop that reads it.
+    """
+    def __init__(self, variant_ids):
+        self.variant_ids = set(variant_ids)
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+    def push(self, update):
+        self.pending[update['id']] = update
+        self.ready.set()
+
+    def push_threadsafe(self, update):
+        try:
+            self.loop.call_soon_threadsafe(self.push, update)
+        except RuntimeError:
+            # The request's loop already closed; unsubscribe() is on its way
+            pass
+
+    async def next_updates(self, timeout):
+        """
+        Wait up to timeout seconds and return the updates gathered so far
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.ready.clear()
+        updates, self.pending = list(self.pending.values()), {}
+        return updates
+
+
+class StockBroadcaster:
+    """
+    Per-process LISTEN connection shared by every subscription. It runs on a
+    daemon thread with its own event loop, so it outlives the request (and,
+    under WSGI, the per-request loop) that started it.
+    """
+    def __init__(self):
+        self.subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _conninfo(self):
+        # Connect the way Django does, OPTIONS (sslmode, ...) included; the
+        # Python-level objects it adds for its own cursors don't apply here
+        params = connection.get_connection_params()
+        for key in ('cursor_factory', 'context', 'prepare_threshold'):
+            params.pop(key, None)
+        return make_conninfo(**params)
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=asyncio.run, args=(self._listen(),), name='stock-listener', daemon=True
+                )
+                self._thread.start()
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self._conninfo(), autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {STOCK_CHANNEL}")
+                    async for notify in conn.notifies():
+                        self._fan_out(json.loads(notify.payload))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Stock listener disconnected, retrying: {e}")
+                await asyncio.sleep(1)
+
+    def _fan_out(self, update):
+        with self._lock:
+            subscriptions = list(self.subscribers.get(update['id'], ()))
+        for subscription in subscriptions:
+            subscription.push_threadsafe(update)
+
+    def subscribe(self, variant_ids):
+        self._ensure_listener()
+        subscription = Subscription(variant_ids)
+        with self._lock:
+            for variant_id in subscription.variant_ids:
+                self.subscribers.setdefault(variant_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for variant_id in subscription.variant_ids:
+                subscribers = self.subscribers.get(variant_id)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[variant_id]
+
+
+broadcaster = StockBroadcaster()
@@ -0,0 +1,63 @@
+"""
+Per-variant stock versions behind the availability ETags. Whichever process
+moves stock bumps the version, and every web worker answers If-None-Match from
+it without reading the database, so the versions must live in a cache all
+processes share (the myapp.E001 system check refuses a per-process one outside
+DEBUG and tests).
+"""
+import hashlib
+import logging
+import time
+
+from django.core.cache import cache
+
+logger = logging.getLogger('myapp')
+
+STOCK_VERSION_KEY = 'stock:version:{}'
+# Short client-side caching for availability polls
+STOCK_MAX_AGE = 5
+STOCK_STALE_WHILE_REVALIDATE = 30
+
+
+def _initial_version():
+    # Millisecond clock, so a flushed cache never reissues a version a client still holds
+    return int(time.time() * 1000)
+
+
+def get_stock_versions(variant_ids):
+    """
+    Return {variant_id: version}, initialising counters the cache doesn't have
+    """
+    keys = {STOCK_VERSION_KEY.format(variant_id): variant_id for variant_id in variant_ids}
+    found = cache.get_many(list(keys))
+    missing = [key for key in keys if key not in found]
+    if missing:
+        initial = _initial_version()
+        for key in missing:
+            # add() only succeeds for the first process, everyone else re-reads its value
+            cache.add(key, initial, timeout=None)
+        found.update(cache.get_many(missing))
+    return {keys[key]: found.get(key, 0) for key in keys}
+
+
+def bump_stock_versions(variant_ids):
+    """
+    Move each variant to a new stock version so cached availability is revalidated
+    """
+    for variant_id in set(variant_ids):
+        key = STOCK_VERSION_KEY.format(variant_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Key was evicted; a fresh clock-based value is newer than any version handed out
+            cache.add(key, _initial_version(), timeout=None)
+            cache.incr(key)
+    logger.debug(f"Stock versions bumped for variants {sorted(set(variant_ids))}")
+
+
+def stock_etag(versions):
+    """
+    Strong ETag for a stock response covering the given {variant_id: version}
+    """
+    raw = ','.join(f"{variant_id}:{version}" for variant_id, version in sorted(versions.items()))
+    return f'"{hashlib.md5(raw.encode("utf-8")).hexdigest()}"'
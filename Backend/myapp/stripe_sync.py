@@ -0,0 +1,179 @@
+import logging
+import os
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Product, ProductVariant, StripeSyncTask
+
+logger = logging.getLogger('myapp')
+
+MAX_ATTEMPTS = 8
+# How long a claimed task is hidden from other workers while it is being pushed
+CLAIM_LEASE = timedelta(minutes=5)
+
+
+def enqueue_stripe_sync(object_type, object_id):
+    """
+    Record that a product/variant needs pushing to Stripe. Runs inside the
+    caller's transaction; a pending row for the same object is reused and only
+    has requested_at bumped, so bursts of saves collapse into one sync.
+    """
+    table = StripeSyncTask._meta.db_table
+    # Timestamps come from the app clock, the same one claim_tasks() compares against
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (object_type, object_id, attempts, requested_at, next_attempt_at, created_at)
+            VALUES (%s, %s, 0, %s, %s, %s)
+            ON CONFLICT (object_type, object_id) WHERE processed_at IS NULL
+            DO UPDATE SET requested_at = EXCLUDED.requested_at
+            """,
+            [object_type, object_id, now, now, now]
+        )
+
+
+def get_stripe_client():
+    """
+    Return the configured stripe module (tests pass a fake client instead)
+    """
+    if not stripe.api_key:
+        stripe.api_key = settings.STRIPE_SECRET_KEY or os.getenv('STRIPE_SECRET_KEY')
+    return stripe
+
+
+def claim_tasks(batch_size):
+    """
+    Lease up to batch_size due tasks. Rows locked by another worker are skipped
+    and the lease keeps them hidden until this worker reports back.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        tasks = list(
+            StripeSyncTask.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if tasks:
+            StripeSyncTask.objects.filter(id__in=[task.id for task in tasks]).update(
+                next_attempt_at=now + CLAIM_LEASE
+            )
+    return tasks, now
+
+
+def sync_product(product, client):
+    """
+    Create or update the Stripe product for a Product
+    """
+    description = product.description or f"{product.brand} {product.name}"
+    if product.stripe_id:
+        client.Product.modify(product.stripe_id, name=product.name, description=description)
+        return product.stripe_id
+
+    stripe_product = client.Product.create(name=product.name, description=description)
+    # update() instead of save() so the write doesn't enqueue another sync
+    Product.objects.filter(pk=product.pk).update(stripe_id=stripe_product.id)
+    product.stripe_id = stripe_product.id
+    return product.stripe_id
+
+
+def sync_variant(variant, client):
+    """
+    Point the variant at a Stripe price matching its current amount. Stripe
+    prices are immutable, so a changed amount means creating a new price.
+    """
+    product = variant.product
+    if not product.stripe_id:
+        sync_product(product, client)
+
+    price_in_cents = int(variant.price * 100)
+    if variant.stripe_price_id:
+        try:
+            current_price = client.Price.retrieve(variant.stripe_price_id)
+            if current_price.unit_amount == price_in_cents:
+                return variant.stripe_price_id
+        except stripe.error.StripeError:
+            # Price missing on Stripe's side; fall through and create a new one
+            pass
+
+    price = client.Price.create(
+        product=product.stripe_id,
+        unit_amount=price_in_cents,
+        currency='usd',
+        metadata={
+            'color': variant.color,
+            'storage': variant.storage,
+            'sku': variant.sku
+        }
+    )
+    ProductVariant.objects.filter(pk=variant.pk).update(stripe_price_id=price.id)
+    variant.stripe_price_id = price.id
+    return price.id
+
+
+def _finish_task(task, claimed_at):
+    """
+    Mark a task done unless it was re-requested while we were pushing it, in
+    which case it is made due again so the newer values get synced too
+    """
+    done = StripeSyncTask.objects.filter(id=task.id, requested_at__lte=claimed_at).update(
+        processed_at=timezone.now(), last_error=None
+    )
+    if not done:
+        StripeSyncTask.objects.filter(id=task.id).update(next_attempt_at=timezone.now(), attempts=0)
+
+
+def _fail_task(task, error):
+    """
+    Record a failure and back off exponentially; give up after MAX_ATTEMPTS
+    """
+    attempts = task.attempts + 1
+    updates = {'attempts': attempts, 'last_error': str(error)}
+    if attempts >= MAX_ATTEMPTS:
+        logger.error(f"Giving up on {task} after {attempts} attempts: {error}")
+        updates['processed_at'] = timezone.now()
+    else:
+        delay = min(timedelta(seconds=30 * 2 ** attempts), timedelta(hours=1))
+        updates['next_attempt_at'] = timezone.now() + delay
+    StripeSyncTask.objects.filter(id=task.id).update(**updates)
+
+
+def process_stripe_sync_batch(client=None, batch_size=50):
+    """
+    Push one batch of pending tasks to Stripe. Products go first so variants
+    in the same batch can attach prices to them. Returns the number handled.
+    """
+    client = client or get_stripe_client()
+    tasks, claimed_at = claim_tasks(batch_size)
+    if not tasks:
+        return 0
+
+    product_ids = [task.object_id for task in tasks if task.object_type == 'product']
+    variant_ids = [task.object_id for task in tasks if task.object_type == 'variant']
+    products = Product.objects.in_bulk(product_ids)
+    variants = ProductVariant.objects.select_related('product').in_bulk(variant_ids)
+
+    for task in sorted(tasks, key=lambda task: task.object_type != 'product'):
+        objects = products if task.object_type == 'product' else variants
+        obj = objects.get(task.object_id)
+        try:
+            if obj is None:
+                # Deleted since it was queued; nothing left to sync
+                pass
+            elif task.object_type == 'product':
+                sync_product(obj, client)
+            else:
+                if obj.product_id in products:
+                    # Reuse the instance synced earlier in this batch
+                    obj.product = products[obj.product_id]
+                sync_variant(obj, client)
+            _finish_task(task, claimed_at)
+        except Exception as e:
+            logger.warning(f"Stripe sync failed for {task}: {e}")
+            _fail_task(task, e)
+
+    return len(tasks)
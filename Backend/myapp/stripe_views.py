@@ -3,17 +3,24 @@ import stripe
 import logging
 import os
 from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
-from django.db import transaction
+from rest_framework.permissions import AllowAny, IsAdminUser
 from django.utils import timezone
-from datetime import timedelta
 from rest_framework import status
 
-from .models import Product, ProductVariant, InventoryReservation
+from .models import Product, InventoryReservation
+from .inventory import (
+    RESERVATION_TTL, reserve_items, release_session_reservations,
+    new_reservation_token, bind_reservations, check_availability
+)
+from .webhooks import dispatch, handler_metrics, prepare
+from .webhook_events import (
+    claim_webhook_event, complete_webhook_event, fail_webhook_event, webhook_queue_metrics
+)
 
 # Configure Stripe
 stripe.api_key = settings.STRIPE_SECRET_KEY
@@ -26,6 +33,14 @@ logger.info("Stripe API configuration initialized")
 if not settings.STRIPE_SECRET_KEY:
     logger.warning("Stripe API key not found in settings, checking environment variables")
 
+def availability_error(variant, result):
+    """
+    Customer-facing message for a failed check_availability() result
+    """
+    if 'insufficient_stock' in result['problems']:
+        return f"Not enough stock for {variant.product.name}. Only {max(result['available'], 0)} available"
+    return f"You can buy at most {result['max_purchase_quantity']} of {variant.product.name}"
+
 @csrf_exempt
 @require_POST
 @api_view(['POST'])
@@ -33,7 +48,8 @@ if not settings.STRIPE_SECRET_KEY:
 def create_checkout_session(request):
     """
     Create a Stripe checkout session for the items in the cart
-    No inventory reservations are made - stock is only reduced when payment is confirmed
+    Stock is reserved first under a provisional token, the Stripe session is
+    created with no row locks held, then the reservation is bound to it
     """
     try:
         # Ensure Stripe API key is set
@@ -72,37 +88,43 @@ def create_checkout_session(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
        
-        # Prepare line items for checkout
-        line_items = []
-        
-        # Process each item in the cart
+        # Collapse the cart into {variant_id: quantity}
+        quantities = {}
         for item in cart_items:
             variant_id = item.get('variant_id')
             quantity = int(item.get('quantity', 1))
             
-            # Log the variant_id for debugging
-            logger.info(f"Processing cart item with variant_id: {variant_id}, type: {type(variant_id)}")
-            
-            # Get the variant
-            try:
-                # Try to convert variant_id to int if it's a string
-                if isinstance(variant_id, str) and variant_id.isdigit():
-                    variant_id = int(variant_id)
-                
-                variant = ProductVariant.objects.get(id=variant_id)
-                logger.info(f"Found variant: {variant.id} - {variant.product.name}")
-            except ProductVariant.DoesNotExist:
+            # Try to convert variant_id to int if it's a string
+            if isinstance(variant_id, str) and variant_id.isdigit():
+                variant_id = int(variant_id)
+            if not variant_id or quantity <= 0:
+                continue
+            quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+        
+        # Load every variant with its product and check stock and purchase
+        # limits in one query (just for validation; the reservation is authoritative)
+        variants, results = check_availability(quantities.items())
+        for result in results:
+            if 'not_found' in result['problems']:
                 return JsonResponse(
-                    {'error': f'Variant with ID {variant_id} not found'},
+                    {'error': f"Variant with ID {result['variant_id']} not found"},
                     status=status.HTTP_404_NOT_FOUND
                 )
-           
-            # Check if there's enough stock (just for validation)
-            if variant.count_in_stock < quantity:
-                return JsonResponse(
-                    {'error': f'Not enough stock for {variant.product.name}'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+        unavailable = [result for result in results if not result['is_available']]
+        if unavailable:
+            return JsonResponse(
+                {
+                    'error': availability_error(variants[unavailable[0]['variant_id']], unavailable[0]),
+                    'items': unavailable
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Prepare line items for checkout
+        line_items = []
+        
+        for variant_id, quantity in quantities.items():
+            variant = variants[variant_id]
             
             # Add to line items
             if variant.stripe_price_id:
@@ -133,65 +155,62 @@ def create_checkout_session(request):
                     'quantity': quantity,
                 })
         
-        # Create the checkout session with all line items
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=line_items,
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
-                'items': json.dumps([{
-                    'variant_id': item.get('variant_id'),
-                    'quantity': item.get('quantity', 1)
-                } for item in cart_items])
-            }
+        if not line_items:
+            return JsonResponse(
+                {'error': 'No items in cart'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Phase 1: reserve under a provisional token (locks held for one short transaction)
+        token = new_reservation_token()
+        reservations, shortages = reserve_items(
+            quantities, token, timezone.now() + RESERVATION_TTL
         )
+        if shortages:
+            shortage = shortages[0]
+            variant = variants[shortage['variant_id']]
+            return JsonResponse(
+                {
+                    'error': f'Not enough stock for {variant.product.name}',
+                    'available': shortage['available']
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # Reserve inventory for this session
+        # Phase 2: create the checkout session with no locks held
         try:
-            with transaction.atomic():
-                for item in cart_items:
-                    variant_id = item.get('variant_id')
-                    quantity = int(item.get('quantity', 1))
-                    
-                    if not variant_id or quantity <= 0:
-                        continue
-                        
-                    if isinstance(variant_id, str) and variant_id.isdigit():
-                        variant_id = int(variant_id)
-                    
-                    try:
-                        variant = ProductVariant.objects.select_for_update().get(id=variant_id)
-                        
-                        # Check if there's enough available stock
-                        if variant.count_in_stock < quantity:
-                            raise Exception(f'Not enough stock for {variant.product.name}')
-                            
-                        # Create reservation
-                        reservation = InventoryReservation.objects.create(
-                            variant=variant,
-                            quantity=quantity,
-                            session_id=checkout_session.id,
-                            expires_at=timezone.now() + timedelta(minutes=3)  # 10 min reservation
-                        )
-                        
-                        # Update reserved stock
-                        variant.reserved_stock += quantity
-                        variant.save()
-                        
-                        logger.info(f"Reserved {quantity} units of variant {variant.id} for session {checkout_session.id}")
-                        
-                    except ProductVariant.DoesNotExist:
-                        raise Exception(f'Variant with ID {variant_id} not found')
-                        
-        except Exception as e:
-            # If we can't reserve inventory, cancel the checkout session
+            checkout_session = stripe.checkout.Session.create(
+                payment_method_types=['card'],
+                line_items=line_items,
+                mode='payment',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                metadata={
+                    'items': json.dumps([{
+                        'variant_id': variant_id,
+                        'quantity': quantity
+                    } for variant_id, quantity in quantities.items()]),
+                    'reservation_token': token
+                }
+            )
+        except Exception:
+            # Compensate: give the provisional hold back straight away
+            release_session_reservations(token, notes="Checkout session could not be created")
+            raise
+        
+        # Phase 3: bind the hold to the session
+        if not bind_reservations(token, checkout_session.id):
+            # The hold expired while Stripe was answering
             try:
                 stripe.checkout.Session.expire(checkout_session.id)
             except Exception:
                 pass
-            raise e
+            return JsonResponse(
+                {'error': 'Reservation expired, please try again'},
+                status=status.HTTP_409_CONFLICT
+            )
+        
+        logger.info(f"Reserved {len(reservations)} variants for session {checkout_session.id}")
         
         logger.info(f"Created checkout session: {checkout_session.id}")
         
@@ -289,30 +308,43 @@ def create_buy_now_session(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
        
-        # Get the variant
-        try:
-            logger.info(f"Looking up variant with ID: {variant_id}")
-            variant = ProductVariant.objects.get(id=variant_id)
-            logger.info(f"Found variant: {variant.id} - {variant.product.name} - {variant.color} - {variant.storage}")
-        except ProductVariant.DoesNotExist:
+        # Get the variant and check its stock and purchase limit in one query
+        logger.info(f"Looking up variant with ID: {variant_id}")
+        variants, results = check_availability([(int(variant_id), quantity)])
+        result = results[0]
+        if 'not_found' in result['problems']:
             logger.error(f"Variant with ID {variant_id} not found")
             return JsonResponse(
                 {'error': f'Variant with ID {variant_id} not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        variant = variants[result['variant_id']]
+        logger.info(f"Found variant: {variant.id} - {variant.product.name} - {variant.color} - {variant.storage}")
+        if not result['is_available']:
+            return JsonResponse(
+                {
+                    'error': availability_error(variant, result),
+                    'available': result['available'],
+                    'max_purchase_quantity': result['max_purchase_quantity']
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
        
-        # Check if there's enough available stock (total - reserved)
-        available_stock = variant.count_in_stock - variant.reserved_stock
-        if available_stock < quantity:
+        # Phase 1: reserve under a provisional token
+        token = new_reservation_token()
+        reservations, shortages = reserve_items(
+            {variant.id: quantity}, token, timezone.now() + RESERVATION_TTL
+        )
+        if shortages:
             return JsonResponse(
                 {
-                    'error': f'Not enough stock for {variant.product.name}. Only {available_stock} available',
-                    'available': available_stock
+                    'error': f'Not enough stock for {variant.product.name}',
+                    'available': shortages[0]['available']
                 },
                 status=status.HTTP_400_BAD_REQUEST
             )
        
-        # Create a checkout session
+        # Phase 2: create the checkout session with no locks held
         try:
             line_items = []
             
@@ -349,38 +381,31 @@ def create_buy_now_session(request):
                 cancel_url=cancel_url,
                 metadata={
                     'variant_id': str(variant_id),
-                    'quantity': str(quantity)
+                    'quantity': str(quantity),
+                    'reservation_token': token
                 }
             )
         except Exception as e:
             logger.error(f"Error creating checkout session: {str(e)}")
+            # Compensate: give the provisional hold back straight away
+            release_session_reservations(token, notes="Checkout session could not be created")
             return JsonResponse(
                 {'error': str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
        
-        # Create a reservation
-        with transaction.atomic():
-            session_id = checkout_session.id
-            expires_at = timezone.now() + timedelta(minutes=3)  # 5-minute reservation
-           
-            # Create a reservation record but don't actually reduce available inventory
-            # This is just to track the intent to purchase
-            reservation = InventoryReservation.objects.create(
-                variant=variant,
-                quantity=quantity,
-                session_id=session_id,
-                expires_at=expires_at,
-                is_active=True
+        # Phase 3: bind the hold to the session
+        if not bind_reservations(token, checkout_session.id):
+            try:
+                stripe.checkout.Session.expire(checkout_session.id)
+            except Exception:
+                pass
+            return JsonResponse(
+                {'error': 'Reservation expired, please try again'},
+                status=status.HTTP_409_CONFLICT
             )
-           
-            # Update reserved_stock to reflect the new reservation
-            # count_in_stock remains the same until payment is confirmed
-            variant.reserved_stock += quantity
-            variant.save()
-            
-            # Log the reservation
-            logger.info(f"Created reservation for session {session_id}, variant {variant.id}, quantity {quantity}")
+        
+        logger.info(f"Created reservation for session {checkout_session.id}, variant {variant.id}, quantity {quantity}")
         
         return JsonResponse({
             'id': checkout_session.id,
@@ -455,113 +480,40 @@ def stripe_webhook(request):
         logger.error(f"Invalid signature: {str(e)}")
         return JsonResponse({'error': 'Invalid signature'}, status=400)
 
-    # Handle the checkout.session.completed event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        # Get the session ID and metadata
-        session_id = session.id
-        
-        logger.info(f"Processing successful payment for session: {session_id}")
-        
-        # Get the items from the session metadata
-        try:
-            items_json = session.get('metadata', {}).get('items', '[]')
-            items = json.loads(items_json)
-            logger.info(f"Items from metadata: {items}")
-            
-            # If no items in metadata, try to get them from the line items
-            if not items and hasattr(session, 'line_items'):
-                items = []
-                for item in session.line_items.data:
-                    if 'price' in item and 'product' in item.price:
-                        variant_id = item.price.product.metadata.get('variant_id')
-                        if variant_id:
-                            items.append({
-                                'variant_id': variant_id,
-                                'quantity': item.quantity
-                            })
-            
-            # Update inventory in a transaction
-            with transaction.atomic():
-                for item in items:
-                    variant_id = item.get('variant_id')
-                    quantity = int(item.get('quantity', 1))
-                    
-                    # Skip if variant_id or quantity is invalid
-                    if not variant_id or quantity <= 0:
-                        continue
-                    
-                    # Convert variant_id to int if it's a string
-                    if isinstance(variant_id, str) and variant_id.isdigit():
-                        variant_id = int(variant_id)
-                    
-                    try:
-                        # Get the variant and update inventory
-                        variant = ProductVariant.objects.select_for_update().get(id=variant_id)
-                        
-                        # Only reduce inventory if there's enough stock
-                        if variant.count_in_stock >= quantity:
-                            # Update inventory count - ONLY on successful payment
-                            variant.count_in_stock -= quantity
-                            variant.save()
-                            
-                            logger.info(f"Updated inventory for variant {variant.id}: "
-                                      f"count_in_stock={variant.count_in_stock}")
-                        else:
-                            logger.warning(f"Not enough stock for variant {variant.id}: "
-                                         f"requested={quantity}, available={variant.count_in_stock}")
-                    except ProductVariant.DoesNotExist:
-                        logger.error(f"Variant with ID {variant_id} not found")
-                
-                return JsonResponse({'status': 'payment_processed'})
-        except Exception as e:
-            logger.error(f"Error processing payment: {str(e)}")
-            return JsonResponse({'error': str(e)}, status=500)
-    
-    # Handle the checkout.session.expired and checkout.session.canceled events
-    elif event['type'] in ['checkout.session.expired', 'checkout.session.canceled']:
-        session = event['data']['object']
-        session_id = session.id
-        
-        logger.info(f"Processing {event['type']} event for session: {session_id}")
-        
+    event_id = event.get('id')
+    if event_id and settings.STRIPE_WEBHOOK_ASYNC:
+        # Record the delivery and acknowledge straight away; process_webhooks workers apply it.
+        # A replay stops here after one indexed insert
+        if not claim_webhook_event(event, payload):
+            logger.info(f"Skipping duplicate webhook event {event_id}")
+            return JsonResponse({'status': 'duplicate'})
+        return JsonResponse({'status': 'queued'})
+
+    try:
+        # Stripe API lookups happen here, before the event row is locked
+        prepare(event)
+    except Exception as e:
+        logger.error(f"Error preparing {event['type']} event: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+    # Record the delivery, apply it and mark it processed in one transaction: a
+    # crash rolls all of it back for Stripe's retry, and a concurrent
+    # redelivery waits on the event row and then finds it processed
+    with transaction.atomic():
+        if event_id and not claim_webhook_event(event, payload, process_now=True):
+            logger.info(f"Skipping duplicate webhook event {event_id}")
+            return JsonResponse({'status': 'duplicate'})
         try:
             with transaction.atomic():
-                # Get all active reservations for this session
-                reservations = InventoryReservation.objects.filter(
-                    session_id=session_id,
-                    is_active=True
-                ).select_for_update()
-                
-                if not reservations.exists():
-                    logger.info(f"No active reservations to release for session {session_id}")
-                    return JsonResponse({'status': 'no_reservations_found'})
-                
-                # Process each reservation
-                for reservation in reservations:
-                    variant = reservation.variant
-                    
-                    # Mark reservation as canceled
-                    reservation.is_active = False
-                    reservation.canceled_at = timezone.now()
-                    reservation.save()
-                    
-                    # Release the reserved stock
-                    variant.reserved_stock = max(0, variant.reserved_stock - reservation.quantity)
-                    variant.save()
-                    
-                    logger.info(f"Released {reservation.quantity} units of variant {variant.id} "
-                               f"from canceled/expired session {session_id}")
-                
-                return JsonResponse({'status': 'reservations_released'})
-                
+                outcome = dispatch(event)
         except Exception as e:
             logger.error(f"Error processing {event['type']} event: {str(e)}")
+            if event_id:
+                fail_webhook_event(event_id, e)
             return JsonResponse({'error': str(e)}, status=500)
-    
-    # Return a 200 response to acknowledge receipt of the event
-    return JsonResponse({'status': 'received'})
+        if event_id:
+            complete_webhook_event(event_id, outcome)
+    return JsonResponse({'status': outcome})
 
 
 @csrf_exempt
@@ -584,45 +536,19 @@ def release_checkout_reservation(request):
         
         logger.info(f"Releasing reservations for session: {session_id}")
         
-        # Release reserved inventory in a transaction
-        with transaction.atomic():
-            # Get all active reservations for this session
-            reservations = InventoryReservation.objects.filter(
-                session_id=session_id,
-                is_active=True
-            ).select_for_update()
-            
-            if not reservations.exists():
-                logger.info(f"No active reservations found for session {session_id}")
-                return JsonResponse({'status': 'no_reservations_found'})
-            
-            # Release each reservation
-            for reservation in reservations:
-                variant = reservation.variant
-                
-                # Log before state
-                logger.info(f"Before release - Variant {variant.id}: count_in_stock={variant.count_in_stock}, "
-                          f"reserved_stock={variant.reserved_stock}")
-                
-                # Mark reservation as canceled
-                reservation.is_active = False
-                reservation.canceled_at = timezone.now()
-                reservation.save()
-                
-                # Release the reserved stock
-                variant.reserved_stock = max(0, variant.reserved_stock - reservation.quantity)
-                variant.save()
-                
-                # Log after state
-                logger.info(f"After release - Variant {variant.id}: count_in_stock={variant.count_in_stock}, "
-                          f"reserved_stock={variant.reserved_stock}")
-            
-            logger.info(f"Successfully released {reservations.count()} reservations for session {session_id}")
-            return JsonResponse({
-                'status': 'success',
-                'message': f'Released {reservations.count()} reservations',
-                'reservations_released': reservations.count()
-            })
+        # Cancel the session's active reservations and release their stock
+        reservations = release_session_reservations(session_id, notes="Checkout canceled")
+        
+        if not reservations:
+            logger.info(f"No active reservations found for session {session_id}")
+            return JsonResponse({'status': 'no_reservations_found'})
+        
+        logger.info(f"Successfully released {len(reservations)} reservations for session {session_id}")
+        return JsonResponse({
+            'status': 'success',
+            'message': f'Released {len(reservations)} reservations',
+            'reservations_released': len(reservations)
+        })
             
     except json.JSONDecodeError:
         return JsonResponse(
@@ -700,3 +626,15 @@ def debug_inventory_reservation(request):
             {'error': str(e)},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def webhook_queue_status(request):
+    """
+    Webhook queue depth and lag for monitoring
+    """
+    try:
+        return JsonResponse({**webhook_queue_metrics(), 'handlers': handler_metrics()})
+    except Exception as e:
+        logger.error(f"Error reading webhook queue metrics: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
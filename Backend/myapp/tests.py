@@ -1,3 +1,1302 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from itertools import count
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .catalog_cache import get_catalog_version
+from .checks import check_reservation_engine
+from .inventory import (
+    RESERVATION_TTL, StockCommitError, reserve_stock, release_stock, commit_stock, deduct_stock,
+    reserve_items_locked, commit_session_reservations, expire_reservations,
+    new_reservation_token, bind_reservations, apply_stock_updates, reserve_items, release_session_reservations
+)
+from .ledger import ensure_ledger_partitions, prune_snapshots, reconcile_inventory, take_inventory_snapshot
+from .management.commands.run_reservation_expiry import Command as ExpiryCommand
+from .models import (
+    Product, ProductVariant, Cart, CartItem, StripeSyncTask, InventoryChange, InventoryReservation,
+    InventorySnapshot, WebhookEvent
+)
+from .reservation_engine import (
+    InProcessCounterStore, flush as engine_flush, get_store, recover_inflight, reset_store, restore_counters,
+    sync_counters
+)
+from .serializers import CartSerializer
+from .stock_stream import broadcaster
+from .stripe_sync import process_stripe_sync_batch
+from .webhook_events import claim_webhook_event, claim_webhook_events, process_webhook_event
+from .webhooks import HANDLERS, handler_metrics, reset_handler_metrics
+
+
+class FakeStripe:
+    """
+    In-memory stand-in for the parts of the stripe module the sync worker uses
+    """
+    def __init__(self):
+        ids = count(1)
+        self.calls = []
+        self.prices = {}
+        fake = self
+
+        class Product:
+            @staticmethod
+            def create(**kwargs):
+                fake.calls.append(('Product.create', kwargs))
+                return SimpleNamespace(id=f"prod_{next(ids)}")
+
+            @staticmethod
+            def modify(stripe_id, **kwargs):
+                fake.calls.append(('Product.modify', stripe_id))
+                return SimpleNamespace(id=stripe_id)
+
+        class Price:
+            @staticmethod
+            def create(**kwargs):
+                fake.calls.append(('Price.create', kwargs))
+                price = SimpleNamespace(id=f"price_{next(ids)}", unit_amount=kwargs['unit_amount'])
+                fake.prices[price.id] = price
+                return price
+
+            @staticmethod
+            def retrieve(price_id):
+                fake.calls.append(('Price.retrieve', price_id))
+                return fake.prices[price_id]
+
+        self.Product = Product
+        self.Price = Price
+
+
+class CatalogFixturesMixin:
+    """
+    Builds products and variants; saves only queue Stripe syncs, so nothing
+    here talks to Stripe
+    """
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client = APIClient()
+
+    def create_product(self, name='Pixel 8', variants=1):
+        product = Product.objects.create(
+            name=name, brand='Google', category='Phones',
+            base_price='699.00', base_image='products/Pixel8.png'
+        )
+        for index in range(variants):
+            ProductVariant.objects.create(
+                product=product, color=f"Color {index}", storage='128GB',
+                price='699.00', count_in_stock=10
+            )
+        return product
+
+
+class QueryCountTests(CatalogFixturesMixin, TestCase):
+    """
+    Each endpoint must be served by a fixed number of queries, however many
+    variants or cart items are involved
+    """
+    def test_product_detail_query_count(self):
+        for variants in (1, 5):
+            product = self.create_product(name=f"Phone {variants}", variants=variants)
+            cache.clear()
+            # Product row + prefetched variants
+            with self.assertNumQueries(2):
+                response = self.client.get(reverse('get_product_detail', args=[product.id]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['variants']), variants)
+
+    def test_product_by_slug_query_count(self):
+        product = self.create_product(variants=4)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('get_product_by_slug', args=[product.slug]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_cart_query_count(self):
+        user = User.objects.create_user(username='shopper', password='pass12345')
+        cart = Cart.objects.create(user=user)
+        self.client.force_authenticate(user=user)
+
+        for items in (1, 5):
+            product = self.create_product(name=f"Cart phone {items}", variants=items)
+            for variant in product.variants.all():
+                CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=1)
+            # Direct item writes cleared the snapshot: cart row, items joined
+            # with products and variants, snapshot write
+            with self.assertNumQueries(3):
+                response = self.client.get(reverse('get_cart'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['total_items'], cart.items.count())
+            # Then the cart row alone
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse('get_cart'))
+            self.assertEqual(response.data['total_items'], cart.items.count())
+
+
+class CatalogCacheTests(CatalogFixturesMixin, TestCase):
+    """
+    Catalog responses are read through the cache and retired only by
+    committed saves
+    """
+    def test_second_request_is_served_from_cache(self):
+        self.create_product(variants=2)
+        with CaptureQueriesContext(connection) as miss:
+            first = self.client.get(reverse('get_products'))
+        self.assertGreater(len(miss.captured_queries), 0)
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('get_products'))
+        self.assertEqual(first.data, second.data)
+
+    def test_query_params_are_part_of_the_key(self):
+        self.create_product(name='Pixel 8')
+        self.client.get(reverse('get_products'), {'brand': 'Google'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('get_products'), {'brand': 'Apple'})
+        self.assertGreater(len(queries.captured_queries), 0)
+        self.assertEqual(response.data['results'], [])
+
+    def test_committed_save_invalidates(self):
+        product = self.create_product()
+        self.assertEqual(self.client.get(reverse('get_brands')).data, ['Google'])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.brand = 'Apple'
+            product.save()
+        self.assertEqual(self.client.get(reverse('get_brands')).data, ['Apple'])
+
+    def test_version_is_not_bumped_before_commit(self):
+        product = self.create_product()
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            product.save()
+            self.assertEqual(get_catalog_version(), version)
+        self.assertTrue(callbacks)
+
+
+class CursorPaginationTests(CatalogFixturesMixin, TestCase):
+    """
+    ?pagination=cursor walks every product exactly once, newest first
+    """
+    def walk(self, params):
+        seen = []
+        response = self.client.get(reverse('get_products'), params)
+        while True:
+            self.assertNotIn('count', response.data)
+            seen += [product['id'] for product in response.data['results']]
+            if not response.data['next']:
+                return seen
+            response = self.client.get(response.data['next'])
+
+    def test_pages_follow_created_order(self):
+        products = [self.create_product(name=f"Phone {index}", variants=0) for index in range(5)]
+        seen = self.walk({'pagination': 'cursor', 'page_size': 2})
+        self.assertEqual(seen, [product.id for product in reversed(products)])
+
+    def test_equal_timestamps_are_neither_skipped_nor_repeated(self):
+        products = [self.create_product(name=f"Phone {index}", variants=0) for index in range(5)]
+        Product.objects.update(createdAt=products[0].createdAt)
+        seen = self.walk({'pagination': 'cursor', 'page_size': 2})
+        # Ties fall back to -id
+        self.assertEqual(seen, sorted((product.id for product in products), reverse=True))
+
+
+class ProductSearchTests(CatalogFixturesMixin, TestCase):
+    """
+    The generated search vector is written by the same statement as the row
+    """
+    def search(self, text):
+        response = self.client.get(reverse('get_products'), {'search': text})
+        return [product['name'] for product in response.data['results']]
+
+    def test_prefix_search_ranks_name_matches_first(self):
+        self.create_product(name='Galaxy S24', variants=0)
+        other = self.create_product(name='Phone Case', variants=0)
+        other.description = 'Fits the Galaxy S24'
+        other.save()
+        self.assertEqual(self.search('gal s2'), ['Galaxy S24', 'Phone Case'])
+        self.assertEqual(self.search('%&|!'), [])
+
+    def test_vector_follows_updates(self):
+        product = self.create_product(name='Pixel 8', variants=0)
+        self.assertEqual(self.search('pixel 8'), ['Pixel 8'])
+        product.name = 'Pixel 9'
+        product.save()
+        # The catalog version only moves on commit, which TestCase never does
+        cache.clear()
+        self.assertEqual(self.search('pixel 9'), ['Pixel 9'])
+        self.assertEqual(self.search('pixel 8'), [])
+
+
+class ProductFilterTests(CatalogFixturesMixin, TestCase):
+    """
+    List filters and the facet counts computed over the same filters
+    """
+    def setUp(self):
+        super().setUp()
+        for name, brand, price in (('Budget', 'Moto', 199), ('Mid', 'Google', 500), ('Flagship', 'Google', 999)):
+            product = self.create_product(name=name, variants=2)
+            Product.objects.filter(pk=product.pk).update(brand=brand, base_price=price)
+
+    def names(self, **params):
+        response = self.client.get(reverse('get_products'), params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(product['name'] for product in response.data['results'])
+
+    def test_price_bounds_are_inclusive(self):
+        self.assertEqual(self.names(min_price='500', max_price='999'), ['Flagship', 'Mid'])
+        self.assertEqual(self.names(max_price='500'), ['Budget', 'Mid'])
+
+    def test_malformed_price_is_a_client_error(self):
+        for params in ({'min_price': 'cheap'}, {'max_price': 'NaN'}, {'min_price': '-1'}):
+            self.assertEqual(self.client.get(reverse('get_products'), params).status_code, 400)
+            self.assertEqual(
+                self.client.get(reverse('search_products_with_facets'), params).status_code, 400
+            )
+
+    def test_facets_count_the_filtered_products(self):
+        response = self.client.get(reverse('search_products_with_facets'), {'brand': 'google'})
+        facets = response.data['facets']
+        self.assertEqual(facets['brand'], {'Google': 2})
+        # Each product counts once per color, whatever its number of variants
+        self.assertEqual(facets['color'], {'Color 0': 2, 'Color 1': 2})
+        self.assertEqual(
+            {bucket['range']: bucket['count'] for bucket in facets['price']},
+            {'0-199': 0, '200-499': 0, '500-999': 2, '1000+': 0}
+        )
+
+    def test_in_stock_filter_follows_sales_without_a_catalog_save(self):
+        ProductVariant.objects.filter(product__name='Budget').update(count_in_stock=0)
+        self.assertEqual(self.names(in_stock='true'), ['Flagship', 'Mid'])
+        self.assertEqual(self.names(in_stock='false'), ['Budget'])
+
+        # Sell out Mid through the inventory service; no catalog version bump
+        for variant in ProductVariant.objects.filter(product__name='Mid'):
+            deduct_stock(variant.id, 10)
+        self.assertEqual(self.names(in_stock='true'), ['Flagship'])
+        response = self.client.get(reverse('search_products_with_facets'), {'in_stock': 'true'})
+        self.assertEqual([product['name'] for product in response.data['results']], ['Flagship'])
+
+        # Reserved units don't count as in stock either
+        for variant in ProductVariant.objects.filter(product__name='Flagship'):
+            reserve_stock(variant.id, 10)
+        self.assertEqual(self.names(in_stock='true'), [])
+
+
+class VariantStockColumnTests(CatalogFixturesMixin, TestCase):
+    """
+    available_stock is generated by the database, and CHECK constraints keep
+    reserved_stock between 0 and count_in_stock
+    """
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+
+    def test_available_stock_is_generated(self):
+        ProductVariant.objects.filter(pk=self.variant.pk).update(reserved_stock=F('reserved_stock') + 4)
+        self.assertEqual(ProductVariant.objects.get(pk=self.variant.pk).available_stock, 6)
+        self.variant.refresh_from_db()
+        self.variant.count_in_stock = 7
+        self.variant.save()
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.available_stock, 3)
+        self.assertEqual(ProductVariant.objects.filter(available_stock=3).count(), 1)
+
+    def test_constraints_reject_impossible_counts(self):
+        for update in ({'reserved_stock': 11}, {'reserved_stock': -1}, {'count_in_stock': -1}):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                ProductVariant.objects.filter(pk=self.variant.pk).update(**update)
+        self.variant.refresh_from_db()
+        self.assertEqual((self.variant.count_in_stock, self.variant.reserved_stock), (10, 0))
+
+
+class CartTests(CatalogFixturesMixin, TestCase):
+    """
+    Cart mutations keep the stored snapshot in step with the items
+    """
+    def test_cart_mutations_keep_snapshot_current(self):
+        user = User.objects.create_user(username='snapshot', password='pass12345')
+        self.client.force_authenticate(user=user)
+        product = self.create_product(variants=2)
+        first, second = product.variants.order_by('id')
+
+        self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': first.id, 'quantity': 2})
+        response = self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': second.id})
+        self.assertEqual(response.data['total_items'], 3)
+        self.assertEqual(response.data['total_price'], 3 * 699.0)
+
+        item = CartItem.objects.get(variant=second)
+        response = self.client.post(reverse('update_cart_item', args=[item.id]), {'quantity': 4})
+        self.assertEqual(response.data['total_items'], 6)
+        response = self.client.delete(reverse('remove_from_cart', args=[item.id]))
+        self.assertEqual([line['variant'] for line in response.data['items']], [first.id])
+
+        # The stored snapshot matches a rebuild from the items
+        cart = Cart.objects.get(user=user)
+        expected = CartSerializer(cart).data
+        self.assertEqual(cart.snapshot['total_items'], expected['total_items'])
+        self.assertEqual(Decimal(str(cart.snapshot['total_price'])), expected['total_price'])
+        self.assertEqual(
+            [(line['id'], line['quantity']) for line in cart.snapshot['items']],
+            [(line['id'], line['quantity']) for line in expected['items']]
+        )
+
+    def test_patch_cart_applies_operations_in_one_batch(self):
+        user = User.objects.create_user(username='batcher', password='pass12345')
+        self.client.force_authenticate(user=user)
+        product = self.create_product(variants=3)
+        first, second, third = product.variants.order_by('id')
+        self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': first.id})
+        item = CartItem.objects.get(variant=first)
+
+        response = self.client.patch(reverse('get_cart'), {'operations': [
+            {'op': 'add', 'variant_id': second.id, 'quantity': 2},
+            {'op': 'add', 'variant_id': second.id},
+            {'op': 'set', 'variant_id': third.id, 'quantity': 4},
+            {'op': 'remove', 'item_id': item.id},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(line['variant'], line['quantity']) for line in response.data['items']],
+            [(second.id, 3), (third.id, 4)]
+        )
+        self.assertEqual(response.data['total_items'], 7)
+        self.assertEqual(CartItem.objects.filter(cart__user=user).count(), 2)
+
+        # A shortage on any line rejects the whole batch
+        response = self.client.patch(reverse('get_cart'), {'operations': [
+            {'op': 'remove', 'variant_id': second.id},
+            {'op': 'set', 'variant_id': third.id, 'quantity': 11},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['shortages'][0]['variant_id'], third.id)
+        self.assertEqual(CartItem.objects.filter(cart__user=user).count(), 2)
+
+    def test_patch_cart_enforces_the_purchase_limit(self):
+        user = User.objects.create_user(username='bulkbuyer', password='pass12345')
+        self.client.force_authenticate(user=user)
+        product = self.create_product(variants=1)
+        variant = product.variants.get()
+        ProductVariant.objects.filter(id=variant.id).update(max_purchase_quantity=3)
+        operations = {'operations': [{'op': 'set', 'variant_id': variant.id, 'quantity': 4}]}
+
+        response = self.client.patch(reverse('get_cart'), operations, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['shortages'][0]['problems'], ['over_purchase_limit'])
+        self.assertFalse(CartItem.objects.filter(variant=variant).exists())
+
+        self.client.force_authenticate(user=None)
+        with self.settings(GUEST_CART_STORAGE='cookie'):
+            response = self.client.patch(reverse('get_cart'), operations, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['shortages'][0]['problems'], ['over_purchase_limit'])
+
+    def test_add_checks_the_resulting_line_quantity(self):
+        user = User.objects.create_user(username='repeater', password='pass12345')
+        self.client.force_authenticate(user=user)
+        product = self.create_product(variants=1)
+        variant = product.variants.get()
+
+        data = {'product_id': product.id, 'variant_id': variant.id, 'quantity': 6}
+        self.assertEqual(self.client.post(reverse('add_to_cart'), data).status_code, 200)
+        response = self.client.post(reverse('add_to_cart'), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['requested'], 12)
+        self.assertEqual(CartItem.objects.get(variant=variant).quantity, 6)
+        self.assertEqual(Cart.objects.get(user=user).snapshot['total_items'], 6)
+
+        data['quantity'] = 0
+        self.assertEqual(self.client.post(reverse('add_to_cart'), data).status_code, 400)
+
+    def test_update_enforces_the_purchase_limit(self):
+        user = User.objects.create_user(username='updater', password='pass12345')
+        self.client.force_authenticate(user=user)
+        product = self.create_product(variants=1)
+        variant = product.variants.get()
+        self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': variant.id, 'quantity': 2})
+        item = CartItem.objects.get(variant=variant)
+        ProductVariant.objects.filter(id=variant.id).update(max_purchase_quantity=3)
+
+        response = self.client.post(reverse('update_cart_item', args=[item.id]), {'quantity': 4})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['problems'], ['over_purchase_limit'])
+        self.assertEqual(CartItem.objects.get(id=item.id).quantity, 2)
+
+        # Shrinking a line is always allowed
+        ProductVariant.objects.filter(id=variant.id).update(max_purchase_quantity=1)
+        response = self.client.post(reverse('update_cart_item', args=[item.id]), {'quantity': 1})
+        self.assertEqual(response.status_code, 200)
+
+        self.client.force_authenticate(user=None)
+        with self.settings(GUEST_CART_STORAGE='cookie'):
+            self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': variant.id})
+            line = self.client.get(reverse('get_cart')).data['items'][0]
+            response = self.client.post(reverse('update_cart_item', args=[line['id']]), {'quantity': 2})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['problems'], ['over_purchase_limit'])
+
+    @override_settings(GUEST_CART_STORAGE='cookie')
+    def test_guest_add_checks_the_resulting_line_quantity(self):
+        product = self.create_product(variants=1)
+        variant = product.variants.get()
+
+        data = {'product_id': product.id, 'variant_id': variant.id, 'quantity': 6}
+        self.client.post(reverse('add_to_cart'), data)
+        response = self.client.post(reverse('add_to_cart'), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('get_cart')).data['total_items'], 6)
+
+    def test_catalog_edits_clear_the_snapshots_that_copy_them(self):
+        user = User.objects.create_user(username='repricer', password='pass12345')
+        self.client.force_authenticate(user=user)
+        product = self.create_product(variants=1)
+        variant = product.variants.get()
+        other = self.create_product(name='Pixel 9')
+        self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': variant.id})
+        cart = Cart.objects.get(user=user)
+
+        other.name = 'Pixel 9 Pro'
+        other.save()
+        self.assertIsNotNone(Cart.objects.get(pk=cart.pk).snapshot)
+
+        variant.price = '649.00'
+        variant.save()
+        self.assertIsNone(Cart.objects.get(pk=cart.pk).snapshot)
+        self.assertEqual(self.client.get(reverse('get_cart')).data['items'][0]['price'], 649.0)
+
+        product.name = 'Pixel 8a'
+        product.save()
+        self.assertEqual(self.client.get(reverse('get_cart')).data['items'][0]['product_name'], 'Pixel 8a')
+
+    def test_merge_adds_quantities_and_clamps_to_purchase_limit(self):
+        user = User.objects.create_user(username='merger', password='pass12345')
+        product = self.create_product(variants=2)
+        first, second = product.variants.order_by('id')
+        accessory = self.create_product(name='Case', variants=0)
+
+        user_cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=user_cart, product=product, variant=first, quantity=6)
+        CartItem.objects.create(cart=user_cart, product=accessory, quantity=1)
+        guest_cart = Cart.objects.create(session_id='guest-session')
+        CartItem.objects.create(cart=guest_cart, product=product, variant=first, quantity=8)
+        CartItem.objects.create(cart=guest_cart, product=product, variant=second, quantity=2)
+        CartItem.objects.create(cart=guest_cart, product=accessory, quantity=2)
+
+        self.client.force_authenticate(user=user)
+        self.client.cookies['cart_session_id'] = 'guest-session'
+        response = self.client.post(reverse('merge_carts'))
+        self.assertEqual(response.status_code, 200)
+        quantities = {
+            (item.product_id, item.variant_id): item.quantity
+            for item in CartItem.objects.filter(cart=user_cart)
+        }
+        self.assertEqual(quantities, {
+            (product.id, first.id): first.max_purchase_quantity,
+            (product.id, second.id): 2,
+            (accessory.id, None): 3,
+        })
+        self.assertEqual(response.data['total_items'], first.max_purchase_quantity + 5)
+        self.assertFalse(Cart.objects.filter(session_id='guest-session').exists())
+
+    def test_validate_cart_reports_every_problem_in_one_query(self):
+        user = User.objects.create_user(username='validator', password='pass12345')
+        product = self.create_product(variants=2)
+        first, second = product.variants.order_by('id')
+        ProductVariant.objects.filter(id=second.id).update(max_purchase_quantity=2)
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=product, variant=first, quantity=12)
+        CartItem.objects.create(cart=cart, product=product, variant=second, quantity=3)
+        self.client.force_authenticate(user=user)
+        self.client.get(reverse('get_cart'))
+
+        # Cart row (with its snapshot) + one availability query
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('validate_cart'))
+        self.assertFalse(response.data['is_valid'])
+        problems = {item['variant_id']: item['problems'] for item in response.data['invalid_items']}
+        self.assertEqual(problems, {
+            first.id: ['insufficient_stock', 'over_purchase_limit'],
+            second.id: ['over_purchase_limit'],
+        })
+
+    @override_settings(GUEST_CART_STORAGE='cookie')
+    def test_guest_cookie_cart_is_written_only_at_login(self):
+        product = self.create_product(variants=2)
+        first, second = product.variants.order_by('id')
+
+        response = self.client.get(reverse('get_cart'))
+        self.assertEqual(response.data['items'], [])
+        self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': first.id, 'quantity': 2})
+        response = self.client.post(reverse('add_to_cart'), {'product_id': product.id, 'variant_id': second.id})
+        self.assertEqual(response.data['total_items'], 3)
+        line = next(line for line in response.data['items'] if line['variant'] == second.id)
+        response = self.client.delete(reverse('remove_from_cart', args=[line['id']]))
+        self.assertEqual([line['variant'] for line in response.data['items']], [first.id])
+        self.assertFalse(Cart.objects.exists())
+
+        # A tampered cookie is treated as an empty cart
+        cookie = self.client.cookies['guest_cart'].value
+        self.client.cookies['guest_cart'] = cookie[:-2] + 'xx'
+        self.assertEqual(self.client.get(reverse('get_cart')).data['items'], [])
+        self.client.cookies['guest_cart'] = cookie
+
+        user = User.objects.create_user(username='returning', password='pass12345')
+        self.client.force_authenticate(user=user)
+        response = self.client.post(reverse('merge_carts'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(CartItem.objects.filter(cart__user=user).values_list('variant_id', 'quantity')),
+            [(first.id, 2)]
+        )
+        self.assertEqual(response.cookies['guest_cart'].value, '')
+
+
+class InventoryTests(CatalogFixturesMixin, TestCase):
+    """
+    The inventory service: guarded stock moves, each paired with a ledger row
+    """
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+
+    def stock(self):
+        variant = ProductVariant.objects.get(pk=self.variant.pk)
+        return variant.count_in_stock, variant.reserved_stock
+
+    def test_stock_moves_write_the_ledger(self):
+        self.assertTrue(reserve_stock(self.variant.id, 4, 'cs_1'))
+        self.assertTrue(release_stock(self.variant.id, 1, 'cs_1'))
+        self.assertTrue(commit_stock(self.variant.id, 3, 'cs_1'))
+        self.assertTrue(deduct_stock(self.variant.id, 2, 'cs_2'))
+        self.assertEqual(self.stock(), (5, 0))
+        self.assertEqual(
+            list(InventoryChange.objects.filter(variant=self.variant).order_by('id')
+                 .values_list('reason', 'quantity', 'reserved_quantity')),
+            [('reservation', 0, 4), ('release', 0, -1), ('purchase', -3, -3), ('purchase', -2, 0)]
+        )
+
+    def test_moves_that_would_oversell_write_nothing(self):
+        self.assertFalse(reserve_stock(self.variant.id, 11))
+        reserve_stock(self.variant.id, 8)
+        self.assertFalse(deduct_stock(self.variant.id, 3))
+        self.assertEqual(self.stock(), (10, 8))
+        self.assertEqual(InventoryChange.objects.filter(variant=self.variant).count(), 1)
+
+    def test_non_positive_quantities_are_rejected(self):
+        for move in (reserve_stock, release_stock, commit_stock, deduct_stock):
+            for quantity in (0, -5):
+                with self.assertRaises(ValueError):
+                    move(self.variant.id, quantity)
+        self.assertEqual(self.stock(), (10, 0))
+        self.assertFalse(InventoryChange.objects.exists())
+
+    def test_reserve_view_rejects_malformed_items(self):
+        self.client.force_authenticate(user=User.objects.create_user(username='shopper', password='pass12345'))
+        for items in ([{'quantity': 1}], [{'variant_id': 'abc'}], [{'variant_id': self.variant.id, 'quantity': -2}]):
+            response = self.client.post(
+                reverse('reserve_inventory'), {'session_id': 'cs_1', 'items': items}, format='json'
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(InventoryReservation.objects.exists())
+
+    def test_reserve_items_is_all_or_nothing(self):
+        other = self.create_product(name='Pixel 9').variants.get()
+        expires_at = timezone.now() + RESERVATION_TTL
+        reservations, shortages = reserve_items_locked({self.variant.id: 2, other.id: 11, 0: 1}, 'cs_1', expires_at)
+        self.assertEqual(reservations, [])
+        self.assertEqual(shortages, [
+            {'variant_id': 0, 'requested': 1, 'available': None},
+            {'variant_id': other.id, 'requested': 11, 'available': 10},
+        ])
+        self.assertEqual(self.stock(), (10, 0))
+        self.assertFalse(InventoryReservation.objects.exists())
+        self.assertFalse(InventoryChange.objects.exists())
+
+        reservations, shortages = reserve_items_locked({other.id: 1, self.variant.id: 2}, 'cs_1', expires_at)
+        self.assertEqual(shortages, [])
+        self.assertEqual(sorted((r.variant_id, r.quantity) for r in reservations), [(self.variant.id, 2), (other.id, 1)])
+        self.assertEqual(self.stock(), (10, 2))
+
+        with self.assertRaises(ValueError):
+            reserve_items_locked({self.variant.id: 1, other.id: 0}, 'cs_2', expires_at)
+        self.assertEqual(self.stock(), (10, 2))
+
+    def test_reserve_items_locks_variants_in_id_order(self):
+        other = self.create_product(name='Pixel 9').variants.get()
+        with CaptureQueriesContext(connection) as queries:
+            reserve_items_locked({other.id: 1, self.variant.id: 1}, 'cs_1', timezone.now() + RESERVATION_TTL)
+        locking = [query['sql'] for query in queries if 'FOR UPDATE' in query['sql']]
+        self.assertEqual(len(locking), 1)
+        self.assertIn('ORDER BY', locking[0])
+        self.assertIn('"id" ASC', locking[0])
+
+    def test_bind_rekeys_the_hold_and_appends_to_the_ledger(self):
+        token = new_reservation_token()
+        reserve_items_locked({self.variant.id: 2}, token, timezone.now() + RESERVATION_TTL)
+        ledger = list(InventoryChange.objects.values_list('id', 'reference_id'))
+
+        self.assertEqual(bind_reservations(token, 'cs_1'), 1)
+        self.assertEqual(
+            list(InventoryReservation.objects.values_list('session_id', flat=True)), ['cs_1']
+        )
+        # Existing ledger rows are untouched; a zero-quantity row links the token
+        self.assertEqual(list(InventoryChange.objects.filter(id__in=[i for i, _ in ledger])
+                              .values_list('id', 'reference_id')), ledger)
+        link = InventoryChange.objects.get(reference_id='cs_1')
+        self.assertEqual((link.quantity, link.reserved_quantity, link.notes), (0, 0, f"Bound hold {token}"))
+        self.assertEqual(self.stock(), (10, 2))
+
+    def test_bind_ignores_expired_holds(self):
+        token = new_reservation_token()
+        reserve_items_locked({self.variant.id: 2}, token, timezone.now() - timedelta(seconds=1))
+        self.assertEqual(bind_reservations(token, 'cs_1'), 0)
+        self.assertFalse(InventoryReservation.objects.filter(session_id='cs_1').exists())
+        self.assertFalse(InventoryChange.objects.filter(reference_id='cs_1').exists())
+
+    def test_failed_commit_rolls_back_the_whole_session(self):
+        other = self.create_product(name='Pixel 9').variants.get()
+        expires_at = timezone.now() + RESERVATION_TTL
+        reserve_items_locked({self.variant.id: 2}, 'cs_1', expires_at)
+        # A hold larger than the stock on hand can't be committed
+        InventoryReservation.objects.create(variant=other, quantity=50, session_id='cs_1', expires_at=expires_at)
+
+        with self.assertRaises(StockCommitError):
+            commit_session_reservations('cs_1')
+        self.assertEqual(InventoryReservation.objects.filter(session_id='cs_1', is_active=True).count(), 2)
+        self.assertEqual(self.stock(), (10, 2))
+        self.assertFalse(InventoryChange.objects.filter(reason='purchase').exists())
+
+    def test_commit_session_reservations_sells_the_held_units(self):
+        reserve_items_locked({self.variant.id: 3}, 'cs_1', timezone.now() + RESERVATION_TTL)
+        self.assertEqual(len(commit_session_reservations('cs_1', order_id='cs_1')), 1)
+        self.assertEqual(self.stock(), (7, 0))
+        reservation = InventoryReservation.objects.get(session_id='cs_1')
+        self.assertFalse(reservation.is_active)
+        self.assertIsNotNone(reservation.fulfilled_at)
+        # A second commit finds nothing left to sell
+        self.assertEqual(commit_session_reservations('cs_1'), [])
+        self.assertEqual(self.stock(), (7, 0))
+
+    def test_expiry_releases_only_due_reservations(self):
+        other = self.create_product(name='Pixel 9').variants.get()
+        now = timezone.now()
+        reserve_items_locked({self.variant.id: 2, other.id: 1}, 'cs_old', now - timedelta(seconds=1))
+        reserve_items_locked({self.variant.id: 3}, 'cs_older', now - timedelta(minutes=1))
+        reserve_items_locked({self.variant.id: 4}, 'cs_live', now + RESERVATION_TTL)
+
+        self.assertEqual(expire_reservations(now=now, batch_size=2), 3)
+        self.assertEqual(self.stock(), (10, 4))
+        self.assertEqual(ProductVariant.objects.get(pk=other.pk).reserved_stock, 0)
+        self.assertEqual(
+            set(InventoryReservation.objects.filter(is_active=True).values_list('session_id', flat=True)),
+            {'cs_live'}
+        )
+        self.assertTrue(all(
+            reservation.canceled_at for reservation in InventoryReservation.objects.filter(is_active=False)
+        ))
+        # One release row per variant per batch, together undoing the expired holds
+        released = InventoryChange.objects.filter(reason='release', notes='Reservation expired')
+        self.assertEqual(
+            sum(released.filter(variant=self.variant).values_list('reserved_quantity', flat=True)), -5
+        )
+        self.assertEqual(list(released.filter(variant=other).values_list('reserved_quantity', flat=True)), [-1])
+        self.assertEqual(expire_reservations(now=now), 0)
+
+
+class BulkStockUpdateTests(CatalogFixturesMixin, TestCase):
+    """
+    Warehouse feeds: one UPDATE ... FROM (VALUES ...) statement per chunk
+    """
+    def setUp(self):
+        super().setUp()
+        self.first, self.second, self.third = self.create_product(variants=3).variants.order_by('id')
+        reserve_stock(self.third.id, 4)
+
+    def counts(self):
+        return list(ProductVariant.objects.order_by('id').values_list('count_in_stock', flat=True))
+
+    def test_rows_are_merged_and_bad_rows_reported(self):
+        updates = [
+            {'row': 1, 'sku': self.first.sku, 'delta': 5},
+            {'row': 2, 'sku': self.second.sku, 'count': 3},
+            {'row': 3, 'sku': self.first.sku, 'delta': 2},
+            {'row': 4, 'sku': self.second.sku, 'delta': 2},
+            {'row': 5, 'sku': self.third.sku, 'count': 1},
+            {'row': 6, 'sku': 'NO-SUCH-SKU', 'delta': 1},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            applied, errors = apply_stock_updates(updates, notes='Feed 42')
+        self.assertEqual(applied, 2)
+        self.assertEqual(
+            [(error['row'], error['sku']) for error in errors], [(5, self.third.sku), (6, 'NO-SUCH-SKU')]
+        )
+        self.assertEqual(self.counts(), [17, 5, 10])
+        self.assertEqual(len([query for query in queries if 'UPDATE' in query['sql']]), 1)
+        self.assertEqual(
+            sorted(InventoryChange.objects.filter(reason='restock', notes='Feed 42')
+                   .values_list('variant_id', 'quantity')),
+            [(self.first.id, 7), (self.second.id, -5)]
+        )
+
+    def test_each_chunk_is_one_statement(self):
+        updates = [{'row': row, 'sku': variant.sku, 'delta': 1} for row, variant in
+                   enumerate((self.first, self.second, self.third), start=1)]
+        with CaptureQueriesContext(connection) as queries:
+            applied, errors = apply_stock_updates(updates, chunk_size=2)
+        self.assertEqual((applied, errors), (3, []))
+        self.assertEqual(len([query for query in queries if 'UPDATE' in query['sql']]), 2)
+        self.assertEqual(self.counts(), [11, 11, 11])
+
+    def test_unchanged_counts_write_no_ledger_row(self):
+        applied, _ = apply_stock_updates([{'row': 1, 'sku': self.first.sku, 'count': 10}], reason='adjustment')
+        self.assertEqual(applied, 1)
+        self.assertFalse(InventoryChange.objects.filter(reason='adjustment').exists())
+
+    def test_import_command_applies_a_csv_feed(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as feed:
+            feed.write(f"sku,delta,count\n{self.first.sku},3,\n{self.second.sku},,2\n,1,\n{self.third.sku},x,\n")
+        self.addCleanup(os.remove, feed.name)
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_stock', feed.name, '--reason', 'return', stdout=stdout, stderr=stderr)
+        self.assertEqual(self.counts(), [13, 2, 10])
+        self.assertIn('Applied 2 SKUs', stdout.getvalue())
+        self.assertIn('2 rows rejected', stdout.getvalue())
+        self.assertIn('Row 3 (None): sku is required', stderr.getvalue())
+        self.assertIn(f"Row 4 ({self.third.sku}): delta/count must be integers", stderr.getvalue())
+        self.assertEqual(InventoryChange.objects.filter(reason='return').count(), 2)
+
+    def test_import_command_rejects_an_unreadable_feed(self):
+        with self.assertRaises(CommandError):
+            call_command('import_stock', '/nonexistent/feed.json')
+
+    def test_bulk_update_view_accepts_csv(self):
+        admin = User.objects.create_user(username='warehouse', password='pass12345', is_staff=True)
+        self.client.force_authenticate(user=admin)
+        response = self.client.generic(
+            'POST', reverse('bulk_update_stock') + '?reason=adjustment',
+            f"sku,delta,count\n{self.first.sku},-2,\n", content_type='text/csv'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['received'], response.data['applied']), (1, 1))
+        self.assertEqual(self.counts(), [8, 10, 10])
+
+
+class LedgerTests(CatalogFixturesMixin, TestCase):
+    """
+    Ledger partitions, snapshots and reconciliation against the live counters
+    """
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+
+    def test_partition_takes_over_rows_from_the_default_partition(self):
+        table = InventoryChange._meta.db_table
+        now = timezone.now()
+        month = now.replace(year=now.year + (now.month + 4) // 12, month=(now.month + 4) % 12 + 1, day=15)
+        change = InventoryChange.objects.create(variant=self.variant, quantity=1, reason='restock')
+        # Moves the row to the default partition: no partition covers that month yet
+        InventoryChange.objects.filter(pk=change.pk).update(created_at=month)
+
+        names = ensure_ledger_partitions(months_ahead=6)
+        self.assertIn(f"{table}_{month:%Y_%m}", names)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute(f"SELECT id FROM {table}_{month:%Y_%m}")
+            self.assertEqual(cursor.fetchall(), [(change.pk,)])
+        # Idempotent
+        self.assertEqual(ensure_ledger_partitions(months_ahead=6), names)
+
+    def test_snapshots_and_reconciliation_follow_the_ledger(self):
+        before = timezone.now()
+        reserve_stock(self.variant.id, 3, 'cs_1')
+        commit_stock(self.variant.id, 1, 'cs_1')
+
+        # First snapshot: live counters minus the ledger rows after the cut
+        self.assertEqual(take_inventory_snapshot(cut=before), 1)
+        snapshot = InventorySnapshot.objects.get(variant=self.variant)
+        self.assertEqual((snapshot.count_in_stock, snapshot.reserved_stock), (10, 0))
+        self.assertEqual(reconcile_inventory(), ([], 0))
+
+        # Later snapshots: previous snapshot plus the ledger rows in between
+        take_inventory_snapshot(cut=timezone.now())
+        latest = InventorySnapshot.objects.filter(variant=self.variant).latest('taken_at')
+        self.assertEqual((latest.count_in_stock, latest.reserved_stock), (9, 2))
+        self.assertEqual(prune_snapshots(timezone.now()), 1)
+        self.assertEqual(InventorySnapshot.objects.get(variant=self.variant).pk, latest.pk)
+
+        # A write that bypasses the ledger shows up as drift
+        ProductVariant.objects.filter(pk=self.variant.pk).update(count_in_stock=F('count_in_stock') + 5)
+        self.create_product(name='Pixel 9')
+        drift, unverified = reconcile_inventory()
+        self.assertEqual(unverified, 1)
+        self.assertEqual(
+            [(row['variant_id'], row['count_in_stock'], row['expected_count_in_stock']) for row in drift],
+            [(self.variant.id, 14, 9)]
+        )
+        with self.assertRaises(CommandError):
+            call_command('reconcile_inventory', '--fail-on-drift', stdout=StringIO())
+
+
+@override_settings(RESERVATION_ENGINE='counter', RESERVATION_ENGINE_URL='')
+class ReservationEngineTests(CatalogFixturesMixin, TestCase):
+    """
+    Counter-store holds, written behind by flush()
+    """
+    def setUp(self):
+        super().setUp()
+        self.store = InProcessCounterStore()
+        reset_store(self.store)
+        self.addCleanup(reset_store)
+        self.first, self.second = self.create_product(variants=2).variants.order_by('id')
+        self.expires_at = timezone.now() + RESERVATION_TTL
+
+    def reserved(self):
+        return list(ProductVariant.objects.order_by('id').values_list('reserved_stock', flat=True))
+
+    def test_holds_are_buffered_then_flushed(self):
+        reservations, shortages = reserve_items({self.first.id: 2, self.second.id: 1}, 'cs_1', self.expires_at)
+        self.assertEqual(shortages, [])
+        self.assertEqual([r.pk for r in reservations], [None, None])
+        self.assertEqual(self.store.counters, {self.first.id: 8, self.second.id: 9})
+        self.assertFalse(InventoryReservation.objects.exists())
+
+        self.assertEqual(engine_flush(), 1)
+        self.assertEqual(self.reserved(), [2, 1])
+        self.assertEqual(InventoryReservation.objects.filter(session_id='cs_1').count(), 2)
+        self.assertEqual(InventoryChange.objects.filter(reference_id='cs_1', reason='reservation').count(), 2)
+        self.assertEqual(self.store.counters, {self.first.id: 8, self.second.id: 9})
+        self.assertEqual(engine_flush(), 0)
+
+    def test_holds_are_all_or_nothing(self):
+        reserve_items({self.first.id: 8}, 'cs_1', self.expires_at)
+        reservations, shortages = reserve_items({self.second.id: 1, self.first.id: 3}, 'cs_2', self.expires_at)
+        self.assertEqual(reservations, [])
+        self.assertEqual(shortages, [{'variant_id': self.first.id, 'requested': 3, 'available': 2}])
+        self.assertEqual(self.store.counters, {self.first.id: 2, self.second.id: 10})
+        _, shortages = reserve_items({0: 1}, 'cs_3', self.expires_at)
+        self.assertEqual(shortages, [{'variant_id': 0, 'requested': 1, 'available': None}])
+
+    def test_discarding_a_buffered_hold_writes_nothing(self):
+        reserve_items({self.first.id: 4}, 'cs_1', self.expires_at)
+        self.assertEqual(len(release_session_reservations('cs_1')), 1)
+        self.assertEqual(self.store.counters[self.first.id], 10)
+        engine_flush()
+        self.assertFalse(InventoryReservation.objects.exists())
+        self.assertEqual(self.reserved(), [0, 0])
+
+    def test_bound_hold_is_written_under_the_session_id(self):
+        token = new_reservation_token()
+        reserve_items({self.first.id: 1}, token, self.expires_at)
+        self.assertEqual(bind_reservations(token, 'cs_1'), 1)
+        engine_flush()
+        self.assertEqual(list(InventoryReservation.objects.values_list('session_id', flat=True)), ['cs_1'])
+
+    def test_waiting_for_a_flush_keeps_the_hold_in_place(self):
+        reserve_items({self.first.id: 1}, 'cs_1', self.expires_at)
+        reserve_items({self.second.id: 1}, 'cs_2', self.expires_at)
+        self.assertEqual(self.store.status('cs_1'), 'buffered')
+        with mock.patch('myapp.reservation_engine.FLUSH_WAIT_SECONDS', 0.05):
+            _, shortages = reserve_items({self.first.id: 1}, 'cs_1', self.expires_at)
+        self.assertEqual(shortages, [{'variant_id': self.first.id, 'requested': 1, 'available': 0}])
+        self.assertEqual(list(self.store.queue), ['cs_1', 'cs_2'])
+        self.store.take_batch(1)
+        self.assertEqual(self.store.status('cs_1'), 'inflight')
+        self.assertEqual(self.store.status('cs_3'), 'absent')
+
+    def test_counters_are_not_set_from_a_read_older_than_a_flush(self):
+        reserve_items({self.first.id: 2}, 'cs_1', self.expires_at)
+        self.store.take_batch(1)
+        stale = self.store.current_version()
+        # The flush commits and finishes after the sync read the database
+        reserve_items_locked({self.first.id: 2}, 'cs_1', self.expires_at, sync_engine=False)
+        self.store.finish(['cs_1'])
+        self.assertFalse(self.store.set_available({self.first.id: 10}, stale))
+        self.assertEqual(self.store.counters[self.first.id], 8)
+        self.assertTrue(sync_counters([self.first.id]))
+        self.assertEqual(self.store.counters[self.first.id], 8)
+
+    def test_dropped_bound_hold_expires_its_checkout_session(self):
+        token = new_reservation_token()
+        reserve_items({self.first.id: 3}, token, self.expires_at)
+        bind_reservations(token, 'cs_1')
+        reserve_items({self.second.id: 1}, 'cs_2', self.expires_at)
+        # Stock sold elsewhere after the counters were loaded
+        ProductVariant.objects.filter(id=self.first.id).update(count_in_stock=2)
+        with mock.patch('myapp.reservation_engine.get_stripe_client') as client, \
+                self.assertLogs('myapp', level='ERROR'):
+            engine_flush()
+        client.return_value.checkout.Session.expire.assert_called_once_with('cs_1')
+        self.assertEqual(list(InventoryReservation.objects.values_list('session_id', flat=True)), ['cs_2'])
+
+    def test_restore_settles_holds_left_in_flight(self):
+        reserve_items({self.first.id: 2}, 'cs_written', self.expires_at)
+        reserve_items({self.second.id: 3}, 'cs_lost', self.expires_at)
+        # A flusher takes both, commits the first and dies before finish()
+        self.store.take_batch(10)
+        reserve_items_locked({self.first.id: 2}, 'cs_written', self.expires_at, sync_engine=False)
+
+        self.assertEqual(recover_inflight(), (1, 1))
+        self.assertEqual(self.store.inflight, {})
+        self.assertEqual(list(self.store.queue), ['cs_lost'])
+        restore_counters()
+        self.assertEqual(self.store.counters, {self.first.id: 8, self.second.id: 7})
+
+        engine_flush()
+        self.assertEqual(self.reserved(), [2, 3])
+        self.assertEqual(
+            sorted(InventoryReservation.objects.values_list('session_id', flat=True)), ['cs_lost', 'cs_written']
+        )
+
+    @override_settings(DEBUG=False, TESTING=False)
+    def test_in_process_store_is_refused_outside_debug_and_tests(self):
+        reset_store()
+        with self.assertRaises(ImproperlyConfigured):
+            get_store()
+        self.assertEqual([error.id for error in check_reservation_engine(None)], ['myapp.E002'])
+
+
+class ReservationExpirySchedulerTests(CatalogFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+        self.command = ExpiryCommand(stdout=StringIO())
+
+    def test_sweep_releases_expired_reservations(self):
+        reserve_items_locked({self.variant.id: 2}, 'cs_old', timezone.now() - timedelta(seconds=1))
+        self.command.sweep(batch_size=100)
+        self.assertEqual(ProductVariant.objects.get(pk=self.variant.pk).reserved_stock, 0)
+        self.assertFalse(InventoryReservation.objects.filter(is_active=True).exists())
+
+    def test_deadlines_are_distinct_and_within_the_horizon(self):
+        now = timezone.now()
+        soon = now + timedelta(seconds=30)
+        reserve_items_locked({self.variant.id: 1}, 'cs_1', soon)
+        reserve_items_locked({self.variant.id: 1}, 'cs_2', soon)
+        reserve_items_locked({self.variant.id: 1}, 'cs_3', now + timedelta(seconds=10))
+        reserve_items_locked({self.variant.id: 1}, 'cs_4', now + timedelta(hours=1))
+        self.assertEqual(
+            self.command.load_deadlines(now + timedelta(minutes=5)),
+            [now + timedelta(seconds=10), soon]
+        )
+
+    def test_catch_up_sweep_survives_a_database_error(self):
+        calls = []
+
+        def sweep(batch_size):
+            calls.append(batch_size)
+            if len(calls) == 1:
+                raise OperationalError('server closed the connection unexpectedly')
+            self.command.stopping.set()
+
+        self.command.sweep = sweep
+        with mock.patch('myapp.management.commands.run_reservation_expiry.signal.signal'), \
+                mock.patch('myapp.management.commands.run_reservation_expiry.connection.close'):
+            self.command.handle(poll_interval=0.01, horizon=300, batch_size=100)
+        self.assertEqual(calls, [100, 100])
+
+
+class StockPollingTests(CatalogFixturesMixin, TestCase):
+    """
+    Availability polls revalidate against the shared stock versions
+    """
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+        self.url = reverse('get_variant_stock', args=[self.variant.id])
+
+    def test_matching_etag_is_answered_without_the_database(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['available'], 10)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_committed_stock_change_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_stock(self.variant.id, 3)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['available'], 7)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_version_is_not_bumped_before_commit(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=False):
+            variant = ProductVariant.objects.get(pk=self.variant.pk)
+            variant.count_in_stock = 4
+            variant.save()
+            # A poll racing the uncommitted save must not get a new ETag for it
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+@mock.patch.object(broadcaster, '_ensure_listener', mock.Mock())
+class StockStreamTests(CatalogFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+        self.url = reverse('stream_variant_stock')
+
+    async def read(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    def test_invalid_ids_are_rejected(self):
+        for ids in ('', 'a,b', ','.join(str(i) for i in range(1, 102))):
+            self.assertEqual(self.client.get(self.url, {'ids': ids}).status_code, 400)
+
+    def test_listener_connects_like_django(self):
+        with mock.patch.dict(connection.settings_dict['OPTIONS'], {'sslmode': 'require'}):
+            conninfo = broadcaster._conninfo()
+        self.assertIn('sslmode=require', conninfo)
+        self.assertIn(f"dbname={connection.settings_dict['NAME']}", conninfo)
+
+    @mock.patch('myapp.inventory_views.STREAM_MAX_SECONDS', 0.05)
+    async def test_stream_sends_current_counts_and_ends_at_its_lifetime(self):
+        response = await self.async_client.get(self.url, {'ids': str(self.variant.id)})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = await self.read(response)
+        self.assertTrue(body.startswith('retry: '))
+        self.assertIn(f'data: {{"id": {self.variant.id}, "available": 10, "reserved": 0}}', body)
+        self.assertEqual(broadcaster.subscribers, {})
+
+    @mock.patch('myapp.inventory_views.STREAM_MAX_SECONDS', 0.2)
+    async def test_stream_pushes_broadcast_updates(self):
+        response = await self.async_client.get(self.url, {'ids': str(self.variant.id)})
+        content = response.streaming_content
+        # retry hint and the current counts
+        await anext(content)
+        await anext(content)
+        broadcaster._fan_out({'id': self.variant.id, 'available': 7, 'reserved': 3})
+        self.assertIn('"available": 7', (await anext(content)).decode())
+        # Runs out at the lifetime cap and unsubscribes
+        self.assertNotIn('data:', b''.join([chunk async for chunk in content]).decode())
+        self.assertEqual(broadcaster.subscribers, {})
+
+
+@override_settings(STRIPE_WEBHOOK_ASYNC=False)
+class StripeWebhookTests(CatalogFixturesMixin, TestCase):
+    """
+    Inline webhook deliveries: recorded, applied and marked processed together
+    """
+    def setUp(self):
+        super().setUp()
+        self.variant = self.create_product().variants.get()
+
+    def deliver(self, event_id, event_type, data):
+        event = {'id': event_id, 'type': event_type, 'data': {'object': data}}
+        return self.client.post(
+            reverse('stripe_webhook'), json.dumps(event),
+            content_type='application/json', HTTP_STRIPE_SIGNATURE='test_signature'
+        )
+
+    def stock(self):
+        variant = ProductVariant.objects.get(pk=self.variant.pk)
+        return variant.count_in_stock, variant.reserved_stock
+
+    def test_duplicate_delivery_is_applied_once(self):
+        reserve_items_locked({self.variant.id: 2}, 'cs_1', timezone.now() + RESERVATION_TTL)
+        session = {'id': 'cs_1', 'payment_status': 'paid', 'metadata': {}}
+
+        response = self.deliver('evt_1', 'checkout.session.completed', session)
+        self.assertEqual(response.json(), {'status': 'committed 1 reservations'})
+        response = self.deliver('evt_1', 'checkout.session.completed', session)
+        self.assertEqual(response.json(), {'status': 'duplicate'})
+
+        self.assertEqual(self.stock(), (8, 0))
+        event = WebhookEvent.objects.get(event_id='evt_1')
+        self.assertEqual((event.status, event.outcome), ('processed', 'committed 1 reservations'))
+
+    def test_failed_handler_leaves_no_partial_writes(self):
+        def handler(obj):
+            reserve_stock(self.variant.id, 3, reference_id=obj['id'])
+            raise RuntimeError('boom')
+
+        with mock.patch.dict(HANDLERS, {'test.failure': handler}):
+            response = self.deliver('evt_2', 'test.failure', {'id': 'obj_1'})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.stock(), (10, 0))
+        self.assertFalse(InventoryChange.objects.exists())
+        self.assertEqual(WebhookEvent.objects.get(event_id='evt_2').status, 'failed')
+
+        # Stripe's retry is processed again
+        with mock.patch.dict(HANDLERS, {'test.failure': lambda obj: 'ok'}):
+            self.assertEqual(self.deliver('evt_2', 'test.failure', {'id': 'obj_1'}).json(), {'status': 'ok'})
+
+    def test_second_paid_event_does_not_deduct_again(self):
+        reserve_items_locked({self.variant.id: 2}, 'cs_1', timezone.now() + RESERVATION_TTL)
+        session = {'id': 'cs_1', 'payment_status': 'paid', 'metadata': {
+            'items': json.dumps([{'variant_id': self.variant.id, 'quantity': 2}])
+        }}
+        self.deliver('evt_1', 'checkout.session.completed', session)
+        response = self.deliver('evt_2', 'checkout.session.async_payment_succeeded', session)
+        self.assertEqual(response.json(), {'status': 'already_committed'})
+        self.assertEqual(self.stock(), (8, 0))
+        self.assertEqual(InventoryChange.objects.filter(reason='purchase').count(), 1)
+
+    def test_paid_session_with_an_expired_hold_deducts_once(self):
+        reserve_items_locked({self.variant.id: 2}, 'cs_1', timezone.now() - timedelta(seconds=1))
+        expire_reservations()
+        session = {'id': 'cs_1', 'payment_status': 'paid', 'metadata': {
+            'items': json.dumps([{'variant_id': self.variant.id, 'quantity': 2}])
+        }}
+        self.assertEqual(self.deliver('evt_1', 'checkout.session.completed', session).json(), {'status': 'deducted 1 variants'})
+        self.assertEqual(self.stock(), (8, 0))
+        # Without a hold that expired there is nothing to fall back on
+        session['id'] = 'cs_2'
+        self.assertEqual(self.deliver('evt_2', 'checkout.session.completed', session).json(), {'status': 'no_reservations'})
+        self.assertEqual(self.stock(), (8, 0))
+
+    def test_canceled_intent_looks_up_its_session_before_the_transaction(self):
+        reserve_items_locked({self.variant.id: 2}, 'cs_1', timezone.now() + RESERVATION_TTL)
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        def list_sessions(**kwargs):
+            depths.append(len(connection.atomic_blocks))
+            return SimpleNamespace(data=[{'id': 'cs_1', 'metadata': {}}])
+
+        with mock.patch('myapp.webhooks.get_stripe_client') as client:
+            client.return_value.checkout.Session.list.side_effect = list_sessions
+            response = self.deliver('evt_1', 'payment_intent.canceled', {'id': 'pi_1'})
+        self.assertEqual(response.json(), {'status': 'released 1 reservations'})
+        self.assertEqual(depths, [depth])
+        self.assertEqual(self.stock(), (10, 0))
+
+    def test_handler_metrics_are_shared_through_the_cache(self):
+        reset_handler_metrics()
+        self.deliver('evt_1', 'checkout.session.expired', {'id': 'cs_1'})
+        self.deliver('evt_2', 'checkout.session.expired', {'id': 'cs_2'})
+        # What another process reads back
+        metrics = handler_metrics()
+        self.assertEqual(list(metrics), ['checkout.session.expired'])
+        self.assertEqual((metrics['checkout.session.expired']['calls'], metrics['checkout.session.expired']['failures']), (2, 0))
+
+
+def queue_webhook_event(event_id, ordering_key):
+    event = {'id': event_id, 'type': 'checkout.session.completed', 'data': {'object': {'id': ordering_key}}}
+    return claim_webhook_event(event, json.dumps(event))
+
+
+class WebhookQueueTests(TestCase):
+    def test_events_of_one_session_are_claimed_in_order(self):
+        queue_webhook_event('evt_a1', 'cs_a')
+        queue_webhook_event('evt_a2', 'cs_a')
+        queue_webhook_event('evt_b1', 'cs_b')
+
+        claimed = claim_webhook_events(10)
+        self.assertEqual([event.event_id for event in claimed], ['evt_a1', 'evt_b1'])
+        # Leased: a second worker gets nothing, and evt_a2 waits for evt_a1
+        self.assertEqual(claim_webhook_events(10), [])
+
+        self.assertTrue(process_webhook_event(claimed[0], lambda event: 'done'))
+        self.assertEqual([event.event_id for event in claim_webhook_events(10)], ['evt_a2'])
+
+    def test_a_claimed_event_is_applied_once(self):
+        queue_webhook_event('evt_1', 'cs_1')
+        event = claim_webhook_events(10)[0]
+        calls = []
+
+        def handler(stripe_event):
+            calls.append(stripe_event['id'])
+            return 'done'
+
+        self.assertTrue(process_webhook_event(event, handler))
+        # e.g. a second worker that claimed it after the lease ran out
+        self.assertFalse(process_webhook_event(event, handler))
+        self.assertEqual(calls, ['evt_1'])
+        self.assertEqual(WebhookEvent.objects.get(event_id='evt_1').status, 'processed')
+
+    def test_failed_handler_is_rolled_back_and_retried(self):
+        queue_webhook_event('evt_1', 'cs_1')
+        event = claim_webhook_events(10)[0]
+
+        def handler(stripe_event):
+            StripeSyncTask.objects.create(object_type='product', object_id=1)
+            raise RuntimeError('boom')
+
+        self.assertFalse(process_webhook_event(event, handler))
+        self.assertFalse(StripeSyncTask.objects.exists())
+        event = WebhookEvent.objects.get(event_id='evt_1')
+        self.assertEqual((event.status, event.attempts), ('received', 1))
+
+
+class WebhookQueueLockingTests(TransactionTestCase):
+    def test_claim_skips_events_a_worker_is_applying(self):
+        queue_webhook_event('evt_a1', 'cs_a')
+        queue_webhook_event('evt_b1', 'cs_b')
+        # Both leases have run out, but evt_a1's handler is still running
+        WebhookEvent.objects.update(next_attempt_at=timezone.now() - timedelta(minutes=1))
+        claimed = []
+
+        def other_worker():
+            try:
+                claimed.extend(event.event_id for event in claim_webhook_events(10))
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            WebhookEvent.objects.select_for_update().get(event_id='evt_a1')
+            thread = threading.Thread(target=other_worker)
+            thread.start()
+            thread.join()
+        self.assertEqual(claimed, ['evt_b1'])
+
+
+class StripeSyncTests(CatalogFixturesMixin, TestCase):
+    def test_saves_queue_one_pending_task_per_object(self):
+        product = self.create_product(variants=1)
+        product.name = 'Pixel 8 Pro'
+        product.save()
+        self.assertEqual(StripeSyncTask.objects.filter(object_type='product', processed_at__isnull=True).count(), 1)
+        self.assertEqual(StripeSyncTask.objects.filter(object_type='variant', processed_at__isnull=True).count(), 1)
+
+    def test_worker_pushes_products_and_prices(self):
+        product = self.create_product(variants=2)
+        fake = FakeStripe()
+
+        self.assertEqual(process_stripe_sync_batch(client=fake), 3)
+
+        product.refresh_from_db()
+        self.assertTrue(product.stripe_id.startswith('prod_'))
+        for variant in product.variants.all():
+            self.assertIn(variant.stripe_price_id, fake.prices)
+        self.assertFalse(StripeSyncTask.objects.filter(processed_at__isnull=True).exists())
+
+    def test_stock_changes_do_not_queue_a_sync(self):
+        product = self.create_product(variants=1)
+        process_stripe_sync_batch(client=FakeStripe())
+
+        variant = ProductVariant.objects.get(product=product)
+        variant.reserved_stock += 1
+        variant.save()
+        self.assertFalse(StripeSyncTask.objects.filter(processed_at__isnull=True).exists())
+
+    def test_price_change_creates_a_new_stripe_price(self):
+        product = self.create_product(variants=1)
+        fake = FakeStripe()
+        process_stripe_sync_batch(client=fake)
+
+        variant = ProductVariant.objects.get(product=product)
+        old_price_id = variant.stripe_price_id
+        variant.price = '749.00'
+        variant.save()
+        process_stripe_sync_batch(client=fake)
+
+        variant.refresh_from_db()
+        self.assertNotEqual(variant.stripe_price_id, old_price_id)
+        self.assertEqual(fake.prices[variant.stripe_price_id].unit_amount, 74900)
@@ -4,7 +4,7 @@ from . import stripe_views
 
 # Import views from their respective modules
 from .views import (
-    get_products, get_product_detail, get_product_by_slug, home, 
+    get_products, get_product_detail, get_product_by_slug, home, search_products_with_facets,
     get_brands, get_categories, get_phone_brands, get_phone_models, 
     get_repair_services, get_accessories, debug_accessories, get_accessory_by_slug
 )
@@ -22,13 +22,13 @@ from .cart_views import (
 )
 
 # Import stripe views
-from .stripe_views import create_checkout_session, create_buy_now_session, get_session_details, release_checkout_reservation, debug_inventory_reservation
+from .stripe_views import create_checkout_session, create_buy_now_session, get_session_details, release_checkout_reservation, debug_inventory_reservation, webhook_queue_status
 
 # Import inventory views
 from .inventory_views import (
     get_variant_stock, update_variant_stock, reserve_inventory,
     release_reservation, commit_reservation, validate_inventory,
-    cleanup_expired_reservations
+    cleanup_expired_reservations, stream_variant_stock, bulk_update_stock
 )
 
 from rest_framework_simplejwt.views import TokenRefreshView
@@ -39,6 +39,7 @@ urlpatterns = [
     
     # Product views
     path('api/products/', get_products, name='get_products'),
+    path('api/products/search/', search_products_with_facets, name='search_products_with_facets'),
     path('api/products/<int:pk>/', get_product_detail, name='get_product_detail'),
     path('api/products/by-slug/<slug:slug>/', get_product_by_slug, name='get_product_by_slug'),
     path('api/brands/', get_brands, name='get_brands'),
@@ -55,7 +56,9 @@ urlpatterns = [
     # Inventory views
     path('api/inventory/variant/<int:variant_id>/', get_variant_stock, name='get_variant_stock'),
     path('api/inventory/variant/', get_variant_stock, name='get_variant_stock_filtered'),
+    path('api/inventory/stream/', stream_variant_stock, name='stream_variant_stock'),
     path('api/inventory/update/', update_variant_stock, name='update_variant_stock'),
+    path('api/inventory/bulk-update/', bulk_update_stock, name='bulk_update_stock'),
     path('api/inventory/reserve/', reserve_inventory, name='reserve_inventory'),
     path('api/inventory/release/', release_reservation, name='release_reservation'),
     path('api/inventory/commit/', commit_reservation, name='commit_reservation'),
@@ -71,6 +74,7 @@ urlpatterns = [
    
     # Webhook views
     path('api/webhook/', stripe_views.stripe_webhook, name='stripe_webhook'),
+    path('api/webhook/metrics/', webhook_queue_status, name='webhook_queue_status'),
     
     # Authentication views
     path('api/auth/login/', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
@@ -1,4 +1,8 @@
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.db.models import Exists, OuterRef
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
@@ -9,7 +13,10 @@ from .serializers import (
     PhoneBrandSerializer, PhoneModelSerializer, RepairServiceSerializer,
     AccessoriesSerializer
 )
-from rest_framework.pagination import PageNumberPagination
+from .pagination import get_product_paginator
+from .search import search_products
+from .facets import compute_facets
+from . import catalog_cache
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -22,6 +29,7 @@ def home(request):
         "version": "1.0.0",
         "endpoints": {
             "products": "/myapp/products/",
+            "product_search": "/myapp/products/search/",
             "product_detail": "/myapp/products/<id>/",
             "product_by_slug": "/myapp/products/slug/<slug>/",
             "brands": "/myapp/brands/",
@@ -35,6 +43,86 @@ def home(request):
         }
     })
 
+def parse_price(value, name):
+    """
+    Parse a price query parameter; raises ValueError with a client-facing message
+    """
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f"{name} must be a number")
+    if not price.is_finite() or price < 0:
+        raise ValueError(f"{name} must be a non-negative number")
+    return price
+
+def filter_products(params):
+    """
+    Build the product queryset for the list/search endpoints from query params.
+    Raises ValueError for malformed parameters.
+    """
+    # Get query parameters
+    brand = params.get('brand')
+    category = params.get('category')
+    product_type = params.get('type')
+    color = params.get('color')
+    storage = params.get('storage')
+    min_price = params.get('min_price')
+    max_price = params.get('max_price')
+    search = params.get('search')
+    in_stock = params.get('in_stock')
+   
+    # Start with all products
+    products = Product.objects.all()
+   
+    # Apply filters if provided
+    if brand:
+        products = products.filter(brand__iexact=brand)
+    if category:
+        products = products.filter(category__iexact=category)
+    if product_type:
+        products = products.filter(product_type=product_type)
+    if color or storage or in_stock in ('true', '1'):
+        # All conditions must hold for the same variant; EXISTS avoids duplicate rows
+        variants = ProductVariant.objects.filter(product=OuterRef('pk'))
+        if color:
+            variants = variants.filter(color__iexact=color)
+        if storage:
+            variants = variants.filter(storage__iexact=storage)
+        if in_stock in ('true', '1'):
+            # Served by the partial variant_in_stock_idx
+            variants = variants.filter(available_stock__gt=0)
+        products = products.filter(Exists(variants))
+    elif in_stock in ('false', '0'):
+        products = products.exclude(
+            Exists(ProductVariant.objects.filter(product=OuterRef('pk'), available_stock__gt=0))
+        )
+    if min_price:
+        products = products.filter(base_price__gte=parse_price(min_price, 'min_price'))
+    if max_price:
+        # Inclusive: "up to $500" should include a $500 product
+        products = products.filter(base_price__lte=parse_price(max_price, 'max_price'))
+    if search:
+        # Ranked full-text match; cursor pagination re-orders by (createdAt, id)
+        products = search_products(products, search)
+    return products
+
+def stock_dependent(params):
+    """
+    Stock filters change with every sale, which doesn't bump the catalog
+    version, so their results are built fresh instead of cached
+    """
+    return params.get('in_stock') in ('true', '1', 'false', '0')
+
+def paginate_products(request, products):
+    """
+    Paginate and serialize a product queryset, returning the response data
+    """
+    # Page numbers by default, keyset cursors on request
+    paginator = get_product_paginator(request)
+    paginated_products = paginator.paginate_queryset(products, request)
+    serializer = ProductSerializer(paginated_products, many=True)
+    return paginator.get_paginated_response(serializer.data).data
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_products(request):
@@ -42,34 +130,54 @@ def get_products(request):
     Get all products or filter by query params
     """
     try:
-        # Get query parameters
-        brand = request.query_params.get('brand')
-        category = request.query_params.get('category')
-        product_type = request.query_params.get('type')
-        search = request.query_params.get('search')
+        try:
+            products = filter_products(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
        
-        # Start with all products
-        products = Product.objects.all()
+        def build():
+            return paginate_products(request, products)
        
-        # Apply filters if provided
-        if brand:
-            products = products.filter(brand__iexact=brand)
-        if category:
-            products = products.filter(category__iexact=category)
-        if product_type:
-            products = products.filter(product_type=product_type)
-        if search:
-            products = products.filter(name__icontains=search)
+        if stock_dependent(request.query_params):
+            return Response(build())
+        # Pagination links are absolute, so the host is part of the key
+        data = catalog_cache.get_or_build(
+            'products', build,
+            catalog_cache.query_params_dict(request), request.get_host()
+        )
+        return Response(data)
+   
+    except Exception as e:
+        return Response(
+            {"error": str(e)},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def search_products_with_facets(request):
+    """
+    Get a page of products plus facet counts (brand, category, type, color,
+    storage, price bucket) for the same filters, in a single round trip
+    """
+    try:
+        try:
+            products = filter_products(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
        
-        # Paginate the results
-        page = request.query_params.get('page', 1)
-        paginator = PageNumberPagination()
-        paginator.page_size = 10
-        paginated_products = paginator.paginate_queryset(products, request)
+        def build():
+            data = paginate_products(request, products)
+            data['facets'] = compute_facets(products)
+            return data
        
-        # Serialize and return
-        serializer = ProductSerializer(paginated_products, many=True)
-        return paginator.get_paginated_response(serializer.data)
+        if stock_dependent(request.query_params):
+            return Response(build())
+        data = catalog_cache.get_or_build(
+            'product_facets', build,
+            catalog_cache.query_params_dict(request), request.get_host()
+        )
+        return Response(data)
    
     except Exception as e:
         return Response(
@@ -84,9 +192,14 @@ def get_product_detail(request, pk):
     Get detailed information for a specific product
     """
     try:
-        product = get_object_or_404(Product, pk=pk)
-        serializer = ProductDetailSerializer(product)
-        return Response(serializer.data)
+        def build():
+            product = get_object_or_404(Product.objects.prefetch_related('variants'), pk=pk)
+            return ProductDetailSerializer(product).data
+       
+        return Response(catalog_cache.get_or_build(
+            'product_detail', build, None, pk,
+            timeout=settings.CATALOG_DETAIL_CACHE_TIMEOUT
+        ))
    
     except Exception as e:
         return Response(
@@ -101,9 +214,14 @@ def get_product_by_slug(request, slug):
     Get detailed information for a product by its slug
     """
     try:
-        product = get_object_or_404(Product, slug=slug)
-        serializer = ProductDetailSerializer(product)
-        return Response(serializer.data)
+        def build():
+            product = get_object_or_404(Product.objects.prefetch_related('variants'), slug=slug)
+            return ProductDetailSerializer(product).data
+       
+        return Response(catalog_cache.get_or_build(
+            'product_by_slug', build, None, slug,
+            timeout=settings.CATALOG_DETAIL_CACHE_TIMEOUT
+        ))
    
     except Exception as e:
         return Response(
@@ -118,8 +236,10 @@ def get_brands(request):
     Get all unique brands
     """
     try:
-        brands = Product.objects.values_list('brand', flat=True).distinct()
-        return Response(list(brands))
+        brands = catalog_cache.get_or_build(
+            'brands', lambda: list(Product.objects.values_list('brand', flat=True).distinct())
+        )
+        return Response(brands)
    
     except Exception as e:
         return Response(
@@ -134,8 +254,10 @@ def get_categories(request):
     Get all unique categories
     """
     try:
-        categories = Product.objects.values_list('category', flat=True).distinct()
-        return Response(list(categories))
+        categories = catalog_cache.get_or_build(
+            'categories', lambda: list(Product.objects.values_list('category', flat=True).distinct())
+        )
+        return Response(categories)
    
     except Exception as e:
         return Response(
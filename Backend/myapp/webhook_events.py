@@ -0,0 +1,197 @@
+"""
+Stripe webhook bookkeeping and queue. Every delivery is recorded in
+WebhookEvent with a single INSERT ... ON CONFLICT on the unique event_id, so a
+retried or replayed event is recognised by that one indexed statement and
+skipped. Rows in 'received' double as a Postgres-backed queue: workers lease
+them with SELECT ... FOR UPDATE SKIP LOCKED, in parallel across checkout
+sessions and in order within one.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import stripe
+from django.db import connection, transaction
+from django.db.models import Count, Exists, Min, OuterRef, Q
+from django.utils import timezone
+
+from .models import WebhookEvent
+
+logger = logging.getLogger('myapp')
+
+# A delivery still 'received' after this long is assumed to have died mid-way
+PROCESSING_LEASE = timedelta(minutes=5)
+MAX_ATTEMPTS = 8
+
+
+def get_ordering_key(event):
+    """
+    Events about the same object (checkout session, payment intent) must be
+    applied in the order they were received
+    """
+    try:
+        return event['data']['object']['id']
+    except (KeyError, TypeError):
+        return None
+
+
+def claim_webhook_event(event, payload, process_now=False):
+    """
+    Record the event and return True if this delivery should process it.
+    Returns False for duplicates: events already processed, or being processed
+    by another delivery. Failed (or abandoned) events are handed out again so
+    Stripe's retries can complete them. With process_now the caller handles
+    the event inline, so queue workers leave it alone for the lease period;
+    the caller claims, applies and completes it in one transaction.
+    """
+    table = WebhookEvent._meta.db_table
+    now = timezone.now()
+    due_at = now + PROCESSING_LEASE if process_now else now
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (event_id, event_type, data, status, ordering_key, attempts, next_attempt_at, received_at)
+            VALUES (%s, %s, %s, 'received', %s, 0, %s, %s)
+            ON CONFLICT (event_id) DO UPDATE
+            SET status = 'received', received_at = EXCLUDED.received_at, outcome = NULL,
+                attempts = 0, next_attempt_at = EXCLUDED.next_attempt_at
+            WHERE {table}.status = 'failed'
+               OR ({table}.status = 'received' AND {table}.received_at < %s)
+            RETURNING id
+            """,
+            [event['id'], event['type'], payload, get_ordering_key(event), due_at, now, now - PROCESSING_LEASE]
+        )
+        return cursor.fetchone() is not None
+
+
+def complete_webhook_event(event_id, outcome):
+    """
+    Mark the event processed and store what processing did
+    """
+    WebhookEvent.objects.filter(event_id=event_id).update(
+        status='processed', outcome=outcome, processed_at=timezone.now()
+    )
+
+
+def fail_webhook_event(event_id, error):
+    """
+    Mark the event failed so Stripe's next retry processes it again
+    """
+    logger.warning(f"Webhook event {event_id} failed: {error}")
+    WebhookEvent.objects.filter(event_id=event_id).update(
+        status='failed', outcome=str(error), processed_at=timezone.now()
+    )
+
+
+def retry_webhook_event(event, error):
+    """
+    Put a queued event back with exponential backoff; give up after MAX_ATTEMPTS
+    """
+    attempts = event.attempts + 1
+    if attempts >= MAX_ATTEMPTS:
+        fail_webhook_event(event.event_id, error)
+        return
+    delay = min(timedelta(seconds=5 * 2 ** attempts), timedelta(minutes=30))
+    WebhookEvent.objects.filter(id=event.id).update(
+        attempts=attempts, outcome=str(error), next_attempt_at=timezone.now() + delay
+    )
+
+
+def claim_webhook_events(batch_size):
+    """
+    Lease up to batch_size due events. Only the oldest pending event of each
+    ordering key is eligible, so one batch never holds two events for the same
+    checkout session; rows locked by another worker are skipped. The lease
+    only covers the gap until process_webhook_event() locks the row itself.
+    """
+    now = timezone.now()
+    earlier = WebhookEvent.objects.filter(
+        ordering_key=OuterRef('ordering_key'), status='received', id__lt=OuterRef('id')
+    )
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(status='received', next_attempt_at__lte=now)
+            .exclude(Exists(earlier))
+            .order_by('id')[:batch_size]
+        )
+        if events:
+            WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(
+                next_attempt_at=now + PROCESSING_LEASE
+            )
+    return events
+
+
+def process_webhook_event(event, handler, prepare=None):
+    """
+    Run one queued event through handler, which returns an outcome string or
+    raises to have the event retried. The event row stays locked while the
+    handler runs and its writes commit together with the 'processed' mark,
+    so a handler that outlives the lease is never picked up a second time
+    and a crash leaves nothing half applied. prepare, if given, runs first
+    and outside the transaction (it may call the Stripe API).
+    """
+    stripe_event = stripe.Event.construct_from(json.loads(event.data), stripe.api_key)
+    if prepare:
+        try:
+            prepare(stripe_event)
+        except Exception as e:
+            logger.warning(f"Preparing queued webhook event {event.event_id} failed: {e}")
+            retry_webhook_event(event, e)
+            return False
+    with transaction.atomic():
+        locked = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(id=event.id, status='received').values_list('id', flat=True)
+        )
+        if not locked:
+            # Finished (or being applied) by another delivery since the claim
+            return False
+        try:
+            with transaction.atomic():
+                outcome = handler(stripe_event)
+        except Exception as e:
+            logger.warning(f"Queued webhook event {event.event_id} failed: {e}")
+            retry_webhook_event(event, e)
+            return False
+        complete_webhook_event(event.event_id, outcome)
+        return True
+
+
+def process_webhook_batch(handler, batch_size=20, workers=4, prepare=None):
+    """
+    Claim one batch and process it on a thread pool. Returns the number claimed.
+    """
+    events = claim_webhook_events(batch_size)
+    if not events:
+        return 0
+
+    def process(event):
+        try:
+            return process_webhook_event(event, handler, prepare)
+        finally:
+            # Each pool thread opens its own connection, and the pool ends with the batch
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(process, events))
+    return len(events)
+
+
+def webhook_queue_metrics():
+    """
+    Queue depth, lag of the oldest pending event and failure counts
+    """
+    now = timezone.now()
+    stats = WebhookEvent.objects.filter(status__in=['received', 'failed']).aggregate(
+        depth=Count('id', filter=Q(status='received')),
+        retrying=Count('id', filter=Q(status='received', attempts__gt=0)),
+        failed=Count('id', filter=Q(status='failed')),
+        oldest=Min('received_at', filter=Q(status='received')),
+    )
+    oldest = stats.pop('oldest')
+    stats['lag_seconds'] = (now - oldest).total_seconds() if oldest else 0
+    return stats
@@ -0,0 +1,242 @@
+"""
+Stripe event router. Each event type maps to one registered handler that does
+all of that event's inventory work; dispatch() times every call so slow
+handlers show up in the webhook metrics. Handlers run inside the transaction
+that holds the event row, so any Stripe API lookup they need is done first
+by the event type's preparer (see prepare()).
+"""
+import json
+import logging
+import time
+
+from django.core.cache import cache
+
+from .inventory import commit_session_reservations, release_session_reservations, deduct_stock
+from .models import InventoryReservation
+from .stripe_sync import get_stripe_client
+
+logger = logging.getLogger('myapp')
+
+HANDLERS = {}
+PREPARERS = {}
+
+# Handler timings live in the shared cache, so the web process's metrics
+# endpoint reports what the process_webhooks workers did
+STATS_KEY = 'webhook:stats:{}:{}'
+STATS_FIELDS = ('calls', 'failures', 'total_us', 'max_us')
+
+
+def register(*event_types, prepare=None):
+    """
+    Register the decorated function as the handler for the given event
+    types, with an optional preparer that prepare() runs before it
+    """
+    def decorator(handler):
+        for event_type in event_types:
+            HANDLERS[event_type] = handler
+            if prepare:
+                PREPARERS[event_type] = prepare
+        return handler
+    return decorator
+
+
+def prepare(event):
+    """
+    Run the preparer of the event's type, which stores what its handler
+    needs from the Stripe API on the event object. Call it before opening
+    the transaction dispatch() runs in, so no network call holds the event
+    row lock or a database connection. Errors propagate.
+    """
+    preparer = PREPARERS.get(event['type'])
+    if preparer:
+        preparer(event['data']['object'])
+    return event
+
+
+def _incr(key, delta):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        return cache.incr(key, delta)
+
+
+def _record_timing(event_type, elapsed, failed):
+    """
+    Add one handler call to the per event type timings
+    """
+    micros = int(elapsed * 1000000)
+    _incr(STATS_KEY.format(event_type, 'calls'), 1)
+    if failed:
+        _incr(STATS_KEY.format(event_type, 'failures'), 1)
+    _incr(STATS_KEY.format(event_type, 'total_us'), micros)
+    max_key = STATS_KEY.format(event_type, 'max_us')
+    if micros > cache.get(max_key, 0):
+        # Read-then-write; two racing calls may keep the smaller one, fine for a gauge
+        cache.set(max_key, micros, timeout=None)
+
+
+def handler_metrics():
+    """
+    Per event type call counts and timings, across every process
+    """
+    keys = {
+        STATS_KEY.format(event_type, field): (event_type, field)
+        for event_type in HANDLERS for field in STATS_FIELDS
+    }
+    stats = {}
+    for key, value in cache.get_many(list(keys)).items():
+        event_type, field = keys[key]
+        stats.setdefault(event_type, dict.fromkeys(STATS_FIELDS, 0))[field] = value
+    return {
+        event_type: {
+            'calls': values['calls'],
+            'failures': values['failures'],
+            'total_ms': values['total_us'] / 1000,
+            'max_ms': values['max_us'] / 1000,
+            'avg_ms': values['total_us'] / 1000 / values['calls'],
+        }
+        for event_type, values in stats.items() if values['calls']
+    }
+
+
+def reset_handler_metrics():
+    """
+    Forget the timings collected so far (e.g. between benchmark runs)
+    """
+    cache.delete_many([
+        STATS_KEY.format(event_type, field) for event_type in HANDLERS for field in STATS_FIELDS
+    ])
+
+
+def dispatch(event):
+    """
+    Run the handler registered for the event's type. Returns the outcome
+    string; handler errors propagate so the caller can record or retry them.
+    """
+    handler = HANDLERS.get(event['type'])
+    if handler is None:
+        return 'ignored'
+
+    started = time.perf_counter()
+    failed = True
+    try:
+        outcome = handler(event['data']['object'])
+        failed = False
+        return outcome
+    finally:
+        _record_timing(event['type'], time.perf_counter() - started, failed)
+
+
+def _metadata_items(session):
+    """
+    {variant_id: quantity} from the session metadata, as written by checkout
+    ('items') or buy-now ('variant_id'/'quantity')
+    """
+    metadata = session.get('metadata') or {}
+    if metadata.get('items'):
+        items = json.loads(metadata['items'])
+    elif metadata.get('variant_id'):
+        items = [{'variant_id': metadata['variant_id'], 'quantity': metadata.get('quantity', 1)}]
+    else:
+        items = []
+
+    quantities = {}
+    for item in items:
+        variant_id = item.get('variant_id')
+        quantity = int(item.get('quantity', 1))
+        if isinstance(variant_id, str) and variant_id.isdigit():
+            variant_id = int(variant_id)
+        if not variant_id or quantity <= 0:
+            continue
+        quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+    return quantities
+
+
+def _session_keys(session):
+    """
+    The ids a session's reservations may be stored under: the session id, or
+    the provisional token if the session was never bound to its hold
+    """
+    keys = [session['id']]
+    token = (session.get('metadata') or {}).get('reservation_token')
+    if token:
+        keys.append(token)
+    return keys
+
+
+def release_session(session, notes):
+    """
+    Release whatever the session holds, under its id or its provisional token
+    """
+    for key in _session_keys(session):
+        reservations = release_session_reservations(key, notes=notes)
+        if reservations:
+            return f"released {len(reservations)} reservations"
+    return 'no_reservations'
+
+
+@register('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+def handle_checkout_paid(session):
+    """
+    Turn the session's reservations into sales. If the hold already expired,
+    sell the units listed in the metadata as long as they are still on hand;
+    a session whose reservations were already fulfilled is left alone.
+    """
+    session_id = session['id']
+    if session.get('payment_status') == 'unpaid':
+        # Delayed payment method; wait for async_payment_succeeded
+        return 'awaiting_payment'
+
+    keys = _session_keys(session)
+    for key in keys:
+        reservations = commit_session_reservations(
+            key, order_id=session_id, notes=f"Purchase from session {session_id}"
+        )
+        if reservations:
+            return f"committed {len(reservations)} reservations"
+
+    holds = InventoryReservation.objects.filter(session_id__in=keys)
+    if holds.filter(fulfilled_at__isnull=False).exists():
+        # Another paid event for this session (or a redelivery) already sold the units
+        return 'already_committed'
+    if not holds.filter(canceled_at__isnull=False).exists():
+        logger.error(f"Paid session {session_id} never held any stock; nothing deducted")
+        return 'no_reservations'
+
+    logger.warning(f"Reservations of paid session {session_id} expired; deducting from metadata")
+    deducted = 0
+    for variant_id, quantity in sorted(_metadata_items(session).items()):
+        if deduct_stock(variant_id, quantity, reference_id=session_id, notes=f"Purchase from session {session_id}"):
+            deducted += 1
+        else:
+            logger.warning(f"Not enough stock (or no such variant) for variant {variant_id}: requested={quantity}")
+    return f"deducted {deducted} variants"
+
+
+@register('checkout.session.expired', 'checkout.session.async_payment_failed', 'checkout.session.canceled')
+def handle_checkout_unpaid(session):
+    """
+    Give the session's reserved stock back
+    """
+    return release_session(session, notes=f"Released reservation for unpaid session {session['id']}")
+
+
+def find_checkout_session(payment_intent):
+    """
+    Look up the checkout session that owns the intent (None if there is none)
+    """
+    sessions = get_stripe_client().checkout.Session.list(payment_intent=payment_intent['id'], limit=1)
+    payment_intent['checkout_session'] = sessions.data[0] if sessions.data else None
+
+
+@register('payment_intent.canceled', prepare=find_checkout_session)
+def handle_payment_intent_canceled(payment_intent):
+    """
+    Release the stock held by the checkout session that owns the intent,
+    as found by find_checkout_session()
+    """
+    session = payment_intent['checkout_session']
+    if session is None:
+        return 'no_session'
+    return release_session(session, notes=f"Payment intent {payment_intent['id']} canceled")
@@ -3,6 +3,17 @@ ASGI config for myproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the project with an ASGI server so the live stock stream
+(/api/inventory/stream/) holds its connections on the event loop instead of
+one thread each:
+
+    uvicorn myproject.asgi:application --workers 4
+
+Behind nginx, turn proxy buffering off for that path (the view also sends
+X-Accel-Buffering: no) and set proxy_read_timeout above the 15 second
+heartbeat. The WSGI entry point still works, but every open stream then
+pins a worker thread until it ends (STREAM_MAX_SECONDS).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
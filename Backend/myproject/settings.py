@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
@@ -14,6 +15,8 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'django-insecure-default-key-change-th
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get('DEBUG', 'True') == 'True'
+# `manage.py test` may use process-local stand-ins for shared services (see myapp/checks.py)
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
 
 ALLOWED_HOSTS = ['*']  # For development only, restrict in production
 
@@ -25,6 +28,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
    
     # Third-party apps
     'rest_framework',
@@ -79,6 +83,21 @@ DATABASES = {
    }
 }
 
+# Cache (catalog responses, catalog and stock versions, webhook timings). Every
+# process (web workers, process_webhooks, the schedulers) must see the same
+# values, so point CACHE_BACKEND/CACHE_LOCATION at a shared backend such as
+# Redis in production; LocMem is only accepted with DEBUG or in tests
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'zainwireless'),
+    }
+}
+
+# Seconds a cached catalog response lives; saves bump the version long before this
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 60 * 60))
+# Product detail embeds live stock counts, which change without a catalog save
+CATALOG_DETAIL_CACHE_TIMEOUT = int(os.environ.get('CATALOG_DETAIL_CACHE_TIMEOUT', 30))
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -162,6 +181,21 @@ STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
 STRIPE_SUCCESS_URL = os.environ.get('STRIPE_SUCCESS_URL', 'http://localhost:3000/checkout/success?session_id={CHECKOUT_SESSION_ID}')
 STRIPE_CANCEL_URL = os.environ.get('STRIPE_CANCEL_URL', 'http://localhost:3000/cart')
+# Acknowledge webhooks immediately and let `manage.py process_webhooks` apply them.
+# Only turn this on where that worker runs, or deliveries are queued and never applied
+STRIPE_WEBHOOK_ASYNC = os.environ.get('STRIPE_WEBHOOK_ASYNC', 'False') == 'True'
+
+# Anonymous carts: 'db' stores a Cart row per visitor, 'cookie' keeps small carts
+# in a signed cookie and writes them to the database only at login
+GUEST_CART_STORAGE = os.environ.get('GUEST_CART_STORAGE', 'db')
+
+# Reservations: 'db' locks variant rows, 'counter' takes holds in an atomic
+# counter store (Redis when RESERVATION_ENGINE_URL is set, otherwise in-process)
+# and writes them behind; run `manage.py run_reservation_engine` with Redis
+RESERVATION_ENGINE = os.environ.get('RESERVATION_ENGINE', 'db')
+RESERVATION_ENGINE_URL = os.environ.get('RESERVATION_ENGINE_URL', '')
+# Seconds between flushes of the in-process store's buffer (0 disables the flusher thread)
+RESERVATION_ENGINE_FLUSH_INTERVAL = float(os.environ.get('RESERVATION_ENGINE_FLUSH_INTERVAL', '0.2'))
 
 # Logging configuration
 LOGGING = {